@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi poller benchmark
+
+Reads every board on one to several simulated I2C buses with the Poller
+worker threads and reports the board reads per second.
+================================================
+
+Usage: python benchmarks/poller.py [options]
+
+-b --buses=value      largest number of buses, default 4
+-n --repeat=value     snapshots taken for each number of buses, default 50
+-l --latency=value    seconds added to each simulated transaction,
+                      default 0.0005 which is close to a 100 kHz bus
+
+With one worker thread for each bus the reads per second should rise
+with the number of buses.
+"""
+
+import sys
+import os
+import getopt
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import iopi  # noqa: E402
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def main(argv):
+    """
+    Main function.
+    """
+    try:
+        opts, args = getopt.getopt(argv, "b:n:l:",
+                                   ["buses=", "repeat=", "latency="])
+    except getopt.GetoptError:
+        print("option not recognised or no argument given.")
+        sys.exit(2)
+
+    buses = 4
+    repeat = 50
+    latency = 0.0005
+    for opt, arg in opts:
+        if opt in ('-b', '--buses'):
+            buses = int(arg)
+        elif opt in ('-n', '--repeat'):
+            repeat = int(arg)
+        elif opt in ('-l', '--latency'):
+            latency = float(arg)
+
+    iopi.MCP23017.backend = 'sim'
+    addresses = range(0x20, 0x28)
+    for count in range(1, buses + 1):
+        for number in range(1, count + 1):
+            iopi.MCP23017.get_shared_bus(number).latency = latency
+        poller = iopi.Poller(dict((number, addresses)
+                                  for number in range(1, count + 1)))
+        start = monotonic()
+        for _ in range(repeat):
+            poller.snapshot()
+        elapsed = monotonic() - start
+        poller.close()
+        print('{0} buses  {1:8.0f} board reads per second'.format(
+            count, repeat * count * len(addresses) / elapsed))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi command line start-up benchmark
+
+Times complete runs of the command line program, from process start to
+exit, so changes in cold start latency are visible.
+================================================
+
+Usage: python benchmarks/startup.py [-c count] [iopi arguments]
+
+The default arguments, -a 0x20 -p 0 -r, read port 0 of the board at 0x20.
+Only a -c at the start is read by the benchmark, every argument after it
+is passed to iopi.py unchanged, e.g. startup.py -c 50 -a 0x21 -p 1 -r.
+Each case is run as a script and with python -m; the -m form can use the
+cached byte code while a script is compiled on every run.  A command that
+fails, such as a read with no board connected, is still timed and its exit
+status is shown.
+"""
+
+import sys
+import os
+import subprocess
+import time
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+IOPI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_command(command, count):
+    """
+    Run a command count times
+    returns the sorted run times in seconds and the last exit status
+    """
+    times = []
+    status = 0
+    with open(os.devnull, 'w') as null:
+        for _ in range(count):
+            start = monotonic()
+            status = subprocess.call(command, cwd=IOPI_DIR, stdout=null,
+                                     stderr=null)
+            times.append(monotonic() - start)
+    return sorted(times), status
+
+
+def report(name, times, status):
+    """
+    Print the minimum, median and maximum run time
+    """
+    print('{0:<40} min {1:7.2f} ms  median {2:7.2f} ms  max {3:7.2f} ms'
+          '  exit {4}'.format(name, times[0] * 1000,
+                              times[len(times) // 2] * 1000,
+                              times[-1] * 1000, status))
+
+
+def main(argv):
+    """
+    Main function.
+    """
+    # only a leading -c is read here, the rest is passed to iopi.py
+    count = 20
+    args = list(argv)
+    try:
+        if args and args[0].startswith('-c'):
+            if args[0] == '-c':
+                count = int(args[1])
+                args = args[2:]
+            else:
+                count = int(args[0][2:])
+                args = args[1:]
+    except (IndexError, ValueError):
+        print("usage: startup.py [-c count] [iopi arguments]")
+        sys.exit(2)
+    if args and args[0] == '--':
+        args = args[1:]
+    if not args:
+        args = ['-a', '0x20', '-p', '0', '-r']
+
+    cases = [
+        ('interpreter only', [sys.executable, '-c', 'pass']),
+        ('argument error (no bus access)',
+         [sys.executable, 'iopi.py', '-p', '9', '-r']),
+        ('iopi.py ' + ' '.join(args), [sys.executable, 'iopi.py'] + args),
+        ('-m iopi ' + ' '.join(args),
+         [sys.executable, '-m', 'iopi'] + args),
+    ]
+    for name, command in cases:
+        times, status = time_command(command, count)
+        report(name, times, status)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
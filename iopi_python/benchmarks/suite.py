@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi benchmark suite
+
+Runs the MCP23017 methods and typical command lines against the simulated
+bus in iopi_sim and reports the I2C transactions and wall time for each.
+================================================
+
+Usage: python benchmarks/suite.py [options]
+
+-n --repeat=value     number of times each case is run, default 200
+-l --latency=value    seconds added to each simulated transaction
+-s --save=file        save the transaction counts as JSON
+-c --compare=file     compare the transaction counts with a saved file and
+                      exit with status 1 if any case uses more transactions
+
+The transactions of the first run of each case are counted and the
+following runs are timed.  Transaction counts do not depend on the speed
+of the machine so a saved file can be checked in CI to catch regressions.
+"""
+
+import sys
+import os
+import getopt
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import iopi  # noqa: E402
+from iopi_sim import SimulatedBus  # noqa: E402
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+# method cases, name and a function taking an MCP23017
+METHODS = [
+    ('set_direction port', lambda d: d.set_direction(0, 0x0F)),
+    ('set_direction pin', lambda d: d.set_direction(3, 1, True)),
+    ('set_pullup pin', lambda d: d.set_pullup(3, 1, True)),
+    ('write port', lambda d: d.write(0, 0x55)),
+    ('write pin', lambda d: d.write(3, 1, True)),
+    ('read port', lambda d: d.read(0)),
+    ('read pin', lambda d: d.read(3, True)),
+    ('invert pin', lambda d: d.invert(3, 1, True)),
+    ('mirror_interrupts', lambda d: d.mirror_interrupts(1)),
+    ('set_interrupt_polarity', lambda d: d.set_interrupt_polarity(1)),
+    ('set_interrupt_type pin', lambda d: d.set_interrupt_type(3, 0, True)),
+    ('set_interrupt_defaults pin',
+     lambda d: d.set_interrupt_defaults(3, 1, True)),
+    ('set_interrupt pin', lambda d: d.set_interrupt(3, 1, True)),
+    ('read_int_status port', lambda d: d.read_int_status(0)),
+    ('read_int_capture port', lambda d: d.read_int_capture(0)),
+    ('read_int_changes', lambda d: d.read_int_changes()),
+    ('reset_interrupts', lambda d: d.reset_interrupts()),
+    ('read_word', lambda d: d.read_word()),
+    ('write_word', lambda d: d.write_word(0x1234)),
+    ('write_pins 5 pins', lambda d: d.write_pins(
+        {1: 1, 3: 0, 5: 1, 9: 1, 12: 0})),
+    ('read_pins 5 pins', lambda d: d.read_pins([1, 3, 5, 9, 12])),
+    ('read_registers', lambda d: d.read_registers()),
+]
+
+# command line cases, each run as a new process would with new devices
+COMMANDS = [
+    '-a 0x20 -p 0 -r',
+    '-a 0x20 -n 3 -r',
+    '-a 0x20 -n 3 -w 1',
+    '-a 0x20 -p 2 -r',
+    '-a 0x20 -n 3 -d 1 -u 1 -r',
+    '-a 0x20 -n 1,3,9 -w 1,0,1',
+    '-a 0x20 -n 3 -d 1 -u 1 -i 1 -e 1 -t 0 -f 1 -r',
+    '-a 0x20 -p 0 -m 1 -l 1',
+    '-a 0x20-0x27 -p 2 -r',
+]
+
+
+class NullWriter(object):
+    """
+    Discard printed output
+    """
+
+    def write(self, text):
+        return
+
+    def flush(self):
+        return
+
+
+def time_case(bus, repeat, run):
+    """
+    Run a case once to count its transactions then repeat times to time it.
+    Later runs of a cached write may not need a transaction so only the
+    first run is counted.
+    returns the transactions of the first run and the seconds per run
+    """
+    bus.reset_counters()
+    run()
+    transactions = bus.transactions
+    start = monotonic()
+    for _ in range(repeat):
+        run()
+    elapsed = monotonic() - start
+    return transactions, elapsed / repeat
+
+
+def run_methods(bus, repeat, label=''):
+    """
+    Time each method with and without the register cache
+    """
+    results = []
+    for cache in (False, True):
+        device = iopi.MCP23017(0x20, cache, bus)
+        for name, method in METHODS:
+            if cache:
+                name += ' (cache)'
+            name += label
+            transactions, seconds = time_case(
+                bus, repeat, lambda: method(device))
+            results.append((name, transactions, seconds))
+    return results
+
+
+def run_commands(bus, repeat):
+    """
+    Time each command line with new devices for every run
+    """
+    results = []
+    stdout = sys.stdout
+    for command in COMMANDS:
+        argv = command.split()
+
+        def run():
+            iopi.run(argv, {})
+        sys.stdout = NullWriter()
+        try:
+            transactions, seconds = time_case(bus, repeat, run)
+        finally:
+            sys.stdout = stdout
+        results.append(('iopi.py ' + command, transactions, seconds))
+    return results
+
+
+def report(title, results):
+    """
+    Print a table of results
+    """
+    print(title)
+    for name, transactions, seconds in results:
+        print('  {0:<52} {1:3d} transactions {2:9.1f} us'.format(
+            name, transactions, seconds * 1000000))
+
+
+def compare(results, path):
+    """
+    Compare transaction counts with a saved file
+    returns True if no case uses more transactions than before
+    """
+    with open(path) as saved_file:
+        saved = json.load(saved_file)
+    passed = True
+    for name, transactions, seconds in results:
+        if name in saved and transactions > saved[name]:
+            print('regression: ' + name + ' ' + str(saved[name]) + ' -> ' +
+                  str(transactions) + ' transactions')
+            passed = False
+    return passed
+
+
+def main(argv):
+    """
+    Main function.
+    """
+    try:
+        opts, args = getopt.getopt(argv, "n:l:s:c:",
+                                   ["repeat=", "latency=", "save=",
+                                    "compare="])
+    except getopt.GetoptError:
+        print("option not recognised or no argument given.")
+        sys.exit(2)
+
+    repeat = 200
+    latency = 0.0
+    save = None
+    compare_file = None
+    for opt, arg in opts:
+        if opt in ('-n', '--repeat'):
+            repeat = int(arg)
+        elif opt in ('-l', '--latency'):
+            latency = float(arg)
+        elif opt in ('-s', '--save'):
+            save = arg
+        elif opt in ('-c', '--compare'):
+            compare_file = arg
+
+    # every device uses the shared simulated bus
+    iopi.MCP23017.backend = 'sim'
+    bus = iopi.MCP23017(0x20).get_bus()
+    bus.latency = latency
+
+    methods = run_methods(bus, repeat)
+    # combined register runs as with the i2c-dev backend
+    methods += run_methods(SimulatedBus(latency=latency, combined=True),
+                           repeat, ' i2c-dev')
+    commands = run_commands(bus, repeat)
+    report('methods', methods)
+    report('command lines', commands)
+
+    results = methods + commands
+    if save:
+        with open(save, 'w') as save_file:
+            json.dump(dict((name, transactions)
+                           for name, transactions, seconds in results),
+                      save_file, indent=1, sort_keys=True)
+    if compare_file and not compare(results, compare_file):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -14,13 +14,28 @@ the lowest numbered pin on the selected port.
 """
 
 import sys
+import os
 import getopt
-try:
-    import smbus
-except ImportError:
-    raise ImportError("python-smbus not found")
-import re
-import platform
+import struct
+import time
+# smbus and the modules only used by some modes are imported when needed
+# so start-up and argument checking stay fast
+
+# clock for scheduling, time.monotonic is not available on Python 2
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def wait_until(due, spin=0.002):
+    """
+    Wait until the monotonic clock reaches due.  Sleeps until spin seconds
+    before due and then polls the clock, which avoids the wake-up jitter
+    of sleeping to the exact time.
+    """
+    remaining = due - monotonic()
+    if remaining > spin:
+        time.sleep(remaining - spin)
+    while monotonic() < due:
+        pass
 
 
 class MCP23017(object):
@@ -81,33 +96,221 @@ class MCP23017(object):
     OLATA = 0x14  # output latches A
     OLATB = 0x15  # output latches B
 
+    # registers held in the shadow cache.  GPIO, INTF and INTCAP are
+    # volatile and reading GPIO or INTCAP clears the interrupt condition so
+    # they are always read from the device.
+    CACHED_REGISTERS = (IODIRA, IODIRB, IPOLA, IPOLB, GPINTENA, GPINTENB,
+                        DEFVALA, DEFVALB, INTCONA, INTCONB, IOCON,
+                        GPPUA, GPPUB, OLATA, OLATB)
+
     # variables
 
     __address = 0x20  # I2C address
     # initial configuration
     __ioconfig = 0x22
     __bus = None
-
-    def __init__(self, address):
+    __cache = None  # shadow copy of the registers, None when disabled
+    __int_fd = None  # file descriptor that becomes ready on an interrupt
+    __init_pending = False  # IOCON is set by the next update
+    # IOCON last written or read when the cache is off, None when not known
+    __iocon = None
+    __lock = None  # advisory lock shared with other processes
+    __shadow = None  # registers shared with other processes
+    __generation = None  # shadow generation the cache was loaded from
+    __buses = {}  # open smbus objects shared by all devices, by bus number
+    # I2C bus number to use instead of detecting it, the IOPI_BUS
+    # environment variable is used if this is None
+    bus_number = None
+    # bus backend, smbus, i2cdev for combined transfers on /dev/i2c-N
+    # with iopi_i2cdev, sim for the simulated bus in iopi_sim or auto to use
+    # smbus if it is installed and i2cdev if not.  The IOPI_BACKEND
+    # environment variable is used if this is None
+    backend = None
+    backends = ('auto', 'smbus', 'i2cdev', 'sim')
+    # True wraps each new bus in an InstrumentedBus that counts transactions
+    instrument = False
+    # True holds an advisory lock on the device while registers are read
+    # and then written so other processes can not change them in between.
+    # The IOPI_LOCK=1 environment variable does the same
+    locking = False
+    # True keeps the register cache in shared memory, see iopi_shared, so
+    # other processes see the changes without reading the device.  Implies
+    # locking.  The IOPI_SHARED_CACHE=1 environment variable does the same
+    shared_cache = False
+    # IOCON bits
+    BANK = 0x80
+    SEQOP = 0x20
+
+    def __init__(self, address, cache=False, bus=None, init=True):
         """
         init object with i2c address, default is 0x20, 0x21 for IOPi board,
         load default configuration
+        cache = True keeps a shadow copy of the configuration and output
+        latch registers so pin updates need a single write
+        bus = smbus object to use, by default one bus object is shared by
+        every device
+        init = False leaves the default configuration to be written by the
+        first call to update, together with the other register changes
         """
         self.__address = address
-        self.__bus = self.__get_smbus()
-        self.__bus.write_byte_data(
-            self.__address, self.IOCON, self.__ioconfig)
+        self.__bus = bus
+        if self.__bus is None:
+            self.__bus = self.__get_smbus()
+        self.__init_pending = not init
+        shared = self.shared_cache or \
+            os.environ.get('IOPI_SHARED_CACHE') == '1'
+        if shared or self.locking or os.environ.get('IOPI_LOCK') == '1':
+            import iopi_shared
+            name = getattr(self.__bus, 'name', None)
+            if not name:
+                name = 'i2c-' + str(self.get_bus_number())
+            self.__lock = iopi_shared.DeviceLock.get(name, address)
+            if shared:
+                self.__shadow = iopi_shared.SharedShadow.get(name)
+                # raises ValueError for an address without a shadow slot
+                self.__shadow.offset(address)
+        if self.__shadow is not None:
+            # filled from the shadow or read when first used
+            self.__cache = [None] * (self.OLATB + 1)
+        elif cache:
+            self.__cache = [None] * (self.OLATB + 1)
+            self.refresh()
+        if init:
+            # skipped when the cache shows IOCON is already set
+            self.__write_register(self.IOCON, self.__ioconfig)
         return
 
     # local methods
+
+    def __critical(method):
+        """
+        internal decorator for methods that read and then write registers
+        or use the cache.  When locking is on the method runs with the
+        device lock held and the cache is loaded from the shared shadow if
+        another process changed it, and stored back if the method changed
+        it.  A private cache can not see changes made by other processes,
+        so it is emptied when the lock is taken and the registers used are
+        read again inside the lock.
+        """
+        def locked(self, *args, **kwargs):
+            if self.__lock is None:
+                return method(self, *args, **kwargs)
+            with self.__lock as outermost:
+                if not outermost:
+                    return method(self, *args, **kwargs)
+                if self.__shadow is None:
+                    if self.__cache is not None:
+                        self.__cache = [None] * (self.OLATB + 1)
+                    self.__iocon = None
+                    return method(self, *args, **kwargs)
+                generation = self.__shadow.generation(self.__address)
+                if generation != self.__generation:
+                    self.__cache = self.__shadow.load(self.__address)
+                before = list(self.__cache)
+                try:
+                    result = method(self, *args, **kwargs)
+                except Exception:
+                    # the registers are not known after a failed transfer
+                    self.__cache = [None] * (self.OLATB + 1)
+                    self.__generation = self.__shadow.store(self.__address,
+                                                            self.__cache)
+                    raise
+                if self.__cache != before:
+                    generation = self.__shadow.store(self.__address,
+                                                     self.__cache)
+                self.__generation = generation
+                return result
+        locked.__doc__ = method.__doc__
+        return locked
+
     @staticmethod
-    def __get_smbus():
+    def __get_smbus(i2c__bus=None):
         """
         internal method for getting an instance of the i2c bus
+        i2c__bus = bus number, by default from get_bus_number
+        """
+        backend = (MCP23017.backend or os.environ.get('IOPI_BACKEND') or
+                   'auto')
+        if backend == 'auto':
+            backend = 'smbus'
+            try:
+                import smbus
+            except ImportError:
+                backend = 'i2cdev'
+        if i2c__bus is None:
+            i2c__bus = MCP23017.get_bus_number()
+        key = (backend, i2c__bus)
+        if key in MCP23017.__buses:
+            return MCP23017.__buses[key]
+
+        if backend == 'sim':
+            from iopi_sim import SimulatedBus
+            latency = float(os.environ.get('IOPI_SIM_LATENCY') or 0)
+            MCP23017.__buses[key] = SimulatedBus(i2c__bus, latency=latency)
+        elif backend == 'i2cdev':
+            from iopi_i2cdev import I2CDevBus
+            try:
+                MCP23017.__buses[key] = I2CDevBus(i2c__bus)
+            except (IOError, OSError):
+                raise IOError('Could not open the i2c bus')
+        elif backend == 'smbus':
+            try:
+                import smbus
+            except ImportError:
+                raise ImportError("python-smbus not found")
+            try:
+                MCP23017.__buses[key] = smbus.SMBus(i2c__bus)
+            except IOError:
+                raise IOError('Could not open the i2c bus')
+        else:
+            raise ValueError('Unknown I2C backend: ' + backend)
+        if MCP23017.instrument:
+            MCP23017.__buses[key] = InstrumentedBus(MCP23017.__buses[key])
+        return MCP23017.__buses[key]
+
+    @staticmethod
+    def get_shared_bus(number=None):
+        """
+        Get the bus object shared by every device on an I2C bus, opening
+        it on first use
+        number = I2C bus number, by default from get_bus_number
         """
+        return MCP23017.__get_smbus(number)
+
+    @staticmethod
+    def get_shared_buses():
+        """
+        Get the bus objects shared by the devices, keyed by backend and bus
+        number
+        """
+        return dict(MCP23017.__buses)
+
+    @staticmethod
+    def get_statistics():
+        """
+        Get the transaction statistics of every shared bus that is
+        instrumented, keyed by bus number
+        """
+        statistics = {}
+        for (backend, number), bus in MCP23017.__buses.items():
+            if isinstance(bus, InstrumentedBus):
+                statistics[number] = bus.snapshot()
+        return statistics
+
+    @staticmethod
+    def get_bus_number():
+        """
+        Get the I2C bus number from bus_number, the IOPI_BUS environment
+        variable or by detecting the device that is being used
+        """
+        if MCP23017.bus_number is not None:
+            return MCP23017.bus_number
+        if os.environ.get('IOPI_BUS'):
+            return int(os.environ['IOPI_BUS'])
+
         i2c__bus = 1
         # detect the device that is being used
-        device = platform.uname()[1]
+        device = os.uname()[1]
 
         if device == "orangepione":  # running on orange pi one
             i2c__bus = 0
@@ -120,20 +323,16 @@ class MCP23017(object):
 
         elif device == "raspberrypi":  # running on raspberry pi
             # detect i2C port number and assign to i2c__bus
-            for line in open('/proc/cpuinfo').readlines():
-                model = re.match('(.*?)\\s*\\s*(.*)', line)
-                if model:
-                    (name, value) = (model.group(1), model.group(2))
-                    if name == "Revision":
+            with open('/proc/cpuinfo') as cpuinfo:
+                for line in cpuinfo:
+                    if line.startswith('Revision'):
+                        value = line.partition(':')[2].strip()
                         if value[-4:] in ('0002', '0003'):
                             i2c__bus = 0
                         else:
                             i2c__bus = 1
                         break
-        try:
-            return smbus.SMBus(i2c__bus)
-        except IOError:
-            raise 'Could not open the i2c bus'
+        return i2c__bus
 
     @staticmethod
     def __checkbit(byte, bit):
@@ -154,29 +353,219 @@ class MCP23017(object):
         elif value == 1:
             return byte | (1 << bit)
 
+    def __read_register(self, reg):
+        """
+        internal method for reading a register, using the shadow cache
+        when it holds a value for the register
+        """
+        if self.__cache is not None and reg in self.CACHED_REGISTERS:
+            if self.__cache[reg] is None:
+                self.__cache[reg] = self.__bus.read_byte_data(
+                    self.__address, reg)
+            return self.__cache[reg]
+        value = self.__bus.read_byte_data(self.__address, reg)
+        if reg in (self.IOCON, self.IOCON + 1):
+            self.__iocon = value
+        return value
+
+    @__critical
+    def __write_register(self, reg, value):
+        """
+        internal method for writing a register, writes that would not
+        change the cached value are skipped
+        """
+        if self.__cache is not None:
+            # a write to GPIO sets the output latch
+            if reg in (self.GPIOA, self.GPIOB):
+                latch = reg + 2
+                if self.__cache[latch] == value:
+                    return
+                self.__bus.write_byte_data(self.__address, reg, value)
+                self.__cache[latch] = value
+                return
+            if reg in self.CACHED_REGISTERS:
+                if self.__cache[reg] == value:
+                    return
+                self.__bus.write_byte_data(self.__address, reg, value)
+                self.__cache[reg] = value
+                return
+        self.__bus.write_byte_data(self.__address, reg, value)
+        if reg in (self.IOCON, self.IOCON + 1):
+            self.__iocon = value
+
+    def __read_runs(self, runs):
+        """
+        internal method for reading runs of registers, list of
+        (first register, number of bytes).  Buses with combined transfers
+        read every run in one call, others use one transfer per run.
+        returns a list of byte lists, one for each run
+        """
+        if hasattr(self.__bus, 'read_runs'):
+            results = self.__bus.read_runs(self.__address, runs)
+        else:
+            results = []
+            for reg, length in runs:
+                if length == 1:
+                    results.append([self.__bus.read_byte_data(
+                        self.__address, reg)])
+                elif length == 2:
+                    word = self.__bus.read_word_data(self.__address, reg)
+                    results.append([word & 0xFF, (word >> 8) & 0xFF])
+                else:
+                    results.append(list(self.__bus.read_i2c_block_data(
+                        self.__address, reg, length)))
+        self.__note_iocon(zip([reg for reg, length in runs], results))
+        return results
+
+    def __note_iocon(self, runs):
+        """
+        internal method for keeping the IOCON value from runs of register
+        values, list of (first register, list of bytes), so updates without
+        the cache know it without a read
+        """
+        for reg, values in runs:
+            for offset, value in enumerate(values):
+                if reg + offset in (self.IOCON, self.IOCON + 1):
+                    self.__iocon = value
+
+    def __write_runs(self, runs):
+        """
+        internal method for writing runs of registers, list of
+        (first register, list of bytes), with one call on buses with
+        combined transfers
+        """
+        if hasattr(self.__bus, 'write_runs'):
+            self.__bus.write_runs(self.__address, runs)
+            self.__note_iocon(runs)
+            return
+        self.__note_iocon(runs)
+        for reg, values in runs:
+            if len(values) == 1:
+                self.__bus.write_byte_data(self.__address, reg, values[0])
+            elif len(values) == 2:
+                self.__bus.write_word_data(self.__address, reg,
+                                           values[0] | (values[1] << 8))
+            else:
+                self.__bus.write_i2c_block_data(self.__address, reg,
+                                                list(values))
+
     def __set_pin(self, pin, value, low_reg, high_reg):
-        pin = pin - 1
-        reg = low_reg
-        if pin >= 8:
-            reg = high_reg
+        self.__set_pins({pin: value}, low_reg, high_reg)
+
+    @__critical
+    def __set_pins(self, pins, low_reg, high_reg):
+        """
+        internal method for setting several pins with at most one
+        read-modify-write per port
+        pins = dictionary of pin number 1 to 16 and value 0 or 1
+        """
+        ports = {}
+        for pin, value in pins.items():
+            pin = pin - 1
+            reg = low_reg
+            if pin >= 8:
+                reg = high_reg
+            mask, bits = ports.get(reg, (0, 0))
+            mask |= 1 << (pin % 8)
+            bits = self.__updatebyte(bits, pin % 8, value)
+            ports[reg] = (mask, bits)
+
+        for reg in sorted(ports):
+            mask, bits = ports[reg]
+            if mask == 0xFF:
+                # every pin on the port is set so no read is needed
+                regval = bits
+            elif reg in (self.GPIOA, self.GPIOB):
+                # modify the output latch rather than the pin state, so
+                # input levels are not copied to the outputs and reading
+                # GPIO does not clear an interrupt
+                regval = (self.__read_register(reg + 2) & ~mask) | bits
+            else:
+                regval = (self.__read_register(reg) & ~mask) | bits
+            self.__write_register(reg, regval)
 
-        regval = self.__bus.read_byte_data(self.__address, reg)
-        regval = self.__updatebyte(regval, int(pin), value)
-        self.__bus.write_byte_data(self.__address, reg, regval)
+    def __get_pins(self, pins, low_reg, high_reg):
+        """
+        internal method for reading several pins with one read per port
+        returns a dictionary of pin number and value
+        """
+        regvals = {}
+        values = {}
+        for pin in pins:
+            reg = low_reg
+            if pin > 8:
+                reg = high_reg
+            if reg not in regvals:
+                regvals[reg] = self.__read_register(reg)
+            values[pin] = self.__checkbit(regvals[reg], (pin - 1) % 8)
+        return values
 
     def __set_port(self, port, value, low_reg, high_reg):
+        if port == 2:
+            self.__write_word(low_reg, value)
+            return
+
         reg = low_reg
         if port == 1:
             reg = high_reg
 
-        self.__bus.write_byte_data(self.__address, reg, value)
+        self.__write_register(reg, value)
+
+    def __read_word(self, low_reg):
+        """
+        internal method for reading an A/B register pair in one transaction.
+        With IOCON.BANK = 0 and IOCON.SEQOP = 1 the address pointer toggles
+        between the A and B registers so a word read returns both ports
+        sampled together, port A in the low byte
+        """
+        if self.__cache is not None and low_reg in self.CACHED_REGISTERS:
+            if (self.__cache[low_reg] is not None and
+                    self.__cache[low_reg + 1] is not None):
+                return self.__cache[low_reg] | (self.__cache[low_reg + 1] << 8)
+        value = self.__bus.read_word_data(self.__address, low_reg)
+        if self.__cache is not None and low_reg in self.CACHED_REGISTERS:
+            self.__cache[low_reg] = value & 0xFF
+            self.__cache[low_reg + 1] = (value >> 8) & 0xFF
+        self.__note_iocon([(low_reg, [value & 0xFF, (value >> 8) & 0xFF])])
+        return value
+
+    @__critical
+    def __write_word(self, low_reg, value):
+        """
+        internal method for writing an A/B register pair in one transaction,
+        port A in the low byte
+        """
+        low = value & 0xFF
+        high = (value >> 8) & 0xFF
+        if self.__cache is not None:
+            latch = low_reg
+            if low_reg == self.GPIOA:
+                latch = self.OLATA
+            if latch in self.CACHED_REGISTERS:
+                low_changed = self.__cache[latch] != low
+                high_changed = self.__cache[latch + 1] != high
+                if low_changed and not high_changed:
+                    self.__write_register(low_reg, low)
+                    return
+                if high_changed and not low_changed:
+                    self.__write_register(low_reg + 1, high)
+                    return
+                if not low_changed and not high_changed:
+                    return
+                self.__bus.write_word_data(self.__address, low_reg, value)
+                self.__cache[latch] = low
+                self.__cache[latch + 1] = high
+                return
+        self.__bus.write_word_data(self.__address, low_reg, value)
+        self.__note_iocon([(low_reg, [low, high])])
 
     # public methods
 
     def set_direction(self, target, value, is_pin=False):
         """
         set IO value for a pin or port
-        pins 1 to 16, port 0 = pins 1 to 8, port 1 = pins 9 to 16
+        pins 1 to 16, port 0 = pins 1 to 8, port 1 = pins 9 to 16,
+        port 2 = pins 1 to 16
         """
         if is_pin:
             self.__set_pin(target, value, self.IODIRA, self.IODIRB)
@@ -187,7 +576,8 @@ class MCP23017(object):
     def set_pullup(self, target, value, is_pin=False):
         """
         set the internal 100K pull-up resistors for an individual pin
-        pins 1 to 16, port 0 = pins 1 to 8, port 1 = pins 9 to 16
+        pins 1 to 16, port 0 = pins 1 to 8, port 1 = pins 9 to 16,
+        port 2 = pins 1 to 16
         value 1 = enabled, 0 = disabled
         """
 
@@ -200,7 +590,8 @@ class MCP23017(object):
     def write(self, target, value, is_pin=False):
         """
         write to an individual pin or port
-        pins 1 to 16, port 0 = pins 1 to 8, port 1 = pins 9 to 16
+        pins 1 to 16, port 0 = pins 1 to 8, port 1 = pins 9 to 16,
+        port 2 = pins 1 to 16
         """
         if is_pin:
             self.__set_pin(target, value, self.GPIOA, self.GPIOB)
@@ -224,6 +615,8 @@ class MCP23017(object):
                 target = target - 8
                 value = self.__checkbit(self.__bus.read_byte_data(
                     self.__address, self.GPIOB), target)
+        elif target == 2:
+            value = self.__read_word(self.GPIOA)
         else:
             if target == 1:
                 value = self.__bus.read_byte_data(self.__address, self.GPIOB)
@@ -235,7 +628,8 @@ class MCP23017(object):
     def invert(self, target, value, is_pin=False):
         """
         invert the polarity of the pins on a selected port
-        port 0 = pins 1 to 8, port 1 = pins 9 to 16
+        port 0 = pins 1 to 8, port 1 = pins 9 to 16,
+        port 2 = pins 1 to 16
         polarity 0 = same logic state of the input pin, 1 = inverted logic
         state of the input pin
         """
@@ -245,27 +639,29 @@ class MCP23017(object):
             self.__set_port(target, value, self.IPOLA, self.IPOLB)
         return
 
+    @__critical
     def mirror_interrupts(self, value):
         """
         1 = The INT pins are internally connected, 0 = The INT pins are not
         connected. __inta is associated with PortA and __intb is associated
         with PortB
         """
-        __ioconfig = self.__bus.read_byte_data(self.__address, self.IOCON)
+        __ioconfig = self.__read_register(self.IOCON)
         __ioconfig = self.__updatebyte(__ioconfig, 6, value)
-        self.__bus.write_byte_data(self.__address, self.IOCON, __ioconfig)
+        self.__write_register(self.IOCON, __ioconfig)
 
         return
 
+    @__critical
     def set_interrupt_polarity(self, value):
         """
         This sets the polarity of the INT output pins
         1 = Active-high.
         0 = Active-low.
         """
-        __ioconfig = self.__bus.read_byte_data(self.__address, self.IOCON)
+        __ioconfig = self.__read_register(self.IOCON)
         __ioconfig = self.__updatebyte(__ioconfig, 1, value)
-        self.__bus.write_byte_data(self.__address, self.IOCON, __ioconfig)
+        self.__write_register(self.IOCON, __ioconfig)
 
         return
 
@@ -297,7 +693,8 @@ class MCP23017(object):
     def set_interrupt(self, target, value, is_pin=False):
         """
         Enable interrupts for the pins on the selected port
-        port 0 = pins 1 to 8, port 1 = pins 9 to 16
+        port 0 = pins 1 to 8, port 1 = pins 9 to 16,
+        port 2 = pins 1 to 16
         value = number between 0 and 255 or 0x00 and 0xFF
         """
         if is_pin:
@@ -309,7 +706,8 @@ class MCP23017(object):
     def read_int_status(self, target, is_pin=False):
         """
         read the interrupt status for the pins on the selected port
-        port 0 = pins 1 to 8, port 1 = pins 9 to 16
+        port 0 = pins 1 to 8, port 1 = pins 9 to 16,
+        port 2 = pins 1 to 16
         """
         value = 0
 
@@ -322,6 +720,8 @@ class MCP23017(object):
                 target = target - 8
                 value = self.__checkbit(self.__bus.read_byte_data(
                     self.__address, self.INTFB), target)
+        elif target == 2:
+            value = self.__read_word(self.INTFA)
         else:
             if target == 1:
                 value = self.__bus.read_byte_data(self.__address, self.INTFB)
@@ -334,7 +734,8 @@ class MCP23017(object):
         """
         read the value from the selected port at the time of the last
         interrupt trigger
-        port 0 = pins 1 to 8, port 1 = pins 9 to 16
+        port 0 = pins 1 to 8, port 1 = pins 9 to 16,
+        port 2 = pins 1 to 16
         """
         value = 0
 
@@ -347,6 +748,8 @@ class MCP23017(object):
                 target = target - 8
                 value = self.__checkbit(self.__bus.read_byte_data(
                     self.__address, self.INTCAPB), target)
+        elif target == 2:
+            value = self.__read_word(self.INTCAPA)
         else:
             if target == 1:
                 value = self.__bus.read_byte_data(self.__address, self.INTCAPB)
@@ -355,6 +758,135 @@ class MCP23017(object):
 
         return value
 
+    def set_interrupt_line(self, fd):
+        """
+        Set a file descriptor that becomes readable when the INT pin is
+        triggered, such as a GPIO character device line event or a pipe.
+        None = wait_for_change polls the interrupt flag registers instead
+        """
+        self.__int_fd = fd
+        return
+
+    def read_int_events(self, sequential=False):
+        """
+        Read the interrupt flags and captured values of both ports in one
+        transaction when the bus supports combined transfers or the address
+        pointer is sequential, otherwise the captures are only read when a
+        flag is set.  Reading the capture registers clears the interrupt.
+        sequential = True when IOCON.SEQOP has been cleared so INTFA to
+        INTCAPB can be read as one block, the cached IOCON is used instead
+        when the cache holds it
+        returns the 16 bit flags and captured values, port A in the low byte
+        """
+        if self.__cache is not None and self.__cache[self.IOCON] is not None:
+            sequential = not self.__cache[self.IOCON] & (self.SEQOP |
+                                                         self.BANK)
+        if hasattr(self.__bus, 'read_runs'):
+            # flags and captures in one combined transfer
+            intf, intcap = self.__read_runs([(self.INTFA, 2),
+                                             (self.INTCAPA, 2)])
+        elif sequential:
+            data = self.__bus.read_i2c_block_data(self.__address,
+                                                  self.INTFA, 4)
+            intf, intcap = data[:2], data[2:]
+        else:
+            flags = self.__read_word(self.INTFA)
+            if not flags:
+                return 0, 0
+            return flags, self.__read_word(self.INTCAPA)
+        return intf[0] | (intf[1] << 8), intcap[0] | (intcap[1] << 8)
+
+    def read_int_changes(self):
+        """
+        Read the interrupt flags and captured values of both ports.
+        Reading the capture registers clears the interrupt.
+        returns a dictionary of the pins that caused the interrupt and their
+        value at the time of the interrupt
+        """
+        flags, capture = self.read_int_events()
+        changes = {}
+        for bit in range(16):
+            if flags & (1 << bit):
+                changes[bit + 1] = self.__checkbit(capture, bit)
+        return changes
+
+    def __wait_int_fd(self, timeout):
+        """
+        internal method for waiting on the interrupt file descriptor
+        returns True if the descriptor became ready
+        """
+        import select
+        poller = select.poll()
+        poller.register(self.__int_fd,
+                        select.POLLIN | select.POLLPRI | select.POLLERR)
+        if timeout is None:
+            events = poller.poll()
+        else:
+            events = poller.poll(int(timeout * 1000))
+        if not events:
+            return False
+        # drain the pending events, sysfs value files need a seek first
+        seekable = True
+        try:
+            os.lseek(self.__int_fd, 0, os.SEEK_SET)
+        except OSError:
+            seekable = False
+        try:
+            data = os.read(self.__int_fd, 256)
+        except OSError:
+            data = None
+        if data == b'' and not seekable:
+            raise IOError("interrupt line closed")
+        return True
+
+    def wait_for_interrupt(self, timeout=None, poll_interval=0.01,
+                           sequential=False):
+        """
+        Wait until an interrupt is triggered by an enabled pin.
+        Blocks on the interrupt file descriptor when one has been set with
+        set_interrupt_line, otherwise polls the interrupt flag registers
+        every poll_interval seconds.
+        timeout = seconds to wait, None = wait forever
+        sequential = passed to read_int_events
+        returns the 16 bit flags and captured values from read_int_events,
+        both 0 if the timeout expired
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0.0, deadline - monotonic())
+            if self.__int_fd is not None:
+                if not self.__wait_int_fd(remaining):
+                    return 0, 0
+            flags, capture = self.read_int_events(sequential)
+            if flags:
+                return flags, capture
+            if remaining is not None and remaining <= 0:
+                return 0, 0
+            if self.__int_fd is None:
+                if remaining is None:
+                    time.sleep(poll_interval)
+                else:
+                    time.sleep(min(poll_interval, remaining))
+
+    def wait_for_change(self, timeout=None, poll_interval=0.01):
+        """
+        Wait until an interrupt is triggered by an enabled pin, see
+        wait_for_interrupt.
+        timeout = seconds to wait, None = wait forever
+        returns a dictionary of the pins that caused the interrupt and their
+        captured value, empty if the timeout expired
+        """
+        flags, capture = self.wait_for_interrupt(timeout, poll_interval)
+        changes = {}
+        for bit in range(16):
+            if flags & (1 << bit):
+                changes[bit + 1] = self.__checkbit(capture, bit)
+        return changes
+
     def reset_interrupts(self):
         """
         Reset the interrupts A and B to 0
@@ -363,6 +895,616 @@ class MCP23017(object):
         self.read_int_capture(1, False)
         return
 
+    def set_direction_word(self, value):
+        """
+        set the direction of all 16 pins with one write
+        value = 0 to 65535, port A in the low byte, 1 = input, 0 = output
+        """
+        self.__write_word(self.IODIRA, value)
+        return
+
+    def set_pullup_word(self, value):
+        """
+        set the pull-up resistors of all 16 pins with one write
+        value = 0 to 65535, port A in the low byte, 1 = enabled, 0 = disabled
+        """
+        self.__write_word(self.GPPUA, value)
+        return
+
+    def write_word(self, value):
+        """
+        write to all 16 pins with one write
+        value = 0 to 65535, port A in the low byte
+        """
+        self.__write_word(self.GPIOA, value)
+        return
+
+    def read_word(self):
+        """
+        read all 16 pins with one read so both ports are sampled together
+        returns 0 to 65535, port A in the low byte
+        """
+        return self.__read_word(self.GPIOA)
+
+    def set_direction_pins(self, pins):
+        """
+        set the direction of several pins with one write per port
+        pins = dictionary of pin number 1 to 16 and value,
+        1 = input, 0 = output
+        """
+        self.__set_pins(pins, self.IODIRA, self.IODIRB)
+        return
+
+    def set_pullup_pins(self, pins):
+        """
+        set the internal 100K pull-up resistors for several pins with one
+        write per port
+        pins = dictionary of pin number 1 to 16 and value,
+        1 = enabled, 0 = disabled
+        """
+        self.__set_pins(pins, self.GPPUA, self.GPPUB)
+        return
+
+    def write_pins(self, pins):
+        """
+        write to several pins with one write per port
+        e.g. write_pins({1: 1, 3: 0, 9: 1})
+        """
+        self.__set_pins(pins, self.GPIOA, self.GPIOB)
+        return
+
+    def invert_pins(self, pins):
+        """
+        invert the polarity of several pins with one write per port
+        pins = dictionary of pin number 1 to 16 and value,
+        0 = same logic state, 1 = inverted logic state
+        """
+        self.__set_pins(pins, self.IPOLA, self.IPOLB)
+        return
+
+    def set_interrupt_pins(self, pins):
+        """
+        enable or disable interrupts for several pins with one write per port
+        pins = dictionary of pin number 1 to 16 and value, 1 = on, 0 = off
+        """
+        self.__set_pins(pins, self.GPINTENA, self.GPINTENB)
+        return
+
+    def set_interrupt_type_pins(self, pins):
+        """
+        set the interrupt type for several pins with one write per port
+        pins = dictionary of pin number 1 to 16 and value,
+        1 = compare against default value, 0 = fire on state change
+        """
+        self.__set_pins(pins, self.INTCONA, self.INTCONB)
+        return
+
+    def set_interrupt_defaults_pins(self, pins):
+        """
+        set the interrupt compare value for several pins with one write
+        per port
+        """
+        self.__set_pins(pins, self.DEFVALA, self.DEFVALB)
+        return
+
+    def read_pins(self, pins):
+        """
+        read several pins with one read per port
+        returns a dictionary of pin number and value
+        """
+        return self.__get_pins(pins, self.GPIOA, self.GPIOB)
+
+    def read_int_status_pins(self, pins):
+        """
+        read the interrupt status of several pins with one read per port
+        returns a dictionary of pin number and value
+        """
+        return self.__get_pins(pins, self.INTFA, self.INTFB)
+
+    def read_int_capture_pins(self, pins):
+        """
+        read the interrupt capture value of several pins with one read per
+        port
+        returns a dictionary of pin number and value
+        """
+        return self.__get_pins(pins, self.INTCAPA, self.INTCAPB)
+
+    @staticmethod
+    def register_name(reg):
+        """
+        Get the datasheet name of a register
+        """
+        for name in dir(MCP23017):
+            if name.isupper() and isinstance(reg, int) and \
+                    getattr(MCP23017, name) == reg:
+                return name
+        return str(reg)
+
+    def get_bus(self):
+        """
+        Get the smbus object used to talk to the device
+        """
+        return self.__bus
+
+    @__critical
+    def refresh(self):
+        """
+        Reload the shadow cache from the device.  Call after anything
+        outside of this object, such as a power-on reset, may have changed
+        the registers.
+        With IOCON.BANK = 0 and IOCON.SEQOP = 1 the address pointer toggles
+        between the A and B registers so each pair is read as one run
+        """
+        if self.__cache is None:
+            return
+        self.__cache = [None] * (self.OLATB + 1)
+        for reg, value in self.read_config().items():
+            self.__cache[reg] = value
+        return
+
+    def read_config(self):
+        """
+        Read the configuration and output latch registers, the registers
+        that can be written, with one call when the bus supports combined
+        transfers.  GPIO, INTF and INTCAP are not read so pending
+        interrupts are kept.
+        returns a dictionary of register values keyed by register
+        """
+        runs = [(reg, 2) for reg in self.CACHED_REGISTERS
+                if reg % 2 == 0 and reg != self.IOCON]
+        runs.append((self.IOCON, 1))
+        registers = {}
+        for (reg, length), values in zip(runs, self.__read_runs(runs)):
+            for offset, value in enumerate(values):
+                registers[reg + offset] = value
+        return registers
+
+    @__critical
+    def plan_config(self, registers, current=None):
+        """
+        Work out the writes needed to set configuration and output latch
+        registers.  Only registers that differ from the device are written,
+        grouped into A/B pair runs and ordered so the change is glitch free:
+        output latches before pull-ups, polarity and direction so outputs
+        start at the right level, interrupt compare values and type before
+        interrupts are enabled, and IOCON last.
+        registers = dictionary of register values keyed by register
+        current = dictionary of the current register values, if None the
+        register cache is used if it is on or the device is read once
+        returns a list of (first register, list of bytes) runs
+        """
+        for reg in registers:
+            if reg not in self.CACHED_REGISTERS:
+                raise ValueError('Register can not be written: ' + str(reg))
+        if current is None:
+            if self.__cache is not None and None not in [
+                    self.__cache[reg] for reg in registers]:
+                current = dict((reg, self.__cache[reg]) for reg in registers)
+            else:
+                current = self.read_config()
+        changed = [reg for reg in registers
+                   if registers[reg] != current[reg]]
+        return [(reg, [registers[reg + offset] for offset in range(length)])
+                for reg, length in self.__config_runs(changed)]
+
+    def __pair_runs(self, regs):
+        """
+        internal method for grouping registers into runs of single
+        registers or A/B pairs
+        returns a list of (first register, number of bytes)
+        """
+        runs = []
+        for reg in sorted(regs):
+            if runs and runs[-1][0] == reg - 1 and reg % 2 == 1 and \
+                    reg != self.IOCON + 1:
+                runs[-1] = (runs[-1][0], 2)
+            else:
+                runs.append((reg, 1))
+        return runs
+
+    def __config_runs(self, regs):
+        """
+        internal method for grouping configuration and output latch
+        registers into A/B pair runs in the order they are written, output
+        latches, pull-ups, polarity and direction then interrupt compare
+        values, type and enable and IOCON last
+        returns a list of (first register, number of bytes)
+        """
+        order = (self.OLATA, self.GPPUA, self.IPOLA, self.IODIRA,
+                 self.DEFVALA, self.INTCONA, self.GPINTENA, self.IOCON)
+        return sorted(self.__pair_runs(regs), key=lambda run: order.index(
+            run[0] & ~1 if run[0] != self.IOCON else run[0]))
+
+    @__critical
+    def plan_update(self, changes, reads=None):
+        """
+        Plan the transactions for changing bits in several configuration
+        and output latch registers and then reading registers such as GPIO
+        or INTCAP.  Registers that need a read-modify-write are read once,
+        changes to one register are written together, A/B pairs are moved
+        as one run and writes that would not change a cached value are left
+        out.  On buses without combined transfers, when that needs fewer
+        transactions, IOCON.SEQOP is cleared so the registers from IODIRA
+        to GPPUB can be read and written as blocks, and the last byte of
+        the block write sets it again.
+        changes = dictionary keyed by register of (mask, bits), the bits of
+        the register in mask are set to bits
+        reads = list of (first register, number of bytes) runs read after
+        the changes
+        returns a list of transactions, ('read', runs) and ('output', runs)
+        with (first register, number of bytes) runs or ('write', runs) with
+        (first register, list of bytes) runs, where a byte of None is
+        worked out from the changes when the plan is run
+        """
+        for reg in changes:
+            if reg not in self.CACHED_REGISTERS:
+                raise ValueError('Register can not be written: ' + str(reg))
+        known, base = self.__update_values()
+        changes = dict(changes)
+        if self.__init_pending and self.IOCON not in changes:
+            changes[self.IOCON] = (0, 0)
+
+        def target(reg):
+            mask, bits = changes.get(reg, (0, 0))
+            return (base[reg] & ~mask) | bits
+
+        def determined(reg):
+            return reg in base or (reg in changes and changes[reg][0] == 0xFF)
+
+        unknown = [reg for reg in changes if not determined(reg)]
+        writes = [reg for reg in changes
+                  if reg not in known or target(reg) != known[reg]]
+        combined = hasattr(self.__bus, 'write_runs')
+
+        def transactions(kind, runs):
+            if combined:
+                return [(kind, runs)] if runs else []
+            return [(kind, [run]) for run in runs]
+
+        def unset(runs):
+            return [(reg, [None] * length) for reg, length in runs]
+
+        plan = transactions('read', self.__pair_runs(unknown))
+        plan += transactions('write', unset(self.__config_runs(writes)))
+
+        # sequential block transfers of the configuration registers
+        block = [reg for reg in writes if reg < self.IOCON]
+        if not combined and block and self.IOCON in base and \
+                not target(self.IOCON) & self.BANK:
+            first = min(block)
+            block_read = [reg for reg in range(first, self.IOCON)
+                          if not determined(reg)]
+            block_read += [reg for reg in unknown if reg in
+                           (self.GPPUA, self.GPPUB)]
+            sequential = [('write', [(self.IOCON, [target(self.IOCON) &
+                                                   ~self.SEQOP])])]
+            if block_read:
+                sequential.append(('read', [
+                    (min(block_read),
+                     max(block_read) - min(block_read) + 1)]))
+            latches = [reg for reg in writes if reg > self.IOCON]
+            sequential += transactions('read', self.__pair_runs(
+                [reg for reg in unknown if reg in (self.OLATA, self.OLATB)]))
+            sequential += transactions('write',
+                                       unset(self.__config_runs(latches)))
+            sequential.append(('write', [
+                (first, [None] * (self.IOCON - first) +
+                 [target(self.IOCON)])]))
+            if len(sequential) < len(plan):
+                plan = sequential
+
+        return plan + transactions('output', list(reads or []))
+
+    def __update_values(self):
+        """
+        internal method for getting the register values known without a
+        read, from the cache, and the values changes are made to, which
+        include the default configuration when it is still to be written
+        returns the two dictionaries keyed by register
+        """
+        known = {}
+        if self.__cache is not None:
+            for reg in self.CACHED_REGISTERS:
+                if self.__cache[reg] is not None:
+                    known[reg] = self.__cache[reg]
+        elif self.__iocon is not None:
+            known[self.IOCON] = self.__iocon
+        base = dict(known)
+        if self.__init_pending:
+            base[self.IOCON] = self.__ioconfig
+        return known, base
+
+    @__critical
+    def update(self, changes, reads=None):
+        """
+        Change bits in several configuration and output latch registers
+        and then read registers, with the transactions from plan_update
+        changes = dictionary keyed by register of (mask, bits), the bits of
+        the register in mask are set to bits
+        reads = list of (first register, number of bytes) runs read after
+        the changes
+        returns a list of byte lists, one for each of the reads
+        """
+        plan = self.plan_update(changes, reads)
+        device, values = self.__update_values()
+        results = []
+        for kind, runs in plan:
+            if kind == 'write':
+                writes = []
+                for reg, data in runs:
+                    data = list(data)
+                    for offset, value in enumerate(data):
+                        if value is None:
+                            mask, bits = changes.get(reg + offset, (0, 0))
+                            data[offset] = (values.get(reg + offset, 0) &
+                                            ~mask) | bits
+                    # skip runs that would not change the device
+                    if [device.get(reg + offset) for offset
+                            in range(len(data))] != data:
+                        writes.append((reg, data))
+                if writes:
+                    self.__write_runs(writes)
+                for reg, data in writes:
+                    for offset, value in enumerate(data):
+                        device[reg + offset] = value
+                continue
+            data = self.__read_runs(runs)
+            if kind == 'output':
+                results += data
+                continue
+            for (reg, length), run in zip(runs, data):
+                for offset, value in enumerate(run):
+                    device[reg + offset] = value
+                    values.setdefault(reg + offset, value)
+
+        self.__init_pending = False
+        if self.__cache is not None:
+            for reg in self.CACHED_REGISTERS:
+                if reg in device:
+                    self.__cache[reg] = device[reg]
+        return results
+
+    @__critical
+    def write_config(self, registers, current=None):
+        """
+        Write configuration and output latch registers that differ from
+        the device, in the order given by plan_config, with one call when
+        the bus supports combined transfers.
+        registers = dictionary of register values keyed by register
+        current = dictionary of the current register values, if None the
+        register cache is used if it is on or the device is read once
+        returns a list of the registers that were written
+        """
+        runs = self.plan_config(registers, current)
+        if runs:
+            self.__write_runs(runs)
+        if self.IOCON in registers:
+            # the default configuration is not written over the new IOCON
+            self.__init_pending = False
+        changed = []
+        for reg, values in runs:
+            for offset, value in enumerate(values):
+                changed.append(reg + offset)
+                if self.__cache is not None:
+                    self.__cache[reg + offset] = value
+        return sorted(changed)
+
+    def combined_transfers(self):
+        """
+        Check if the bus can send several register runs in one transfer
+        """
+        return hasattr(self.__bus, 'write_runs')
+
+    def read_registers(self):
+        """
+        Read every register from IODIRA to OLATB, with a single call when
+        the bus supports combined transfers.
+        Reading GPIO and INTCAP clears any interrupt.
+        returns a list of the 22 register values in address order
+        """
+        # the address pointer toggles within each A/B pair
+        runs = [(reg, 2) for reg in range(self.IODIRA, self.OLATB + 1, 2)]
+        values = []
+        for run in self.__read_runs(runs):
+            values += run
+        return values
+
+    @__critical
+    def invalidate(self, reg=None):
+        """
+        Mark a cached register, or all registers if reg is None, as stale
+        so it is read from the device on the next access
+        """
+        if reg in (None, self.IOCON):
+            self.__iocon = None
+        if self.__cache is None:
+            return
+        if reg is None:
+            self.__cache = [None] * (self.OLATB + 1)
+        else:
+            self.__cache[reg] = None
+        return
+
+
+class InstrumentedBus(object):
+    """
+    Wrap an smbus object to count the transactions to each register, time
+    them and count I/O errors.
+    Attributes not listed here are passed through to the wrapped bus.
+    """
+
+    # upper limits of the latency histogram buckets in microseconds
+    buckets = (50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.reset()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.bus, name)
+        if name in ('read_runs', 'write_runs'):
+            # combined transfers count as one transaction
+            def combined(addr, runs):
+                return self.__call(name, runs[0][0] if runs else None,
+                                   addr, runs)
+            return combined
+        return attribute
+
+    def reset(self):
+        """
+        Set all of the counters to 0
+        """
+        self.transactions = 0
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+        self.seconds = 0.0
+        # count, total seconds and longest seconds by method and register
+        self.registers = {}
+        self.histogram = [0] * (len(self.buckets) + 1)
+
+    def __call(self, method, reg, *args):
+        """
+        internal method for timing and counting one transaction
+        """
+        start = monotonic()
+        try:
+            return getattr(self.bus, method)(*args)
+        except IOError:
+            self.errors += 1
+            raise
+        finally:
+            elapsed = monotonic() - start
+            self.transactions += 1
+            if method.startswith('read'):
+                self.reads += 1
+            else:
+                self.writes += 1
+            self.seconds += elapsed
+            count, total, longest = self.registers.get((method, reg),
+                                                       (0, 0.0, 0.0))
+            self.registers[(method, reg)] = (count + 1, total + elapsed,
+                                             max(longest, elapsed))
+            micro = elapsed * 1000000
+            bucket = 0
+            while bucket < len(self.buckets) and micro > self.buckets[bucket]:
+                bucket += 1
+            self.histogram[bucket] += 1
+
+    def read_byte(self, addr):
+        return self.__call('read_byte', None, addr)
+
+    def write_byte(self, addr, val):
+        return self.__call('write_byte', None, addr, val)
+
+    def read_byte_data(self, addr, cmd):
+        return self.__call('read_byte_data', cmd, addr, cmd)
+
+    def write_byte_data(self, addr, cmd, val):
+        return self.__call('write_byte_data', cmd, addr, cmd, val)
+
+    def read_word_data(self, addr, cmd):
+        return self.__call('read_word_data', cmd, addr, cmd)
+
+    def write_word_data(self, addr, cmd, val):
+        return self.__call('write_word_data', cmd, addr, cmd, val)
+
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        return self.__call('read_i2c_block_data', cmd, addr, cmd, length)
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        return self.__call('write_i2c_block_data', cmd, addr, cmd, vals)
+
+    @staticmethod
+    def register_name(reg):
+        """
+        Get the datasheet name of a register
+        """
+        return MCP23017.register_name(reg)
+
+    def snapshot(self):
+        """
+        Get a copy of the counters that can be exported, for example as JSON
+        """
+        registers = {}
+        for (method, reg), (count, total, longest) in self.registers.items():
+            registers[method + " " + self.register_name(reg)] = {
+                "count": count, "seconds": total, "max": longest}
+        histogram = {}
+        for bucket, count in enumerate(self.histogram):
+            if bucket < len(self.buckets):
+                histogram["<=" + str(self.buckets[bucket]) + "us"] = count
+            else:
+                histogram[">" + str(self.buckets[-1]) + "us"] = count
+        return {"transactions": self.transactions, "reads": self.reads,
+                "writes": self.writes, "errors": self.errors,
+                "seconds": self.seconds, "registers": registers,
+                "histogram": histogram}
+
+    def summary(self):
+        """
+        Describe the counters as text
+        """
+        lines = ["transactions: " + str(self.transactions) +
+                 ", reads: " + str(self.reads) +
+                 ", writes: " + str(self.writes) +
+                 ", errors: " + str(self.errors) +
+                 ", time: " + '{0:.3f}'.format(self.seconds * 1000) + " ms"]
+        for (method, reg) in sorted(self.registers,
+                                    key=lambda item: (item[1] or 0, item[0])):
+            count, total, longest = self.registers[(method, reg)]
+            lines.append("  " + '{0:<21}'.format(method) +
+                         '{0:<9}'.format(self.register_name(reg)) +
+                         " count: " + str(count) +
+                         ", mean: " + '{0:.1f}'.format(
+                             total / count * 1000000) + " us" +
+                         ", max: " + '{0:.1f}'.format(longest * 1000000) +
+                         " us")
+        counts = []
+        for bucket, count in enumerate(self.histogram):
+            if count and bucket < len(self.buckets):
+                counts.append("<=" + str(self.buckets[bucket]) + "us: " +
+                              str(count))
+            elif count:
+                counts.append(">" + str(self.buckets[-1]) + "us: " +
+                              str(count))
+        if counts:
+            lines.append("  latency " + ", ".join(counts))
+        return "\n".join(lines)
+
+
+# options and profile settings that set pins and their A/B register pair
+option_registers = {
+    'direction': MCP23017.IODIRA,
+    'pullup': MCP23017.GPPUA,
+    'invert': MCP23017.IPOLA,
+    'enableinterrupts': MCP23017.GPINTENA,
+    'interrupttype': MCP23017.INTCONA,
+    'int_defaults': MCP23017.DEFVALA,
+    'write': MCP23017.OLATA
+}
+
+# options and profile settings for the whole board and their IOCON bit
+option_iocon_bits = {
+    'mirrorinterrupts': 6,
+    'interruptpolarity': 1
+}
+
+
+def merge_bits(changes, reg, mask, bits):
+    """
+    Add a change to bits of an A/B register pair, port A in the low byte,
+    to a dictionary of (mask, bits) keyed by register as used by
+    MCP23017.update.  Later changes to a bit replace earlier ones.
+    """
+    for offset in (0, 1):
+        part_mask = (mask >> (offset * 8)) & 0xFF
+        part_bits = (bits >> (offset * 8)) & part_mask
+        if part_mask:
+            old_mask, old_bits = changes.get(reg + offset, (0, 0))
+            changes[reg + offset] = (old_mask | part_mask,
+                                     (old_bits & ~part_mask) | part_bits)
+
 
 class Command(object):
     """
@@ -383,6 +1525,7 @@ class Command(object):
         ('-s', '--int_status'): 'int_status',
         ('-c', '--int_capture'): 'int_capture',
         ('-z', '--resetinterrupts'): 'resetinterrupts',
+        ('-P', '--plan'): 'plan',
         ('-b', '--binary'): 'bin',
         ('-x', '--hex'): 'hex'
     }
@@ -399,6 +1542,8 @@ class Command(object):
         'invert': False,
         'mirrorinterrupts': False,
         'pin': False,
+        'pinlist': False,
+        'plan': False,
         'port': False,
         'pullup': False,
         'read': False,
@@ -418,6 +1563,8 @@ class Command(object):
         'invert': 0,
         'mirrorinterrupts': 0,
         'pin_or_port': 0,
+        'pins': [],
+        'addresses': [],
         'pullup': 0,
         'write': 0
     }
@@ -431,6 +1578,35 @@ class Command(object):
     output_format = "dec"
     output_count = 0
 
+    def __init__(self, devices=None):
+        """
+        Copy the default flags, parameters and output so each command starts
+        from a clean state
+        devices = optional dictionary of MCP23017 objects keyed by address,
+        shared between commands so each device is only initialised once
+        """
+        self.flags = dict(Command.flags)
+        self.params = dict(Command.params)
+        self.output = dict(Command.output)
+        self.devices = devices
+        if self.devices is None:
+            self.devices = {}
+
+    def get_device(self, init=True):
+        """
+        Get the MCP23017 for the selected address
+        init = False leaves the default configuration of a new device to be
+        written by the first update
+        """
+        address = self.params['address']
+        if address not in self.devices:
+            self.devices[address] = MCP23017(address, init=init)
+        device = self.devices[address]
+        if init:
+            # writes the default configuration if a plan was only printed
+            device.update({})
+        return device
+
     @staticmethod
     def error_message(message):
         """
@@ -460,9 +1636,27 @@ class Command(object):
         """
         Check the option argument to see if it is within range.
         """
-        if arg:
+        if arg and ',' in arg:
+            if not self.flags['pinlist']:
+                self.error_message("A list of values needs a list of pins.")
+                sys.exit(2)
+            vals = [self.num(val) for val in arg.split(',')]
+            if len(vals) != len(self.params['pins']):
+                self.error_message(option + " needs one value for each pin.")
+                sys.exit(2)
+            for val in vals:
+                if val < 0 or val > 1:
+                    self.error_message(option + " argument outside of range.")
+                    sys.exit(2)
+            self.params[option] = vals
+        elif arg:
             val = self.num(arg)
-            if self.flags['port'] and (val < 0 or val > 255):
+            if self.flags['port'] and self.params['pin_or_port'] == 2 and (
+                    val < 0 or val > 65535):
+                self.error_message(option + " argument outside of range.")
+                sys.exit(2)
+            elif self.flags['port'] and self.params['pin_or_port'] != 2 and (
+                    val < 0 or val > 255):
                 self.error_message(option + " argument outside of range.")
                 sys.exit(2)
             elif self.flags['pin'] and (val < 0 or val > 1):
@@ -474,98 +1668,161 @@ class Command(object):
 
         return
 
-    def run_io_commands(self):
+    def register_changes(self):
         """
-        Send all of the IO related commands to the MCP23017
+        Fold the options that set pins or IOCON bits into one change for
+        each register
+        returns a dictionary keyed by register of (mask, bits)
         """
-        # direction
-        bus = MCP23017(self.params['address'])
-
-        if self.flags['direction']:
-            bus.set_direction(self.params['pin_or_port'],
-                              self.params['direction'], self.flags['pin'])
-
-        # invert
-        if self.flags['invert']:
-            bus.invert(self.params['pin_or_port'],
-                       self.params['invert'], self.flags['pin'])
-
-        # pullup
-        if self.flags['pullup']:
-            bus.set_pullup(self.params['pin_or_port'],
-                           self.params['pullup'], self.flags['pin'])
-
-        # write
-        if self.flags['write']:
-            bus.write(self.params['pin_or_port'],
-                      self.params['write'], self.flags['pin'])
+        changes = {}
+        for option in ('direction', 'invert', 'pullup', 'write',
+                       'enableinterrupts', 'interrupttype', 'int_defaults'):
+            if not self.flags[option]:
+                continue
+            reg = option_registers[option]
+            if self.flags['pin']:
+                for pin, value in self.pin_values(option).items():
+                    bit = 1 << (pin - 1)
+                    merge_bits(changes, reg, bit, bit if value else 0)
+            elif self.params['pin_or_port'] == 2:
+                merge_bits(changes, reg, 0xFFFF, self.params[option])
+            else:
+                shift = self.params['pin_or_port'] * 8
+                merge_bits(changes, reg, 0xFF << shift,
+                           self.params[option] << shift)
+        for option, bit in option_iocon_bits.items():
+            if self.flags[option]:
+                merge_bits(changes, MCP23017.IOCON, 1 << bit,
+                           (1 << bit) if self.params[option] else 0)
+        return changes
+
+    def output_reads(self):
+        """
+        Work out the register runs read for the read, interrupt status,
+        interrupt capture and reset interrupts options, in that order
+        returns a list of (option, (first register, number of bytes))
+        """
+        if self.flags['pin']:
+            ports = set([(pin - 1) // 8 for pin in self.params['pins']])
+        elif self.params['pin_or_port'] == 2:
+            ports = set([0, 1])
+        else:
+            ports = set([self.params['pin_or_port']])
+        reads = []
+        for option, reg in (('read', MCP23017.GPIOA),
+                            ('int_status', MCP23017.INTFA),
+                            ('int_capture', MCP23017.INTCAPA)):
+            if self.flags[option]:
+                if len(ports) == 2:
+                    reads.append((option, (reg, 2)))
+                else:
+                    reads.append((option, (reg + min(ports), 1)))
+        # reading both capture registers clears the interrupts
+        if self.flags['resetinterrupts'] and \
+                ('int_capture', (MCP23017.INTCAPA, 2)) not in reads:
+            reads.append(('resetinterrupts', (MCP23017.INTCAPA, 2)))
+        return reads
+
+    def output_value(self, run, data):
+        """
+        Get the value of the selected port, pin or pins from the bytes read
+        for a run of registers
+        """
+        reg, length = run
+        word = 0
+        for offset, value in enumerate(data):
+            word |= value << (((reg + offset) % 2) * 8)
+        if self.flags['pinlist']:
+            return [(word >> (pin - 1)) & 1 for pin in self.params['pins']]
+        if self.flags['pin']:
+            return (word >> (self.params['pin_or_port'] - 1)) & 1
+        if self.params['pin_or_port'] == 2:
+            return word
+        return (word >> (self.params['pin_or_port'] * 8)) & 0xFF
+
+    def plan_io_commands(self):
+        """
+        Plan the transactions for the selected options, see
+        MCP23017.plan_update
+        """
+        device = self.get_device(init=False)
+        return device.plan_update(self.register_changes(),
+                                  [run for option, run
+                                   in self.output_reads()])
 
-        # read
-        if self.flags['read']:
-            self.output_count += 1
-            self.output['read'] = bus.read(self.params['pin_or_port'],
-                                           self.flags['pin'])
+    def run_io_commands(self):
+        """
+        Send all of the IO and interrupt commands to the MCP23017.  The
+        options are folded into one change for each register so each
+        register is read and written at most once, see
+        MCP23017.plan_update
+        """
+        device = self.get_device(init=False)
+        reads = self.output_reads()
+        results = device.update(self.register_changes(),
+                                [run for option, run in reads])
+        self.output_count += 1
+        for (option, run), data in zip(reads, results):
+            if option in self.output:
+                self.output_count += 1
+                self.output[option] = self.output_value(run, data)
+        return
 
-        self.run_interrupt_commands(bus)
+    def format_plan(self, plan):
+        """
+        Format a transaction plan as one line for each transaction
+        """
+        lines = []
+        for kind, runs in plan:
+            items = []
+            for reg, data in runs:
+                length = data if kind != 'write' else len(data)
+                item = MCP23017.register_name(reg)
+                if length > 1:
+                    item += '-' + MCP23017.register_name(reg + length - 1)
+                if kind == 'write' and None not in data:
+                    item += '=' + ','.join(['0x{0:02x}'.format(value)
+                                            for value in data])
+                items.append(item)
+            lines.append(kind.replace('output', 'read') + ' ' +
+                         ', '.join(items))
+        lines.append(str(len(plan)) + ' transactions')
+        return '\n'.join(lines)
+
+    def pin_values(self, option):
+        """
+        Pair each selected pin with the value given for the option
+        """
+        values = self.params[option]
+        if not isinstance(values, list):
+            values = [values] * len(self.params['pins'])
+        return dict(zip(self.params['pins'], values))
 
-    def run_interrupt_commands(self, bus):
+    def pin_list(self, values):
         """
-        Send all of the interrupt related commands to the MCP23017
+        Order a dictionary of pin values by the selected pins
         """
-        # enable interrupts
-        if self.flags['enableinterrupts']:
-            bus.set_interrupt(self.params['pin_or_port'],
-                              self.params['enableinterrupts'],
-                              self.flags['pin'])
+        return [values[pin] for pin in self.params['pins']]
 
-        # mirror interrupts
-        if self.flags['mirrorinterrupts']:
-            bus.mirror_interrupts(self.params['mirrorinterrupts'])
-
-        # interrupt polarity
-        if self.flags['interruptpolarity']:
-            bus.set_interrupt_polarity(self.params['interruptpolarity'])
-
-        # interrupt type
-        if self.flags['interrupttype']:
-            bus.set_interrupt_type(self.params['pin_or_port'],
-                                   self.params['interrupttype'],
-                                   self.flags['pin'])
-
-        # interrupt defaults
-        if self.flags['int_defaults']:
-            bus.set_interrupt_defaults(self.params['pin_or_port'],
-                                       self.params['int_defaults'],
-                                       self.flags['pin'])
-
-        # interrupt status
-        self.output_count += 1
-        if self.flags['int_status']:
-            self.output['int_status'] = bus.read_int_status(
-                self.params['pin_or_port'],
-                self.flags['pin'])
-
-        # interrupt capture
-
-        if self.flags['int_capture']:
-            self.output_count += 1
-            self.output['int_capture'] = bus.read_int_capture(
-                self.params['pin_or_port'],
-                self.flags['pin'])
-
-        # reset interrupts
-        if self.flags['resetinterrupts']:
-            bus.reset_interrupts()
-
-        return
+    def is_word(self):
+        """
+        Check if both ports have been selected as one 16-bit port
+        """
+        return self.flags['port'] and self.params['pin_or_port'] == 2
 
     def format_number(self, value):
         """
         Format the number as determined by the Command
         """
         out = ""
-        if self.flags['hex']:
+        if isinstance(value, list):
+            out = ",".join([self.format_number(val) for val in value])
+        elif self.flags['hex'] and self.is_word():
+            out = '0x{0:04x}'.format(value)
+        elif self.flags['hex']:
             out = '0x{0:02x}'.format(value)
+        elif self.flags['bin'] and self.is_word():
+            out = '0b{0:016b}'.format(value)
         elif self.flags['bin']:
             out = '0b{0:08b}'.format(value)
         else:
@@ -576,6 +1833,13 @@ class Command(object):
         """
         Write any read values to the display
         """
+        print(self.format_output())
+        return
+
+    def format_output(self):
+        """
+        Format any read values for display
+        """
         output = ""
         if self.flags['read']:
             if self.flags['int_status'] or self.flags['int_capture']:
@@ -596,69 +1860,93 @@ class Command(object):
                     self.output['int_status']) + "\""
             else:
                 output += self.format_number(self.output['int_capture'])
-        print(output)
-        return
+        return output
 
-    def check_for_port_or_pin(self, opts):
+    def format_address_output(self):
+        """
+        Format any read values as a JSON value for one of several addresses
+        """
+        output = self.format_output()
+        if len([name for name in self.output if self.flags[name]]) > 1:
+            return "{" + output.lstrip(',') + "}"
+        return "\"" + output + "\""
+
+    def check_for_port_or_pin(self, opts, required=True):
         """
         Chec if an address, port or pin has been selected
         """
         for opt, arg in opts:
             if opt in ('-a', '--address'):
-                if self.num(arg) >= 0x20 and self.num(arg) <= 0x27:
-                    self.params['address'] = self.num(arg)
-                else:
+                addresses = []
+                for item in arg.split(','):
+                    first, sep, last = item.partition('-')
+                    if not sep:
+                        last = first
+                    addresses += range(self.num(first), self.num(last) + 1)
+                if not addresses or min(addresses) < 0x20 or \
+                        max(addresses) > 0x27:
                     self.error_message('Address out of range - 0x20 to 0x27.')
                     sys.exit(2)
+                self.params['addresses'] = sorted(set(addresses))
+                self.params['address'] = self.params['addresses'][0]
             elif opt in ("-p", "--port"):
-                if self.num(arg) == 0 or self.num(arg) == 1:
+                if self.num(arg) >= 0 and self.num(arg) <= 2:
                     self.flags['port'] = True
                     self.params['pin_or_port'] = self.num(arg)
                 else:
-                    self.error_message("Port out of range: 0 or 1. " + arg)
+                    self.error_message("Port out of range: 0 to 2. " + arg)
                     sys.exit(2)
             elif opt in ("-n", "--pin"):
                 if self.flags['port']:
                     self.error_message("You cannot select both port and pin.")
                     sys.exit(2)
-                if int(arg) >= 1 and int(arg) <= 16:
-                    self.flags['pin'] = True
-                    self.params['pin_or_port'] = int(arg)
-                else:
-                    self.error_message("Pin outside of range: 1 to 16.")
-                    sys.exit(2)
-
-        if not self.flags['port'] and not self.flags['pin']:
+                for pin in arg.split(','):
+                    if int(pin) >= 1 and int(pin) <= 16:
+                        if int(pin) not in self.params['pins']:
+                            self.params['pins'] = self.params['pins'] + [
+                                int(pin)]
+                    else:
+                        self.error_message("Pin outside of range: 1 to 16.")
+                        sys.exit(2)
+                self.flags['pin'] = True
+                self.params['pin_or_port'] = self.params['pins'][0]
+
+        if required and not self.flags['port'] and not self.flags['pin']:
             self.error_message("Please select a port or pin number.")
             sys.exit(2)
 
+        self.flags['pinlist'] = len(self.params['pins']) > 1
+
         return
 
 
-def main(argv):
+def parse(argv, devices=None, target=True):
     """
-    Main function.
+    Parse a single command.
+    target = False when a port or pin does not need to be selected
+    returns the Command
     """
 
-    cmd = Command()
+    cmd = Command(devices)
 
     cmd.params['address'] = 0x20  # default I2C address
 
     try:
-        opts, args = getopt.getopt(argv, "a:bcd:e:f:i:l:m:n:p:rst:u:w:xz",
+        opts, args = getopt.getopt(argv, "a:bcd:e:f:i:l:m:n:p:rst:u:w:xzP",
                                    ["address=", "port=", "pin=", "read",
                                     "write=", "direction=", "invert=",
                                     "pullup=", "mirrorinterrupts=",
                                     "interruptpolarity=", "interrupttype=",
                                     "int_defaults=", "enableinterrupts=",
                                     "int_status", "int_capture",
-                                    "resetinterrupts", "binary", "hex"])
+                                    "resetinterrupts", "binary", "hex",
+                                    "plan"])
     except getopt.GetoptError:
         cmd.error_message("option not recognised or no argument given.")
         sys.exit(2)
 
     # check if the target is a port or pin
-    cmd.check_for_port_or_pin(opts)
+    cmd.check_for_port_or_pin(opts, target)
 
     #  parse arguments by searching the arguments dictionary
     for opt, arg in opts:
@@ -668,8 +1956,1488 @@ def main(argv):
         if val:
             cmd.parse_option(arg, str(val).strip('[]').strip("''"))
 
+    return cmd
+
+
+def run(argv, devices=None):
+    """
+    Parse and run a single command.
+    """
+    cmd = parse(argv, devices)
+    if cmd.flags['plan']:
+        # print the transactions without running them
+        addresses = cmd.params['addresses'] or [cmd.params['address']]
+        for address in addresses:
+            cmd.params['address'] = address
+            if len(addresses) > 1:
+                print('0x{0:02x}'.format(address))
+            print(cmd.format_plan(cmd.plan_io_commands()))
+        return
+    if len(cmd.params['addresses']) > 1:
+        # run on every board, results keyed by address
+        outputs = []
+        for address in cmd.params['addresses']:
+            cmd.params['address'] = address
+            cmd.run_io_commands()
+            outputs.append('"0x{0:02x}":'.format(address) +
+                           cmd.format_address_output())
+        print("{" + ",".join(outputs) + "}")
+        return
     cmd.run_io_commands()
     cmd.write_output()
 
+
+def open_gpio_line(chip, line, edge='both'):
+    """
+    Request edge events for a line on a GPIO character device, such as the
+    GPIO the IO Pi INT pin is wired to.
+    chip = path to the device, e.g. /dev/gpiochip0
+    line = line offset on the chip
+    edge = rising, falling or both
+    returns a file descriptor that becomes readable on each edge
+    """
+    import fcntl
+    # GPIO_GET_LINEEVENT_IOCTL from linux/gpio.h
+    lineevent_ioctl = 0xC030B404
+    handle_input = 0x01
+    edges = {'rising': 0x01, 'falling': 0x02, 'both': 0x03}
+    request = struct.pack('<III32si', line, handle_input, edges[edge],
+                          b'iopi', 0)
+    chip_fd = os.open(chip, os.O_RDONLY)
+    try:
+        request = fcntl.ioctl(chip_fd, lineevent_ioctl, request)
+    finally:
+        os.close(chip_fd)
+    return struct.unpack('<III32si', request)[4]
+
+
+def selected_pins(cmd):
+    """
+    Get the pin numbers covered by the selected port, pin or list of pins
+    """
+    if cmd.flags['pin']:
+        return cmd.params['pins']
+    if cmd.params['pin_or_port'] == 1:
+        return list(range(9, 17))
+    if cmd.params['pin_or_port'] == 2:
+        return list(range(1, 17))
+    return list(range(1, 9))
+
+
+def interrupt_line(cmd, settings):
+    """
+    Open the interrupt line given with --intfd or --intline
+    returns a file descriptor or None if no line was given
+    """
+    try:
+        if settings.get('intfd') is not None:
+            return int(settings['intfd'])
+        elif settings.get('intline') is not None:
+            chip, sep, line = settings['intline'].rpartition(':')
+            return open_gpio_line(chip, int(line))
+    except (ValueError, IOError, OSError) as err:
+        cmd.error_message("Could not open the interrupt line: " + str(err))
+        sys.exit(2)
+    return None
+
+
+def run_watch(argv, settings):
+    """
+    Apply any configuration options once then wait for interrupts on the
+    selected port or pins and print each pin that changed with its
+    captured value
+    """
+    cmd = parse(argv)
+    output_format = settings.get('format') or 'csv'
+    if output_format not in ('csv', 'ndjson'):
+        cmd.error_message("Format must be csv or ndjson.")
+        sys.exit(2)
+    fd = interrupt_line(cmd, settings)
+
+    cmd.flags['read'] = False
+    cmd.run_io_commands()
+
+    bus = cmd.get_device()
+    bus.set_interrupt_line(fd)
+    bus.reset_interrupts()
+    pins = selected_pins(cmd)
+    if output_format == 'csv':
+        print("time,pin,value")
+    start = monotonic()
+    try:
+        while True:
+            changes = bus.wait_for_change()
+            stamp = '{0:.6f}'.format(monotonic() - start)
+            for pin in sorted(changes):
+                if pin not in pins:
+                    continue
+                value = cmd.format_number(changes[pin])
+                if output_format == 'ndjson':
+                    print("{\"time\":" + stamp + ",\"pin\":" + str(pin) +
+                          ",\"value\":\"" + value + "\"}")
+                else:
+                    print(stamp + "," + str(pin) + "," + value)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    except IOError as err:
+        cmd.error_message(str(err))
+        sys.exit(1)
+
+
+def run_count(argv, settings):
+    """
+    Apply any configuration options once then count the rising and
+    falling edges on the selected port or pins, printing the edges per
+    second of each pin every 1 / rate seconds
+    """
+    from iopi_counter import PulseCounter
+    cmd = parse(argv)
+    output_format = settings.get('format') or 'csv'
+    if output_format not in ('csv', 'ndjson'):
+        cmd.error_message("Format must be csv or ndjson.")
+        sys.exit(2)
+    try:
+        rate = float(settings.get('rate') or 1)
+        samples = settings.get('samples')
+        if samples is not None:
+            samples = int(samples, 0)
+    except ValueError:
+        cmd.error_message("Error parsing summary rate or count.")
+        sys.exit(2)
+    if rate <= 0 or (samples is not None and samples < 1):
+        cmd.error_message("Summary rate and count must be above 0.")
+        sys.exit(2)
+    fd = interrupt_line(cmd, settings)
+
+    cmd.flags['read'] = False
+    cmd.run_io_commands()
+
+    bus = cmd.get_device()
+    bus.set_interrupt_line(fd)
+    counter = PulseCounter(bus, selected_pins(cmd))
+    if output_format == 'csv':
+        print("time,pin,rising,falling,rising_rate,falling_rate")
+    counter.start()
+    start = monotonic()
+    count = 0
+    try:
+        while samples is None or count < samples:
+            count += 1
+            wait_until(start + count / rate)
+            seconds, rates = counter.rates()
+            counts = counter.counts()
+            stamp = '{0:.6f}'.format(monotonic() - start)
+            for pin in counter.pins:
+                fields = (str(counts[pin][0]), str(counts[pin][1]),
+                          '{0:.3f}'.format(rates[pin][0]),
+                          '{0:.3f}'.format(rates[pin][1]))
+                if output_format == 'ndjson':
+                    print("{\"time\":" + stamp + ",\"pin\":" + str(pin) +
+                          ",\"rising\":" + fields[0] +
+                          ",\"falling\":" + fields[1] +
+                          ",\"rising_rate\":" + fields[2] +
+                          ",\"falling_rate\":" + fields[3] + "}")
+                else:
+                    print(stamp + "," + str(pin) + "," + ",".join(fields))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    except IOError as err:
+        cmd.error_message(str(err))
+        sys.exit(1)
+    finally:
+        counter.stop()
+    statistics = counter.statistics()
+    sys.stderr.write(
+        "interrupts {0} ({1:.1f}/s), edges {2}, missed {3}\n".format(
+            statistics['events'], statistics['event_rate'],
+            statistics['edges'], statistics['missed']))
+
+
+def run_rules(path, argv, settings):
+    """
+    Apply any configuration options once then run the actions of the
+    rules in a file when the inputs of the selected board change, printing
+    each event with its reaction latency
+    """
+    import threading
+    from iopi_rules import RuleEngine, load_rules
+    cmd = parse(argv, target=False)
+    output_format = settings.get('format') or 'csv'
+    if output_format not in ('csv', 'ndjson'):
+        cmd.error_message("Format must be csv or ndjson.")
+        sys.exit(2)
+    try:
+        samples = settings.get('samples')
+        if samples is not None:
+            samples = int(samples, 0)
+    except ValueError:
+        cmd.error_message("Error parsing event count.")
+        sys.exit(2)
+    fd = interrupt_line(cmd, settings)
+
+    def get_device(address):
+        if address is None:
+            address = cmd.params['address']
+        if address < 0x20 or address > 0x27:
+            raise ValueError('Address out of range - 0x20 to 0x27.')
+        # the output latches are cached so each write is one transaction
+        if address not in cmd.devices:
+            cmd.devices[address] = MCP23017(address, True)
+        return cmd.devices[address]
+
+    try:
+        bus = get_device(None)
+        rules = load_rules(path, get_device)
+        engine = RuleEngine(bus)
+        for pin, edge, debounce, action, text in rules:
+            engine.add_rule(pin, edge, action, debounce, text)
+    except (IOError, ValueError) as err:
+        cmd.error_message("Could not read rules: " + str(err))
+        sys.exit(2)
+    if not rules:
+        cmd.error_message("No rules in " + path)
+        sys.exit(2)
+    if cmd.flags['port'] or cmd.flags['pin']:
+        cmd.flags['read'] = False
+        cmd.run_io_commands()
+    bus.set_interrupt_line(fd)
+
+    done = threading.Event()
+    count = [0]
+
+    def show(stamp, pin, edge, ran, latency):
+        stamp = '{0:.6f}'.format(stamp - start)
+        latency = '{0:.3f}'.format(latency * 1000)
+        if output_format == 'ndjson':
+            print("{\"time\":" + stamp + ",\"pin\":" + str(pin) +
+                  ",\"edge\":\"" + edge + "\",\"actions\":" +
+                  str(len(ran)) + ",\"latency_ms\":" + latency + "}")
+        else:
+            print(stamp + "," + str(pin) + "," + edge + "," +
+                  str(len(ran)) + "," + latency)
+        sys.stdout.flush()
+        count[0] += 1
+        if samples is not None and count[0] >= samples:
+            done.set()
+
+    engine.listeners.append(show)
+    if output_format == 'csv':
+        print("time,pin,edge,actions,latency_ms")
+    start = monotonic()
+    engine.start()
+    try:
+        while not done.wait(0.1) and engine.error is None:
+            continue
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.stop()
+    if engine.error is not None:
+        cmd.error_message(str(engine.error))
+        sys.exit(1)
+    statistics = engine.statistics()
+    sys.stderr.write(
+        "events {0}, actions {1}, errors {2}, latency ms p50 {3:.3f} "
+        "p90 {4:.3f} p99 {5:.3f} max {6:.3f}\n".format(
+            statistics['events'], statistics['actions'],
+            statistics['errors'], statistics['p50'] * 1000,
+            statistics['p90'] * 1000, statistics['p99'] * 1000,
+            statistics['max'] * 1000))
+    if statistics['last_error']:
+        sys.stderr.write("last action error: " +
+                         statistics['last_error'] + "\n")
+
+
+class MCP23017Group(object):
+    """
+    Several MCP23017 devices sharing one I2C bus object.
+    """
+
+    def __init__(self, addresses, cache=False, bus=None):
+        """
+        addresses = list of I2C addresses
+        cache = True keeps a register cache for each device
+        bus = smbus object to share, by default the detected bus is used
+        """
+        self.devices = {}
+        for address in addresses:
+            self.devices[address] = MCP23017(address, cache, bus)
+            bus = self.devices[address].get_bus()
+
+    def call(self, method, *args):
+        """
+        Call an MCP23017 method on every device
+        returns a dictionary of the results keyed by address
+        """
+        results = {}
+        for address in sorted(self.devices):
+            results[address] = getattr(self.devices[address], method)(*args)
+        return results
+
+    def read(self, target, is_pin=False):
+        """
+        read a pin or port on every device
+        returns a dictionary of values keyed by address
+        """
+        return self.call('read', target, is_pin)
+
+    def read_word(self):
+        """
+        read all 16 pins of every device with one read per device
+        returns a dictionary of values keyed by address
+        """
+        return self.call('read_word')
+
+
+class Poller(object):
+    """
+    MCP23017 groups on several I2C buses, each with its own worker thread
+    so transfers on different bus adapters run at the same time.
+
+    Bus calls that wait for the bus release the interpreter lock, so the
+    time to read every board is about the time for the bus with the most
+    boards rather than the total for all buses.
+    """
+
+    def __init__(self, boards, cache=False):
+        """
+        boards = dictionary of lists of I2C addresses keyed by bus number
+        cache = True keeps a register cache for each device
+        """
+        import threading
+        try:
+            from queue import Queue
+        except ImportError:
+            from Queue import Queue
+        self.groups = {}
+        self.__queues = {}
+        self.__threads = []
+        for number in sorted(boards):
+            self.groups[number] = MCP23017Group(
+                boards[number], cache, MCP23017.get_shared_bus(number))
+            self.__queues[number] = Queue()
+            thread = threading.Thread(target=self.__worker,
+                                      args=(number, self.__queues[number]))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def __worker(self, number, requests):
+        """
+        internal method run by the thread for one bus, calling the method
+        of each request on every device in the group in address order
+        """
+        group = self.groups[number]
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            method, args, results, done = request
+            try:
+                values = {}
+                for address in sorted(group.devices):
+                    value = getattr(group.devices[address], method)(*args)
+                    values[address] = (monotonic(), value)
+                results[number] = values
+            except Exception as err:
+                results[number] = err
+            done.release()
+
+    def call(self, method, *args):
+        """
+        Call an MCP23017 method on every device of every bus, with the
+        buses in parallel
+        returns a dictionary keyed by bus number of dictionaries keyed by
+        address of (time, result), time from the monotonic clock when the
+        result was read
+        """
+        import threading
+        results = {}
+        done = threading.Semaphore(0)
+        for number in self.__queues:
+            self.__queues[number].put((method, args, results, done))
+        for _ in self.__queues:
+            done.acquire()
+        for number, values in results.items():
+            if isinstance(values, Exception):
+                raise values
+        return results
+
+    def snapshot(self):
+        """
+        Read all 16 pins of every board on every bus
+        returns a dictionary keyed by bus number of dictionaries keyed by
+        address of (time, value)
+        """
+        return self.call('read_word')
+
+    def close(self):
+        """
+        Stop the worker threads
+        """
+        for number in self.__queues:
+            self.__queues[number].put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+
+def run_poll(argv, settings, buses):
+    """
+    Read all 16 pins of the selected boards on each bus at a fixed rate,
+    with one worker thread for each bus, printing each snapshot as a JSON
+    line of values keyed by bus number and address
+    """
+    cmd = parse(argv, target=False)
+    try:
+        rate = float(settings.get('rate') or 10)
+        samples = settings.get('samples')
+        if samples is not None:
+            samples = int(samples, 0)
+    except ValueError:
+        cmd.error_message("Error parsing poll rate or count.")
+        sys.exit(2)
+    if rate <= 0 or (samples is not None and samples < 1):
+        cmd.error_message("Poll rate and count must be above 0.")
+        sys.exit(2)
+    cmd.flags['port'] = True
+    cmd.params['pin_or_port'] = 2
+    addresses = cmd.params['addresses'] or [cmd.params['address']]
+    poller = Poller(dict((number, addresses) for number in buses))
+
+    start = monotonic()
+    count = 0
+    try:
+        while samples is None or count < samples:
+            wait_until(start + count / rate)
+            snapshot = poller.snapshot()
+            line = []
+            for number in sorted(snapshot):
+                line.append('"' + str(number) + '":{' + ",".join(
+                    ['"0x{0:02x}":'.format(address) + '{"time":' +
+                     '{0:.6f}'.format(stamp - start) + ',"read":"' +
+                     cmd.format_number(value) + '"}'
+                     for address, (stamp, value)
+                     in sorted(snapshot[number].items())]) + '}')
+            sys.stdout.write("{" + ",".join(line) + "}\n")
+            sys.stdout.flush()
+            count += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        poller.close()
+
+
+def run_export(listen, argv, settings, buses):
+    """
+    Serve the pin states and interrupt flags of the selected boards on each
+    bus over HTTP, read in the background at --rate readings per second
+    """
+    from iopi_export import Exporter
+    cmd = parse(argv, target=False)
+    host, sep, port = (listen or '').rpartition(':')
+    try:
+        port = int(port or 9400)
+        rate = float(settings.get('rate') or 1)
+    except ValueError:
+        cmd.error_message("Error parsing export port or rate.")
+        sys.exit(2)
+    if rate <= 0:
+        cmd.error_message("Export rate must be above 0.")
+        sys.exit(2)
+    addresses = cmd.params['addresses'] or [cmd.params['address']]
+    # the bus statistics are part of the exported metrics
+    MCP23017.instrument = True
+    exporter = Exporter(Poller(dict((number, addresses)
+                                    for number in buses)), 1.0 / rate)
+    try:
+        exporter.serve(host or '127.0.0.1', port)
+    except (IOError, OSError) as err:
+        cmd.error_message("Could not serve on port " + str(port) + ": " +
+                          str(err))
+        sys.exit(1)
+
+
+class Sampler(object):
+    """
+    Read the selected port or pins at a fixed rate and stream each reading
+    with its time in seconds from the start of sampling.
+
+    Samples are scheduled from the start time rather than the previous
+    sample so timing errors do not accumulate.  If a reading finishes after
+    the next sample is due the missed slots are skipped and counted as
+    overruns.
+
+    The binary format writes one 10 byte little-endian record per sample,
+    an 8 byte float time followed by a 16 bit value with pin N at bit N - 1
+    whichever port or pins are selected, and pins not read as 0.
+    """
+
+    formats = ('csv', 'ndjson', 'binary')
+    record = struct.Struct('<dH')
+
+    def __init__(self, cmd, rate, samples=None, output_format='csv',
+                 stream=None):
+        self.cmd = cmd
+        self.bus = cmd.get_device()
+        self.period = 1.0 / rate
+        self.samples = samples
+        self.output_format = output_format
+        self.stream = stream
+        if self.stream is None:
+            self.stream = sys.stdout
+            if output_format == 'binary':
+                self.stream = getattr(sys.stdout, 'buffer', sys.stdout)
+        self.count = 0
+        self.overruns = 0
+        self.first = None
+        self.last = None
+        self.late_total = 0.0
+        self.late_max = 0.0
+
+    def read(self):
+        """
+        Read the selected port, pin or list of pins
+        """
+        if self.cmd.flags['pinlist']:
+            return self.cmd.pin_list(
+                self.bus.read_pins(self.cmd.params['pins']))
+        return self.bus.read(self.cmd.params['pin_or_port'],
+                             self.cmd.flags['pin'])
+
+    def write_header(self):
+        """
+        Write the column names for the csv format
+        """
+        if self.output_format != 'csv':
+            return
+        if self.cmd.flags['pinlist']:
+            names = ['pin' + str(pin) for pin in self.cmd.params['pins']]
+        else:
+            names = ['read']
+        self.stream.write("time," + ",".join(names) + "\n")
+
+    def pin_word(self, value):
+        """
+        Place a reading at the bits of the pins it was read from, port A in
+        the low byte, so --analyse labels the pins correctly
+        """
+        if self.cmd.flags['pinlist']:
+            return sum([bit << (pin - 1) for pin, bit
+                        in zip(self.cmd.params['pins'], value)])
+        if self.cmd.flags['pin']:
+            return value << (self.cmd.params['pin_or_port'] - 1)
+        if self.cmd.params['pin_or_port'] == 1:
+            return value << 8
+        return value
+
+    def write_sample(self, stamp, value):
+        """
+        Write one sample in the selected format
+        """
+        if self.output_format == 'binary':
+            self.stream.write(self.record.pack(stamp, self.pin_word(value)))
+        elif self.output_format == 'ndjson':
+            self.stream.write("{\"time\":" + '{0:.6f}'.format(stamp) +
+                              ",\"read\":\"" +
+                              self.cmd.format_number(value) + "\"}\n")
+        else:
+            self.stream.write('{0:.6f}'.format(stamp) + "," +
+                              self.cmd.format_number(value) + "\n")
+        self.stream.flush()
+
+    def run(self):
+        """
+        Sample until the sample count is reached or the user interrupts
+        """
+        self.write_header()
+        start = monotonic()
+        slot = 0
+        try:
+            while self.samples is None or self.count < self.samples:
+                due = start + slot * self.period
+                delay = due - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                now = monotonic()
+                value = self.read()
+                self.write_sample(now - start, value)
+
+                late = now - due
+                self.late_total += late
+                self.late_max = max(self.late_max, late)
+                if self.first is None:
+                    self.first = now
+                self.last = now
+                self.count += 1
+
+                slot += 1
+                behind = monotonic() - (start + slot * self.period)
+                if behind > 0:
+                    missed = int(behind / self.period) + 1
+                    self.overruns += missed
+                    slot += missed
+        except KeyboardInterrupt:
+            pass
+        return
+
+    def summary(self):
+        """
+        Describe the achieved sample rate and timing jitter
+        """
+        rate = 0.0
+        if self.count > 1 and self.last > self.first:
+            rate = (self.count - 1) / (self.last - self.first)
+        jitter = 0.0
+        if self.count:
+            jitter = self.late_total / self.count
+        return ("samples: " + str(self.count) +
+                ", rate: " + '{0:.1f}'.format(rate) + " Hz" +
+                ", target: " + '{0:.1f}'.format(1.0 / self.period) + " Hz" +
+                ", jitter mean: " + '{0:.3f}'.format(jitter * 1000) + " ms" +
+                ", max: " + '{0:.3f}'.format(self.late_max * 1000) + " ms" +
+                ", overruns: " + str(self.overruns))
+
+
+def run_sample(argv, settings):
+    """
+    Apply any configuration options once then sample the selected port or
+    pins, writing the summary to stderr
+    """
+    cmd = parse(argv)
+    try:
+        rate = float(settings.get('rate') or 10)
+        samples = settings.get('samples')
+        if samples is not None:
+            samples = int(samples, 0)
+    except ValueError:
+        cmd.error_message("Error parsing sample rate or count.")
+        sys.exit(2)
+    if rate <= 0 or (samples is not None and samples < 1):
+        cmd.error_message("Sample rate and count must be above 0.")
+        sys.exit(2)
+    output_format = settings.get('format') or 'csv'
+    if output_format not in Sampler.formats:
+        cmd.error_message("Format must be csv, ndjson or binary.")
+        sys.exit(2)
+
+    cmd.flags['read'] = False
+    cmd.run_io_commands()
+
+    sampler = Sampler(cmd, rate, samples, output_format)
+    sampler.run()
+    sys.stderr.write(sampler.summary() + "\n")
+
+
+class CaptureSampler(Sampler):
+    """
+    Sampler that adds the 16 bit pin state, and optionally the interrupt
+    flags and capture, of each sample to a capture file from iopi_record
+    instead of printing it
+    """
+
+    def __init__(self, cmd, rate, samples, capture):
+        Sampler.__init__(self, cmd, rate, samples)
+        self.capture = capture
+
+    def read(self):
+        """
+        Read both ports, after the interrupt flags and capture when they
+        are recorded as reading GPIO clears them
+        """
+        if self.capture.interrupts:
+            intf = self.bus.read_int_status(2)
+            intcap = self.bus.read_int_capture(2)
+            return (self.bus.read_word(), intf, intcap)
+        return (self.bus.read_word(),)
+
+    def write_header(self):
+        return
+
+    def write_sample(self, stamp, value):
+        self.capture.append(stamp, *value)
+
+
+def run_record(path, argv, settings):
+    """
+    Apply any configuration options once then record both ports of the
+    selected board into a capture file, writing the summary to stderr
+    """
+    import iopi_record
+    cmd = parse(argv, target=False)
+    try:
+        rate = float(settings.get('rate') or 10)
+        samples = settings.get('samples')
+        if samples is not None:
+            samples = int(samples, 0)
+        size = int(settings.get('size') or '1000000', 0)
+    except ValueError:
+        cmd.error_message("Error parsing sample rate, count or size.")
+        sys.exit(2)
+    if rate <= 0 or size < 1 or (samples is not None and samples < 1):
+        cmd.error_message("Sample rate, count and size must be above 0.")
+        sys.exit(2)
+    try:
+        capture = iopi_record.CaptureFile(path, size,
+                                          settings.get('interrupts', False))
+    except (IOError, OSError, ValueError) as err:
+        cmd.error_message("Could not open capture file: " + str(err))
+        sys.exit(2)
+
+    cmd.flags['read'] = False
+    if cmd.flags['port'] or cmd.flags['pin']:
+        cmd.run_io_commands()
+
+    sampler = CaptureSampler(cmd, rate, samples, capture)
+    try:
+        sampler.run()
+    finally:
+        capture.close()
+    sys.stderr.write(sampler.summary() + "\n")
+
+
+def run_replay(path, argv, settings):
+    """
+    Print the records of a capture file as csv or ndjson, optionally only
+    those between the --from and --to times in seconds from the start of
+    the file
+    """
+    import iopi_record
+    cmd = parse(argv, target=False)
+    # values are shown as 16 bit port values
+    cmd.flags['port'] = True
+    cmd.params['pin_or_port'] = 2
+    output_format = settings.get('format') or 'csv'
+    if output_format not in ('csv', 'ndjson'):
+        cmd.error_message("Format must be csv or ndjson.")
+        sys.exit(2)
+    try:
+        start = settings.get('from')
+        end = settings.get('to')
+        if start is not None:
+            start = float(start)
+        if end is not None:
+            end = float(end)
+    except ValueError:
+        cmd.error_message("Error parsing --from or --to time.")
+        sys.exit(2)
+    try:
+        capture = iopi_record.CaptureFile(path, writable=False)
+    except (IOError, OSError, ValueError) as err:
+        cmd.error_message("Could not open capture file: " + str(err))
+        sys.exit(2)
+
+    names = ('time', 'read', 'int_status', 'int_capture')
+    if not capture.interrupts:
+        names = names[:2]
+    if output_format == 'csv':
+        sys.stdout.write(",".join(names) + "\n")
+    try:
+        for record in capture.records(start, end):
+            values = [cmd.format_number(value) for value in record[1:]]
+            if output_format == 'ndjson':
+                sys.stdout.write("{\"time\":" + '{0:.6f}'.format(record[0]) +
+                                 "".join([",\"" + name + "\":\"" + value +
+                                          "\"" for name, value
+                                          in zip(names[1:], values)]) +
+                                 "}\n")
+            else:
+                sys.stdout.write('{0:.6f}'.format(record[0]) + "," +
+                                 ",".join(values) + "\n")
+    finally:
+        capture.close()
+
+
+def run_analyse(path, argv, settings):
+    """
+    Print per pin statistics for the readings in a capture file or binary
+    sample file as JSON, for the selected pins or port or every pin
+    """
+    import json
+    cmd = parse(argv, target=False)
+    try:
+        import iopi_analysis
+    except ImportError:
+        cmd.error_message("Analysis needs NumPy, install python-numpy.")
+        sys.exit(2)
+    try:
+        hold = float(settings.get('debounce') or 0)
+    except ValueError:
+        cmd.error_message("Error parsing debounce time.")
+        sys.exit(2)
+    try:
+        times, values = iopi_analysis.load_samples(path)
+        results = iopi_analysis.analyse(times, values, 16, hold)
+    except (IOError, OSError, ValueError) as err:
+        cmd.error_message("Could not analyse samples: " + str(err))
+        sys.exit(2)
+    if cmd.flags['pin']:
+        pins = cmd.params['pins']
+    elif cmd.flags['port'] and cmd.params['pin_or_port'] != 2:
+        pins = range(cmd.params['pin_or_port'] * 8 + 1,
+                     cmd.params['pin_or_port'] * 8 + 9)
+    else:
+        pins = range(1, 17)
+    print(json.dumps([results[pin - 1] for pin in pins], sort_keys=True))
+
+
+class Sequencer(object):
+    """
+    Write a sequence of values to the selected port at set times.
+
+    Each step is a delay in seconds from the previous step and the value
+    written when it ends.  Steps are scheduled from the start time so
+    timing errors do not accumulate, waiting with wait_until.
+
+    Port 2 writes both ports, with a single byte write when only one port
+    changes and one A/B pair write when both do.
+    """
+
+    spin = 0.002  # seconds before a step spent polling the clock
+
+    def __init__(self, cmd, steps, loops=1):
+        """
+        cmd = Command with the selected port
+        steps = list of (delay in seconds, value)
+        loops = times to play the sequence, 0 plays it until interrupted
+        """
+        self.cmd = cmd
+        self.bus = cmd.get_device()
+        self.steps = steps
+        self.loops = loops
+        self.count = 0
+        self.writes = 0
+        self.late_total = 0.0
+        self.late_max = 0.0
+        self.value = None
+
+    @staticmethod
+    def load(source, period):
+        """
+        Read the steps from a file of 'delay value' lines, with # comments,
+        or from a pattern of comma separated values one period apart
+        returns a list of (delay in seconds, value string)
+        """
+        if ',' in source or not os.path.exists(source):
+            return [(period, value.strip()) for value in source.split(',')
+                    if value.strip()]
+        steps = []
+        with open(source) as sequence_file:
+            for line in sequence_file:
+                fields = line.split('#')[0].split()
+                if not fields:
+                    continue
+                if len(fields) != 2:
+                    raise ValueError("expected 'delay value': " + line.strip())
+                steps.append((float(fields[0]), fields[1]))
+        return steps
+
+    def write(self, value):
+        """
+        Write a value to the selected port, only sending the ports that
+        change
+        """
+        port = self.cmd.params['pin_or_port']
+        if port != 2:
+            if value != self.value:
+                self.bus.write(port, value)
+                self.writes += 1
+        elif value != self.value:
+            changed = 0xFFFF
+            if self.value is not None:
+                changed = value ^ self.value
+            if changed & 0xFF and changed & 0xFF00:
+                self.bus.write_word(value)
+            elif changed & 0xFF:
+                self.bus.write(0, value & 0xFF)
+            else:
+                self.bus.write(1, (value >> 8) & 0xFF)
+            self.writes += 1
+        self.value = value
+
+    def run(self):
+        """
+        Play the sequence until the loops are done or the user interrupts
+        """
+        start = monotonic()
+        due = start
+        loop = 0
+        try:
+            while self.loops == 0 or loop < self.loops:
+                for delay, value in self.steps:
+                    due += delay
+                    wait_until(due, self.spin)
+                    late = monotonic() - due
+                    self.write(value)
+                    self.late_total += late
+                    self.late_max = max(self.late_max, late)
+                    self.count += 1
+                loop += 1
+        except KeyboardInterrupt:
+            pass
+        return
+
+    def summary(self):
+        """
+        Describe the achieved step timing
+        """
+        error = 0.0
+        if self.count:
+            error = self.late_total / self.count
+        return ("steps: " + str(self.count) +
+                ", writes: " + str(self.writes) +
+                ", timing error mean: " + '{0:.3f}'.format(error * 1000) +
+                " ms, max: " + '{0:.3f}'.format(self.late_max * 1000) + " ms")
+
+
+def run_sequence(source, argv, settings):
+    """
+    Apply any configuration options once then play a sequence of values
+    on the selected port, writing the timing summary to stderr
+    """
+    cmd = parse(argv)
+    if cmd.flags['pin']:
+        cmd.error_message("Please select a port for the sequence.")
+        sys.exit(2)
+    try:
+        rate = float(settings.get('rate') or 10)
+        loops = int(settings.get('loops') or '1', 0)
+        steps = Sequencer.load(source, 1.0 / rate)
+        steps = [(delay, cmd.num(value)) for delay, value in steps]
+    except (IOError, ValueError, ZeroDivisionError) as err:
+        cmd.error_message("Could not read sequence: " + str(err))
+        sys.exit(2)
+    limit = 65535 if cmd.params['pin_or_port'] == 2 else 255
+    if not steps or loops < 0 or \
+            [delay for delay, value in steps if delay < 0] or \
+            [value for delay, value in steps if value < 0 or value > limit]:
+        cmd.error_message("Sequence steps or values out of range.")
+        sys.exit(2)
+    if loops != 1 and not sum([delay for delay, value in steps]):
+        cmd.error_message("A looping sequence needs a delay.")
+        sys.exit(2)
+
+    cmd.flags['read'] = False
+    cmd.run_io_commands()
+
+    sequencer = Sequencer(cmd, steps, loops)
+    sequencer.run()
+    sys.stderr.write(sequencer.summary() + "\n")
+
+
+class Service(object):
+    """
+    Serve commands over a Unix domain socket so the I2C bus and MCP23017
+    objects stay open between commands.
+
+    Each request is a JSON list of command line arguments on a single line.
+    Each reply is a JSON object on a single line with the printed output and
+    the exit status, {"output": "12\\n", "status": 0}.
+    Several requests can be sent over one connection.  Each connection is
+    answered by its own thread, so an idle client does not hold up the
+    others, and commands run one at a time.
+    """
+
+    default_socket = "/tmp/iopi.sock"
+
+    def __init__(self, path=None):
+        import threading
+        self.path = path or self.default_socket
+        self.devices = {}
+        # commands share the devices and sys.stdout
+        self.lock = threading.Lock()
+
+    def execute(self, argv):
+        """
+        Run one command and return the printed output and exit status.
+        A command starting with --stats also returns the bus statistics.
+        """
+        try:
+            from io import StringIO
+        except ImportError:
+            from StringIO import StringIO
+        stats = argv[:1] == ['--stats']
+        if stats:
+            argv = argv[1:]
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        status = 0
+        try:
+            if argv:
+                run(argv, self.devices)
+            if stats and MCP23017.instrument:
+                write_statistics(sys.stdout)
+            elif stats:
+                print("Statistics are off, start the service with --stats")
+        except SystemExit as err:
+            status = err.code
+        except IOError as err:
+            print("I2C bus error: " + str(err))
+            status = 1
+        except Exception as err:  # keep serving after a bad command
+            print("Error: " + str(err))
+            status = 1
+        finally:
+            output = sys.stdout.getvalue()
+            sys.stdout = stdout
+        return output, status
+
+    def handle(self, conn):
+        """
+        Answer requests on a connection until the client closes it
+        """
+        import json
+        stream = conn.makefile('rw')
+        try:
+            for line in stream:
+                if not line.strip():
+                    continue
+                try:
+                    argv = json.loads(line)
+                except ValueError:
+                    argv = None
+                if isinstance(argv, list):
+                    with self.lock:
+                        output, status = self.execute(
+                            [str(a) for a in argv])
+                else:
+                    output, status = "request not recognised.\n", 2
+                stream.write(json.dumps({"output": output,
+                                         "status": status}) + "\n")
+                stream.flush()
+        finally:
+            stream.close()
+
+    def connection(self, conn):
+        """
+        Answer a connection and close it, for a connection thread
+        """
+        try:
+            self.handle(conn)
+        except (IOError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def serve(self):
+        """
+        Accept connections until interrupted.  An existing socket is only
+        replaced when no service answers on it.
+        """
+        import socket
+        import stat
+        import threading
+        if os.path.lexists(self.path):
+            if not stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                print(self.path + " exists and is not a socket")
+                sys.exit(1)
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except (IOError, OSError):
+                os.remove(self.path)  # left by a service that stopped
+            else:
+                print("A service is already running on " + self.path)
+                sys.exit(1)
+            finally:
+                probe.close()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.path)
+            server.listen(16)
+            while True:
+                conn, addr = server.accept()
+                thread = threading.Thread(target=self.connection,
+                                          args=(conn,))
+                thread.daemon = True
+                thread.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def request(self, argv):
+        """
+        Send a command to a running service, print the reply and exit with
+        the returned status
+        """
+        import json
+        import socket
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.path)
+        except (IOError, OSError):
+            print("Could not connect to " + self.path)
+            sys.exit(1)
+        stream = client.makefile('rw')
+        stream.write(json.dumps(argv) + "\n")
+        stream.flush()
+        reply = json.loads(stream.readline())
+        stream.close()
+        client.close()
+        sys.stdout.write(reply['output'])
+        sys.exit(reply['status'])
+
+
+def run_batch(source=None, devices=None):
+    """
+    Run one command per line from a file, or stdin if no file is given,
+    printing one line of output for each command.
+    Blank lines and lines starting with # are ignored.
+    returns the exit status of the last command that failed, or 0
+    """
+    import shlex
+    if devices is None:
+        devices = {}
+    status = 0
+    if source in (None, '', '-'):
+        stream = sys.stdin
+    else:
+        try:
+            stream = open(source)
+        except IOError:
+            Command.error_message("Could not open batch file: " + source)
+            sys.exit(2)
+    for line in stream:
+        argv = shlex.split(line, comments=True)
+        if not argv:
+            continue
+        try:
+            run(argv, devices)
+        except SystemExit as err:
+            if err.code:
+                status = err.code
+        except IOError as err:
+            Command.error_message("I2C bus error: " + str(err))
+            status = 1
+        sys.stdout.flush()
+    if stream is not sys.stdin:
+        stream.close()
+    return status
+
+
+def run_dump(argv):
+    """
+    Print every register of the selected boards as a JSON object keyed by
+    address and register name
+    """
+    import json
+    cmd = parse(argv, target=False)
+    dump = {}
+    for address in cmd.params['addresses'] or [cmd.params['address']]:
+        cmd.params['address'] = address
+        # a new device is not initialised so IOCON is read as it is
+        values = cmd.get_device(init=False).read_registers()
+        registers = {}
+        for reg, value in enumerate(values):
+            if reg != MCP23017.IOCON + 1:  # second address of IOCON
+                registers[MCP23017.register_name(reg)] = \
+                    cmd.format_number(value)
+        dump['0x{0:02x}'.format(address)] = registers
+    print(json.dumps(dump, sort_keys=True))
+
+
+def run_restore(source, argv):
+    """
+    Write the registers saved by --dump back to the boards, only writing
+    registers that differ.  If addresses are selected only those boards
+    are restored.  Prints the registers written for each board.
+    """
+    import json
+    cmd = parse(argv, target=False)
+    try:
+        with open(source) as dump_file:
+            dump = json.load(dump_file)
+    except (IOError, ValueError) as err:
+        cmd.error_message("Could not read restore file: " + str(err))
+        sys.exit(2)
+
+    # every board is checked before any is written
+    boards = []
+    for key in sorted(dump):
+        address = cmd.num(str(key))
+        if address < 0x20 or address > 0x27:
+            cmd.error_message('Address out of range - 0x20 to 0x27.')
+            sys.exit(2)
+        if cmd.params['addresses'] and address not in cmd.params['addresses']:
+            continue
+        registers = {}
+        for name, value in dump[key].items():
+            reg = getattr(MCP23017, str(name), None)
+            # read only registers in the dump are ignored
+            if reg in MCP23017.CACHED_REGISTERS:
+                registers[reg] = cmd.num(str(value))
+        if registers.get(MCP23017.IOCON, 0) & 0x80:
+            cmd.error_message("IOCON.BANK = 1 is not supported.")
+            sys.exit(2)
+        boards.append((address, registers))
+
+    written = {}
+    for address, registers in boards:
+        cmd.params['address'] = address
+        # only write_config writes, the saved IOCON replaces the default
+        changed = cmd.get_device(init=False).write_config(registers)
+        written['0x{0:02x}'.format(address)] = [
+            MCP23017.register_name(reg) for reg in changed]
+    print(json.dumps(written, sort_keys=True))
+
+
+def load_profile(path):
+    """
+    Read a board profile from a JSON or INI file.
+
+    Each board is a JSON object or INI section named by its address holding
+    settings named like the command line options:
+    mirrorinterrupts and interruptpolarity for the board, and
+    portN.<option> or pinN.<option> where option is direction, pullup,
+    invert, enableinterrupts, interrupttype, int_defaults or write.
+    Port 2 sets all 16 pins.  Pin settings override port settings.
+
+    returns a dictionary of settings dictionaries keyed by address
+    """
+    if path.lower().endswith('.ini'):
+        try:
+            from configparser import ConfigParser
+        except ImportError:
+            from ConfigParser import ConfigParser
+        parser = ConfigParser()
+        if not parser.read(path):
+            raise IOError("Could not open " + path)
+        return dict((section, dict(parser.items(section)))
+                    for section in parser.sections())
+    import json
+    with open(path) as profile_file:
+        return json.load(profile_file)
+
+
+def profile_target(cmd, settings, current):
+    """
+    Work out the register values a board profile asks for, starting from
+    the current register values so unset bits are left alone
+    returns a dictionary of register values keyed by register
+    """
+    changes = {}
+    # board settings and ports first so pins override them
+    ordered = sorted(settings.items(),
+                     key=lambda item: (str(item[0]).startswith('pin'),
+                                       str(item[0])))
+    for key, value in ordered:
+        value = cmd.num(str(value))
+        name, sep, option = str(key).lower().partition('.')
+        if not sep and name in option_iocon_bits:
+            bit = 1 << option_iocon_bits[name]
+            merge_bits(changes, MCP23017.IOCON, bit, bit if value else 0)
+        elif sep and option in option_registers and \
+                name.startswith('port') and name[4:] in ('0', '1', '2'):
+            port = int(name[4:])
+            if port == 2:
+                merge_bits(changes, option_registers[option], 0xFFFF, value)
+            else:
+                merge_bits(changes, option_registers[option],
+                           0xFF << (port * 8), value << (port * 8))
+        elif sep and option in option_registers and \
+                name.startswith('pin') and name[3:].isdigit() and \
+                1 <= int(name[3:]) <= 16:
+            bit = 1 << (int(name[3:]) - 1)
+            merge_bits(changes, option_registers[option], bit,
+                       bit if value else 0)
+        else:
+            cmd.error_message("Profile setting not recognised: " + str(key))
+            sys.exit(2)
+    target = dict(current)
+    for reg, (mask, bits) in changes.items():
+        target[reg] = (target[reg] & ~mask) | bits
+    return target
+
+
+def run_apply(source, argv, dry_run=False):
+    """
+    Set the boards in a profile file to the profile with the fewest writes.
+    If addresses are selected only those boards are set.  Prints the writes
+    and the number of I2C transactions used for each board as JSON, without
+    writing anything if dry_run is True.
+    """
+    import json
+    cmd = parse(argv, target=False)
+    try:
+        profile = load_profile(source)
+    except (IOError, ValueError) as err:
+        cmd.error_message("Could not read profile: " + str(err))
+        sys.exit(2)
+
+    results = {}
+    for key in sorted(profile):
+        address = cmd.num(str(key))
+        if address < 0x20 or address > 0x27:
+            cmd.error_message('Address out of range - 0x20 to 0x27.')
+            sys.exit(2)
+        if cmd.params['addresses'] and address not in cmd.params['addresses']:
+            continue
+        # the transactions of this board are counted on their own.  The
+        # device is not initialised so a dry run writes nothing and IOCON
+        # is only written when the profile changes it.
+        bus = InstrumentedBus(MCP23017.get_shared_bus())
+        device = MCP23017(address, bus=bus, init=False)
+        current = device.read_config()
+        target = profile_target(cmd, profile[key], current)
+        runs = device.plan_config(target, current)
+        if not dry_run and runs:
+            device.write_config(target, current)
+        transactions = bus.transactions
+        if dry_run and runs:
+            # the writes write_config would make, in one call when combined
+            transactions += 1 if device.combined_transfers() else len(runs)
+        writes = []
+        for reg, values in runs:
+            writes.append(MCP23017.register_name(reg) + "=" + ",".join(
+                [cmd.format_number(value) for value in values]))
+        results['0x{0:02x}'.format(address)] = {
+            "writes": writes, "transactions": transactions}
+    print(json.dumps(results, sort_keys=True))
+
+
+def write_statistics(stream=None):
+    """
+    Write the transaction statistics of each instrumented bus to stderr
+    """
+    stream = stream or sys.stderr
+    for key, bus in sorted(MCP23017.get_shared_buses().items()):
+        if isinstance(bus, InstrumentedBus):
+            stream.write("bus " + str(key[1]) + " " + bus.summary() + "\n")
+
+
+# options that select how the program runs, with or without an argument
+mode_options = ('serve', 'client', 'batch', 'sample', 'watch', 'dump',
+                'restore', 'apply', 'sequence', 'record', 'replay',
+                'analyse', 'poll', 'count', 'export', 'rules')
+# options shared by the modes that take an argument
+setting_options = ('socket', 'rate', 'samples', 'format', 'intfd',
+                   'intline', 'bus', 'backend', 'loops', 'size', 'from',
+                   'to', 'debounce')
+# options shared by the modes without an argument
+flag_options = ('stats', 'dry-run', 'interrupts', 'lock', 'shared-cache')
+
+
+def split_mode_options(argv):
+    """
+    Remove the mode and setting options from the arguments, exiting with
+    an error if more than one mode is given
+    returns the mode, the mode argument, a dictionary of settings and the
+    remaining arguments
+    """
+    mode = None
+    mode_arg = None
+    settings = {}
+    remaining = []
+    args = iter(argv)
+    for arg in args:
+        name, sep, value = arg[2:].partition('=')
+        if arg.startswith('--') and name in mode_options:
+            if mode is not None:
+                Command.error_message("Only one of --" + mode + " and --" +
+                                      name + " can be used.")
+                sys.exit(2)
+            mode = name
+            mode_arg = value if sep else None
+        elif arg.startswith('--') and name in setting_options:
+            settings[name] = value if sep else next(args, None)
+        elif arg.startswith('--') and name in flag_options and not sep:
+            settings[name] = True
+        else:
+            remaining.append(arg)
+    return mode, mode_arg, settings, remaining
+
+
+def main(argv):
+    """
+    Main function.
+    """
+    mode, mode_arg, settings, argv = split_mode_options(argv)
+    buses = []
+    if settings.get('bus') is not None:
+        try:
+            buses = [int(number) for number in settings['bus'].split(',')]
+        except ValueError:
+            Command.error_message("Error parsing bus number: " +
+                                  str(settings['bus']))
+            sys.exit(2)
+        if len(buses) > 1 and mode not in ('poll', 'export'):
+            Command.error_message("Several buses can only be used with "
+                                  "--poll or --export.")
+            sys.exit(2)
+        MCP23017.bus_number = buses[0]
+    if settings.get('backend') is not None:
+        if settings['backend'] not in MCP23017.backends:
+            Command.error_message("Backend must be one of: " +
+                                  ", ".join(MCP23017.backends))
+            sys.exit(2)
+        MCP23017.backend = settings['backend']
+    MCP23017.locking = settings.get('lock', False)
+    MCP23017.shared_cache = settings.get('shared-cache', False)
+    if settings.get('stats') and mode == 'client':
+        argv = ['--stats'] + argv
+    elif settings.get('stats'):
+        MCP23017.instrument = True
+    try:
+        if mode == 'serve':
+            Service(settings.get('socket')).serve()
+        elif mode == 'client':
+            Service(settings.get('socket')).request(argv)
+        elif mode == 'batch':
+            sys.exit(run_batch(mode_arg))
+        elif mode == 'sample':
+            run_sample(argv, settings)
+        elif mode == 'watch':
+            run_watch(argv, settings)
+        elif mode == 'count':
+            run_count(argv, settings)
+        elif mode == 'poll':
+            run_poll(argv, settings, buses or [MCP23017.get_bus_number()])
+        elif mode == 'export':
+            run_export(mode_arg, argv, settings,
+                       buses or [MCP23017.get_bus_number()])
+        elif mode == 'dump':
+            run_dump(argv)
+        elif mode == 'restore':
+            if not mode_arg:
+                Command.error_message("Please give a file to restore.")
+                sys.exit(2)
+            run_restore(mode_arg, argv)
+        elif mode == 'apply':
+            if not mode_arg:
+                Command.error_message("Please give a profile to apply.")
+                sys.exit(2)
+            run_apply(mode_arg, argv, settings.get('dry-run', False))
+        elif mode == 'rules':
+            if not mode_arg:
+                Command.error_message("Please give a rules file.")
+                sys.exit(2)
+            run_rules(mode_arg, argv, settings)
+        elif mode == 'sequence':
+            if not mode_arg:
+                Command.error_message("Please give a sequence to play.")
+                sys.exit(2)
+            run_sequence(mode_arg, argv, settings)
+        elif mode in ('record', 'replay', 'analyse'):
+            if not mode_arg:
+                Command.error_message("Please give a capture file.")
+                sys.exit(2)
+            if mode == 'record':
+                run_record(mode_arg, argv, settings)
+            elif mode == 'analyse':
+                run_analyse(mode_arg, argv, settings)
+            else:
+                run_replay(mode_arg, argv, settings)
+        else:
+            run(argv)
+    finally:
+        if MCP23017.instrument:
+            write_statistics()
+
+
 if __name__ == "__main__":
     main(sys.argv[1:])
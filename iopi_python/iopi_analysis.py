@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi sample analysis
+
+Requires NumPy
+================================================
+
+Per pin statistics for a block of port readings: the number of
+transitions, the fraction of time each pin is high, pulse widths, a
+frequency estimate and glitches shorter than a debounce time.
+
+Readings are 8 or 16 bit port values with port A in the low byte and a
+time in seconds for each.  All pins are unpacked at once with
+numpy.unpackbits so a million readings take a fraction of a second.
+load_samples reads capture files from iopi_record and the binary output
+of sample mode.
+"""
+
+import numpy as np
+
+# binary sample mode record, time and 16 bit value
+SAMPLE_DTYPE = np.dtype([('time', '<f8'), ('value', '<u2')])
+
+
+def load_samples(path):
+    """
+    Read the readings from a capture file made with --record or from the
+    output of --sample --format=binary
+    returns arrays of the times and 16 bit values
+    """
+    with open(path, 'rb') as sample_file:
+        magic = sample_file.read(4)
+    import iopi_record
+    if magic != iopi_record.MAGIC:
+        samples = np.fromfile(path, dtype=SAMPLE_DTYPE)
+        return samples['time'], samples['value']
+
+    capture = iopi_record.CaptureFile(path, writable=False)
+    try:
+        names = ['time', 'value', 'intf', 'intcap']
+        formats = ['<f8', '<u2', '<u2', '<u2']
+        fields = 4 if capture.interrupts else 2
+        records = np.frombuffer(capture.map, dtype=np.dtype(
+            {'names': names[:fields], 'formats': formats[:fields]}),
+            count=capture.capacity, offset=capture.records_offset)
+        count = capture.count
+        if count <= capture.capacity:
+            records = records[:count]
+        else:
+            # oldest record first
+            first = count % capture.capacity
+            records = np.concatenate((records[first:], records[:first]))
+        # copy the values out of the mapped file and drop every view of
+        # it, the map can not be closed while a view exists
+        times = np.array(records['time'], copy=True)
+        values = np.array(records['value'], copy=True)
+        del records
+    finally:
+        capture.close()
+    return times, values
+
+
+def unpack_pins(values, bits=16):
+    """
+    Split port readings into one column for each pin
+    values = array of 8 or 16 bit readings, port A in the low byte
+    bits = 8 or 16
+    returns an array of 0 and 1 with a row for each reading, column 0 is
+    pin 1
+    """
+    values = np.ascontiguousarray(values, dtype='<u2' if bits == 16
+                                  else np.uint8)
+    return np.unpackbits(values.view(np.uint8).reshape(len(values), -1),
+                         axis=1, bitorder='little')
+
+
+def debounce_pins(times, pins, hold):
+    """
+    Remove pulses shorter than hold seconds from unpacked pin readings,
+    the pin keeps its previous state during a removed pulse
+    times = array of reading times in seconds
+    pins = array from unpack_pins
+    returns an array of the debounced pin states
+    """
+    count = len(times)
+    debounced = np.empty_like(pins)
+    for pin in range(pins.shape[1]):
+        column = pins[:, pin]
+        # runs of readings with the same state
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(column)) + 1))
+        ends = np.concatenate((starts[1:], [count]))
+        durations = times[np.minimum(ends, count - 1)] - times[starts]
+        keep = durations >= hold
+        keep[0] = True
+        # each removed run takes the state of the last kept run
+        kept = np.maximum.accumulate(
+            np.where(keep, np.arange(len(starts)), 0))
+        debounced[:, pin] = np.repeat(column[starts][kept], ends - starts)
+    return debounced
+
+
+def debounce(times, values, hold, bits=16):
+    """
+    Remove pulses shorter than hold seconds from port readings
+    times = array of reading times in seconds
+    values = array of 8 or 16 bit readings, port A in the low byte
+    hold = shortest pulse in seconds that is kept
+    bits = 8 or 16
+    returns an array of the debounced readings
+    """
+    times = np.asarray(times, dtype=float)
+    packed = np.packbits(debounce_pins(times, unpack_pins(values, bits),
+                                       hold), axis=1, bitorder='little')
+    return packed.view('<u2' if bits == 16 else np.uint8).ravel()
+
+
+def analyse(times, values, bits=16, hold=0.0):
+    """
+    Work out per pin statistics for port readings
+    times = array of reading times in seconds, in order
+    values = array of 8 or 16 bit readings, port A in the low byte
+    bits = 8 or 16
+    hold = debounce time in seconds, pulses shorter than this are counted
+    as glitches and removed from the debounced state
+    returns a list with a dictionary for each pin: the pin number, the
+    number of transitions, rising and falling edges, the fraction of time
+    high, the frequency of rising edges in Hz, the shortest and longest
+    complete high and low pulses in seconds (None if there are none),
+    glitches, transitions after debouncing and the last debounced state
+    """
+    times = np.asarray(times, dtype=float)
+    if len(times) < 2 or len(times) != len(values):
+        raise ValueError('need at least two readings with a time for each')
+    pins = unpack_pins(values, bits)
+    change = np.diff(pins.astype(np.int8), axis=0)
+    rising = np.count_nonzero(change == 1, axis=0)
+    falling = np.count_nonzero(change == -1, axis=0)
+    duration = times[-1] - times[0]
+    # each reading holds until the next one
+    high_time = np.diff(times).dot(pins[:-1])
+    debounced = debounce_pins(times, pins, hold)
+    debounced_transitions = np.count_nonzero(np.diff(debounced, axis=0),
+                                             axis=0)
+
+    results = []
+    for pin in range(bits):
+        edges = np.flatnonzero(change[:, pin]) + 1
+        # complete pulses lie between two edges
+        widths = np.diff(times[edges])
+        states = pins[edges[:-1], pin]
+        high = widths[states == 1]
+        low = widths[states == 0]
+        rises = edges[change[edges - 1, pin] == 1]
+        frequency = 0.0
+        if len(rises) > 1 and times[rises[-1]] > times[rises[0]]:
+            frequency = (len(rises) - 1) / (times[rises[-1]] -
+                                            times[rises[0]])
+        results.append({
+            'pin': pin + 1,
+            'transitions': int(rising[pin] + falling[pin]),
+            'rising': int(rising[pin]),
+            'falling': int(falling[pin]),
+            'high_ratio': float(high_time[pin] / duration) if duration
+            else float(pins[0, pin]),
+            'frequency': float(frequency),
+            'min_high': float(high.min()) if len(high) else None,
+            'max_high': float(high.max()) if len(high) else None,
+            'min_low': float(low.min()) if len(low) else None,
+            'max_low': float(low.max()) if len(low) else None,
+            'glitches': int(np.count_nonzero(widths < hold)),
+            'debounced_transitions': int(debounced_transitions[pin]),
+            'state': int(debounced[-1, pin])
+        })
+    return results
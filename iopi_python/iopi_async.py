@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi 32-Channel Port Expander asyncio interface
+
+Requires Python 3.7 or newer and python smbus
+================================================
+
+AsyncMCP23017 wraps an MCP23017 object so each method can be awaited from
+an asyncio application without blocking the event loop.
+
+All transfers for one I2C bus run in order on a single worker thread that
+is shared by every AsyncMCP23017 using that bus.  When several tasks read
+the same register while a read is already waiting to run they share the
+result of that read rather than each adding a transfer.
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from iopi import MCP23017
+
+__executors = {}
+__executors_lock = threading.Lock()
+
+
+def bus_executor(bus):
+    """
+    Get the single thread executor that runs all transfers for an smbus
+    object, creating it on first use
+    """
+    with __executors_lock:
+        key = id(bus)
+        if key not in __executors:
+            __executors[key] = ThreadPoolExecutor(max_workers=1)
+        return __executors[key]
+
+
+class AsyncMCP23017(object):
+    """
+    Awaitable versions of the MCP23017 methods.
+    wait_for_change is not included as it would hold the bus worker thread
+    while waiting, use read_int_changes after waiting on the INT line with
+    the event loop instead.
+    """
+
+    def __init__(self, address, cache=False, device=None):
+        """
+        init object with i2c address, default is 0x20, 0x21 for IOPi board
+        device = an existing MCP23017 to wrap instead of creating one
+        """
+        self.device = device
+        if self.device is None:
+            self.device = MCP23017(address, cache)
+        self.executor = bus_executor(self.device.get_bus())
+        # reads waiting to run, keyed by method name and arguments
+        self.__pending = {}
+
+    def __submit(self, name, *args):
+        """
+        internal method for queueing a method call on the bus worker thread
+        """
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self.executor, functools.partial(getattr(self.device, name),
+                                             *args))
+
+    async def __read(self, name, *args):
+        """
+        internal method for a read that can be shared with identical reads
+        that are still waiting to run
+        """
+        key = (name,) + args
+        future = self.__pending.get(key)
+        if future is None:
+            future = self.__submit(name, *args)
+            self.__pending[key] = future
+
+            def done(finished):
+                if self.__pending.get(key) is finished:
+                    del self.__pending[key]
+            future.add_done_callback(done)
+        # shield so a cancelled task does not cancel the read for the others
+        return await asyncio.shield(future)
+
+    async def __write(self, name, *args):
+        """
+        internal method for a write, reads queued after a write must not
+        share a result read before it
+        """
+        self.__pending.clear()
+        return await self.__submit(name, *args)
+
+    async def set_direction(self, target, value, is_pin=False):
+        """
+        set IO value for a pin or port
+        """
+        return await self.__write('set_direction', target, value, is_pin)
+
+    async def set_pullup(self, target, value, is_pin=False):
+        """
+        set the internal 100K pull-up resistors for a pin or port
+        """
+        return await self.__write('set_pullup', target, value, is_pin)
+
+    async def write(self, target, value, is_pin=False):
+        """
+        write to a pin or port
+        """
+        return await self.__write('write', target, value, is_pin)
+
+    async def read(self, target, is_pin=False):
+        """
+        read a pin or port
+        """
+        return await self.__read('read', target, is_pin)
+
+    async def invert(self, target, value, is_pin=False):
+        """
+        invert the polarity of a pin or port
+        """
+        return await self.__write('invert', target, value, is_pin)
+
+    async def mirror_interrupts(self, value):
+        """
+        1 = The INT pins are internally connected, 0 = not connected
+        """
+        return await self.__write('mirror_interrupts', value)
+
+    async def set_interrupt_polarity(self, value):
+        """
+        set the polarity of the INT output pins, 1 = Active-high,
+        0 = Active-low
+        """
+        return await self.__write('set_interrupt_polarity', value)
+
+    async def set_interrupt_type(self, target, value, is_pin=False):
+        """
+        set the type of interrupt for a pin or port
+        """
+        return await self.__write('set_interrupt_type', target, value,
+                                  is_pin)
+
+    async def set_interrupt_defaults(self, target, value, is_pin=False):
+        """
+        set the interrupt compare value for a pin or port
+        """
+        return await self.__write('set_interrupt_defaults', target, value,
+                                  is_pin)
+
+    async def set_interrupt(self, target, value, is_pin=False):
+        """
+        enable interrupts for a pin or port
+        """
+        return await self.__write('set_interrupt', target, value, is_pin)
+
+    async def read_int_status(self, target, is_pin=False):
+        """
+        read the interrupt status for a pin or port
+        """
+        return await self.__read('read_int_status', target, is_pin)
+
+    async def read_int_capture(self, target, is_pin=False):
+        """
+        read the value of a pin or port at the time of the last interrupt
+        """
+        return await self.__read('read_int_capture', target, is_pin)
+
+    async def read_int_changes(self):
+        """
+        read the pins that caused the interrupt and their captured values
+        """
+        return await self.__read('read_int_changes')
+
+    async def reset_interrupts(self):
+        """
+        Reset the interrupts A and B to 0
+        """
+        return await self.__write('reset_interrupts')
+
+    async def set_direction_word(self, value):
+        """
+        set the direction of all 16 pins with one write
+        """
+        return await self.__write('set_direction_word', value)
+
+    async def set_pullup_word(self, value):
+        """
+        set the pull-up resistors of all 16 pins with one write
+        """
+        return await self.__write('set_pullup_word', value)
+
+    async def write_word(self, value):
+        """
+        write to all 16 pins with one write
+        """
+        return await self.__write('write_word', value)
+
+    async def read_word(self):
+        """
+        read all 16 pins with one read
+        """
+        return await self.__read('read_word')
+
+    async def set_direction_pins(self, pins):
+        """
+        set the direction of several pins with one write per port
+        """
+        return await self.__write('set_direction_pins', pins)
+
+    async def set_pullup_pins(self, pins):
+        """
+        set the pull-up resistors of several pins with one write per port
+        """
+        return await self.__write('set_pullup_pins', pins)
+
+    async def write_pins(self, pins):
+        """
+        write to several pins with one write per port
+        """
+        return await self.__write('write_pins', pins)
+
+    async def invert_pins(self, pins):
+        """
+        invert the polarity of several pins with one write per port
+        """
+        return await self.__write('invert_pins', pins)
+
+    async def set_interrupt_pins(self, pins):
+        """
+        enable interrupts for several pins with one write per port
+        """
+        return await self.__write('set_interrupt_pins', pins)
+
+    async def set_interrupt_type_pins(self, pins):
+        """
+        set the interrupt type for several pins with one write per port
+        """
+        return await self.__write('set_interrupt_type_pins', pins)
+
+    async def set_interrupt_defaults_pins(self, pins):
+        """
+        set the interrupt compare value for several pins with one write per
+        port
+        """
+        return await self.__write('set_interrupt_defaults_pins', pins)
+
+    async def read_pins(self, pins):
+        """
+        read several pins with one read per port
+        """
+        return await self.__read('read_pins', tuple(pins))
+
+    async def read_int_status_pins(self, pins):
+        """
+        read the interrupt status of several pins with one read per port
+        """
+        return await self.__read('read_int_status_pins', tuple(pins))
+
+    async def read_int_capture_pins(self, pins):
+        """
+        read the interrupt capture value of several pins with one read per
+        port
+        """
+        return await self.__read('read_int_capture_pins', tuple(pins))
+
+    async def refresh(self):
+        """
+        Reload the register cache from the device
+        """
+        return await self.__write('refresh')
+
+    async def invalidate(self, reg=None):
+        """
+        Mark cached registers as stale
+        """
+        return await self.__write('invalidate', reg)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi 32-Channel Port Expander pulse counter
+
+Requires python smbus
+================================================
+
+PulseCounter counts the rising and falling edges on input pins of an
+MCP23017 from a background thread, for flow meters, encoders and other
+pulse outputs that change too quickly to be seen by reading the pins.
+
+The pins are set to interrupt on change so the chip latches the first
+edge on a port in INTF and the port value at that moment in INTCAP.  Each
+interrupt costs one read of INTFA to INTCAPB: a combined transfer on
+buses that support them, otherwise IOCON.SEQOP is cleared while counting
+so the four registers can be read as one block.  The captured port value
+is compared with the last known level of every counted pin on the port,
+so pins that changed while the interrupt was waiting to be cleared are
+still counted.  A flagged pin captured at its last known level has made
+two edges in between, the first of which is added as a missed edge.
+"""
+
+import threading
+
+from iopi import MCP23017, merge_bits, monotonic
+
+
+class PulseCounter(object):
+    """
+    Edge counter on the input pins of an MCP23017.
+    The device should not be used by other threads while counting, and
+    the pins should be set as inputs first.
+    """
+
+    def __init__(self, device, pins=range(1, 17), poll_interval=0.001):
+        """
+        device = MCP23017 with the counted pins set as inputs
+        pins = pin numbers 1 to 16 to count
+        poll_interval = seconds between reads of the interrupt flags when
+        no interrupt line has been set with set_interrupt_line
+        """
+        self.device = device
+        self.pins = sorted(pins)
+        for pin in self.pins:
+            if pin < 1 or pin > 16:
+                raise ValueError('pin out of range: 1 to 16')
+        self.poll_interval = poll_interval
+        self.__mask = 0
+        for pin in self.pins:
+            self.__mask |= 1 << (pin - 1)
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__stop = threading.Event()
+        self.__restore = {}
+        self.__sequential = False
+        self.__levels = 0
+        self.__rising = dict((pin, 0) for pin in self.pins)
+        self.__falling = dict((pin, 0) for pin in self.pins)
+        self.__last = None
+        self.events = 0
+        self.missed = 0
+        self.error = None  # bus error that stopped the counting thread
+        self.__started = None
+
+    def __count(self, flags, capture):
+        """
+        internal method for counting the edges in one interrupt
+        returns the number of edges counted
+        """
+        ports = 0
+        if flags & 0xFF:
+            ports |= 0xFF
+        if flags & 0xFF00:
+            ports |= 0xFF00
+        changed = (capture ^ self.__levels) & ports & self.__mask
+        doubled = flags & ~changed & self.__mask
+        edges = 0
+        with self.__lock:
+            for pin in self.pins:
+                bit = 1 << (pin - 1)
+                if doubled & bit:
+                    # the edge away from the captured level was missed
+                    if capture & bit:
+                        self.__falling[pin] += 1
+                    else:
+                        self.__rising[pin] += 1
+                    self.missed += 1
+                    edges += 1
+                if (changed | doubled) & bit:
+                    if capture & bit:
+                        self.__rising[pin] += 1
+                    else:
+                        self.__falling[pin] += 1
+                    edges += 1
+            self.__levels = (self.__levels & ~ports) | (capture & ports)
+            self.events += 1
+        return edges
+
+    def start(self):
+        """
+        Enable interrupt on change for the pins, read their levels and
+        start the counting thread
+        """
+        if self.__thread is not None:
+            return
+        config = self.device.read_config()
+        changes = {}
+        merge_bits(changes, MCP23017.INTCONA, self.__mask, 0)
+        merge_bits(changes, MCP23017.GPINTENA, self.__mask, self.__mask)
+        self.__restore = {}
+        for reg in (MCP23017.INTCONA, MCP23017.GPINTENA):
+            merge_bits(self.__restore, reg, self.__mask,
+                       config[reg] | (config[reg + 1] << 8))
+        self.__sequential = not self.device.combined_transfers()
+        if self.__sequential:
+            changes[MCP23017.IOCON] = (MCP23017.SEQOP, 0)
+            self.__restore[MCP23017.IOCON] = (
+                MCP23017.SEQOP, config[MCP23017.IOCON] & MCP23017.SEQOP)
+        # reading GPIO clears any interrupt from before counting started
+        gpio = self.device.update(changes, [(MCP23017.GPIOA, 2)])[0]
+        with self.__lock:
+            self.__levels = gpio[0] | (gpio[1] << 8)
+            self.__started = monotonic()
+            self.__last = (self.__started, dict(self.__rising),
+                           dict(self.__falling))
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self):
+        """
+        internal method for the counting thread
+        """
+        try:
+            while not self.__stop.is_set():
+                flags, capture = self.device.wait_for_interrupt(
+                    0.1, self.poll_interval, self.__sequential)
+                if flags:
+                    self.__count(flags, capture)
+        except IOError as err:
+            self.error = err
+
+    def stop(self):
+        """
+        Stop the counting thread and put back the interrupt settings of the
+        pins and IOCON.SEQOP
+        """
+        if self.__thread is None:
+            return
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+        if self.error is None:
+            self.device.update(self.__restore)
+
+    def counts(self):
+        """
+        Get the edges counted on each pin since counting started
+        returns a dictionary of (rising, falling) keyed by pin number
+        """
+        with self.__lock:
+            return dict((pin, (self.__rising[pin], self.__falling[pin]))
+                        for pin in self.pins)
+
+    def rates(self):
+        """
+        Get the edges per second on each pin since the last call, or since
+        counting started for the first call.  Raises the bus error that
+        stopped the counting thread if there was one.
+        returns the seconds covered and a dictionary of (rising, falling)
+        rates keyed by pin number
+        """
+        if self.error is not None:
+            raise self.error
+        now = monotonic()
+        with self.__lock:
+            then, rising, falling = self.__last
+            self.__last = (now, dict(self.__rising), dict(self.__falling))
+            current = self.__last
+        seconds = max(now - then, 1e-9)
+        return seconds, dict(
+            (pin, ((current[1][pin] - rising[pin]) / seconds,
+                   (current[2][pin] - falling[pin]) / seconds))
+            for pin in self.pins)
+
+    def statistics(self):
+        """
+        Get the number of interrupts read, the edges counted and inferred
+        as missed, and the interrupts read per second since counting
+        started
+        returns a dictionary
+        """
+        with self.__lock:
+            edges = sum(self.__rising.values()) + \
+                sum(self.__falling.values())
+            events = self.events
+            missed = self.missed
+        elapsed = 0.0
+        if self.__started is not None:
+            elapsed = monotonic() - self.__started
+        return {'events': events,
+                'edges': edges,
+                'missed': missed,
+                'seconds': elapsed,
+                'event_rate': events / elapsed if elapsed > 0 else 0.0}
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi 32-Channel Port Expander metrics exporter
+
+Requires python smbus
+================================================
+
+Exporter serves the pin states and interrupt flags of several IO Pi boards
+over HTTP, as Prometheus text on /metrics and as JSON on /json, together
+with the I2C bus statistics and the time taken to answer each request.
+
+The boards are read by a background thread every interval through a
+Poller, so boards on different buses are read at the same time, and the
+readings are kept in a cache.  Requests are answered from the cache and
+only read the boards themselves when the cache is older than the
+interval, for example when the background thread has been held up, with
+one request reading while the others wait for its result.  However many
+scrapers there are, each board is read at most once per interval.
+
+Each reading takes INTF before GPIO, as reading GPIO clears the interrupt,
+so the flags show the pins that triggered an interrupt since the previous
+reading.
+"""
+
+import json
+import threading
+
+from iopi import MCP23017, monotonic
+
+
+class Exporter(object):
+    """
+    Cached pin states of several boards with an HTTP server to export them
+    """
+
+    # upper limits of the request latency histogram buckets in seconds
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1)
+
+    def __init__(self, poller, interval=1.0):
+        """
+        poller = Poller for the boards to read, the statistics of buses
+        wrapped in an InstrumentedBus are exported
+        interval = seconds between readings of each board
+        """
+        if interval <= 0:
+            raise ValueError('interval must be above 0')
+        self.interval = interval
+        self.poller = poller
+        self.__lock = threading.Lock()  # held while the boards are read
+        self.__stats_lock = threading.Lock()
+        self.__readings = {}
+        self.__read_time = None
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.samples = 0
+        self.errors = 0
+        self.last_error = None
+        self.sample_seconds = 0.0
+        self.requests = {}
+        self.histogram = [0] * (len(self.buckets) + 1)
+        self.request_seconds = 0.0
+
+    def __sample(self):
+        """
+        internal method for reading the flags and pins of every board
+        """
+        start = monotonic()
+        try:
+            results = self.poller.call('update', {}, [(MCP23017.INTFA, 2),
+                                                      (MCP23017.GPIOA, 2)])
+        except IOError as err:
+            # the old readings are kept, with their age showing the failure
+            self.errors += 1
+            self.last_error = str(err)
+            self.__read_time = start
+            return
+        readings = {}
+        for number, values in results.items():
+            readings[number] = {}
+            for address, (stamp, (flags, pins)) in values.items():
+                readings[number][address] = (
+                    stamp, pins[0] | (pins[1] << 8),
+                    flags[0] | (flags[1] << 8))
+        self.__readings = readings
+        self.__read_time = start
+        self.samples += 1
+        self.sample_seconds = monotonic() - start
+        self.last_error = None
+
+    def readings(self):
+        """
+        Get the latest readings, reading the boards first if the cache is
+        older than the interval
+        returns the time of the readings and a dictionary keyed by bus
+        number of dictionaries keyed by address of (time, pins, flags),
+        times from the monotonic clock
+        """
+        read_time = self.__read_time
+        if read_time is None or monotonic() - read_time >= self.interval:
+            with self.__lock:
+                # another request may have read the boards while waiting
+                if self.__read_time is read_time:
+                    self.__sample()
+        return self.__read_time, self.__readings
+
+    def __run(self):
+        """
+        internal method for the background thread, readings are scheduled
+        from the start time so they do not drift
+        """
+        start = monotonic()
+        count = 0
+        while not self.__stop.wait(max(0.0, start + count * self.interval -
+                                        monotonic())):
+            with self.__lock:
+                if self.__read_time is None or monotonic() - \
+                        self.__read_time >= self.interval / 2:
+                    self.__sample()
+            count += 1
+            behind = monotonic() - (start + count * self.interval)
+            if behind > 0:
+                count += int(behind / self.interval) + 1
+
+    def start(self):
+        """
+        Start the background thread
+        """
+        if self.__thread is not None:
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and the poller
+        """
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+        self.poller.close()
+
+    def buses(self):
+        """
+        Get the instrumented bus objects of the poller
+        returns a list of (bus number, bus) sorted by bus number
+        """
+        buses = []
+        for number in sorted(self.poller.groups):
+            devices = self.poller.groups[number].devices
+            if devices:
+                bus = devices[min(devices)].get_bus()
+                if hasattr(bus, 'histogram'):
+                    buses.append((number, bus))
+        return buses
+
+    def record_request(self, path, seconds):
+        """
+        Add the time taken to answer a request to the latency metrics
+        """
+        bucket = 0
+        while bucket < len(self.buckets) and seconds > self.buckets[bucket]:
+            bucket += 1
+        with self.__stats_lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            self.histogram[bucket] += 1
+            self.request_seconds += seconds
+
+    def as_json(self):
+        """
+        Describe the readings and statistics as JSON
+        """
+        read_time, readings = self.readings()
+        now = monotonic()
+        boards = {}
+        for number in sorted(readings):
+            boards[str(number)] = dict(
+                ('0x{0:02x}'.format(address),
+                 {"pins": pins, "flags": flags, "age": now - stamp})
+                for address, (stamp, pins, flags)
+                in readings[number].items())
+        with self.__stats_lock:
+            requests = {"count": dict(self.requests),
+                        "seconds": self.request_seconds}
+        return json.dumps({
+            "boards": boards, "interval": self.interval,
+            "samples": self.samples, "errors": self.errors,
+            "last_error": self.last_error,
+            "sample_seconds": self.sample_seconds,
+            "buses": dict((str(number), bus.snapshot())
+                          for number, bus in self.buses()),
+            "requests": requests}, sort_keys=True)
+
+    def as_prometheus(self):
+        """
+        Describe the readings and statistics in the Prometheus text format
+        """
+        read_time, readings = self.readings()
+        now = monotonic()
+        lines = []
+
+        def metric(name, kind, text, samples):
+            lines.append('# HELP ' + name + ' ' + text)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for labels, value in samples:
+                label_text = ''
+                if labels:
+                    label_text = '{' + ','.join(
+                        [key + '="' + str(val) + '"'
+                         for key, val in labels]) + '}'
+                lines.append(name + label_text + ' ' + repr(value))
+
+        boards = []
+        for number in sorted(readings):
+            for address in sorted(readings[number]):
+                labels = [('bus', number),
+                          ('address', '0x{0:02x}'.format(address))]
+                boards.append((labels, readings[number][address]))
+        metric('iopi_pin_state', 'gauge', 'Logic level of each pin.',
+               [(labels + [('pin', bit + 1)], (pins >> bit) & 1)
+                for labels, (stamp, pins, flags) in boards
+                for bit in range(16)])
+        metric('iopi_interrupt_flag', 'gauge',
+               'Pins that triggered an interrupt since the previous '
+               'reading.',
+               [(labels + [('pin', bit + 1)], (flags >> bit) & 1)
+                for labels, (stamp, pins, flags) in boards
+                for bit in range(16)])
+        metric('iopi_reading_age_seconds', 'gauge',
+               'Seconds since each board was read.',
+               [(labels, now - stamp)
+                for labels, (stamp, pins, flags) in boards])
+        metric('iopi_samples_total', 'counter',
+               'Readings of every board.', [([], self.samples)])
+        metric('iopi_sample_errors_total', 'counter',
+               'Readings that failed with a bus error.',
+               [([], self.errors)])
+        metric('iopi_sample_duration_seconds', 'gauge',
+               'Seconds taken by the last reading of every board.',
+               [([], self.sample_seconds)])
+
+        buses = self.buses()
+        for name, attribute, text in (
+                ('transactions', 'transactions', 'I2C transactions.'),
+                ('reads', 'reads', 'I2C read transactions.'),
+                ('writes', 'writes', 'I2C write transactions.'),
+                ('errors', 'errors', 'I2C transactions that failed.')):
+            metric('iopi_bus_' + name + '_total', 'counter', text,
+                   [([('bus', number)], getattr(bus, attribute))
+                    for number, bus in buses])
+        lines.append('# HELP iopi_bus_transaction_seconds Time taken by '
+                     'each I2C transaction.')
+        lines.append('# TYPE iopi_bus_transaction_seconds histogram')
+        for number, bus in buses:
+            label = 'bus="' + str(number) + '"'
+            total = 0
+            for limit, count in zip(bus.buckets, bus.histogram):
+                total += count
+                lines.append('iopi_bus_transaction_seconds_bucket{' + label +
+                             ',le="' + repr(limit / 1000000.0) + '"} ' +
+                             str(total))
+            lines.append('iopi_bus_transaction_seconds_bucket{' + label +
+                         ',le="+Inf"} ' + str(bus.transactions))
+            lines.append('iopi_bus_transaction_seconds_sum{' + label + '} ' +
+                         repr(bus.seconds))
+            lines.append('iopi_bus_transaction_seconds_count{' + label +
+                         '} ' + str(bus.transactions))
+
+        with self.__stats_lock:
+            requests = dict(self.requests)
+            histogram = list(self.histogram)
+            request_seconds = self.request_seconds
+        metric('iopi_http_requests_total', 'counter',
+               'HTTP requests answered by path.',
+               [([('path', path)], count)
+                for path, count in sorted(requests.items())])
+        lines.append('# HELP iopi_http_request_duration_seconds Time taken '
+                     'to answer each HTTP request.')
+        lines.append('# TYPE iopi_http_request_duration_seconds histogram')
+        total = 0
+        for limit, count in zip(self.buckets, histogram):
+            total += count
+            lines.append('iopi_http_request_duration_seconds_bucket{le="' +
+                         repr(limit) + '"} ' + str(total))
+        lines.append('iopi_http_request_duration_seconds_bucket{le="+Inf"} ' +
+                     str(sum(histogram)))
+        lines.append('iopi_http_request_duration_seconds_sum ' +
+                     repr(request_seconds))
+        lines.append('iopi_http_request_duration_seconds_count ' +
+                     str(sum(histogram)))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host='127.0.0.1', port=9400):
+        """
+        Start the background thread and answer HTTP requests until
+        interrupted
+        """
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+            Answer GET /metrics and GET /json from the exporter
+            """
+
+            def do_GET(self):
+                start = monotonic()
+                path = self.path.partition('?')[0]
+                if path == '/metrics':
+                    body = exporter.as_prometheus()
+                    kind = 'text/plain; version=0.0.4'
+                elif path == '/json':
+                    body = exporter.as_json()
+                    kind = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                exporter.record_request(path, monotonic() - start)
+
+            def log_message(self, format, *args):
+                return
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        server = Server((host, port), Handler)
+        self.start()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stop()
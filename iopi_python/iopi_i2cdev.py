@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi i2c-dev bus
+
+Talks to /dev/i2c-N directly with the I2C_RDWR ioctl so python-smbus is not
+needed and several register transfers can be combined into one call.
+================================================
+
+I2CDevBus has the smbus methods used by MCP23017 plus read_runs and
+write_runs, which move any number of register runs in a single ioctl using
+repeated start conditions between the messages.  MCP23017 uses these to
+read or write a block of registers in one call.
+"""
+
+import ctypes
+import fcntl
+import os
+
+I2C_RDWR = 0x0707  # combined read/write transfer, from linux/i2c-dev.h
+I2C_M_RD = 0x0001  # message is a read, from linux/i2c.h
+I2C_RDWR_MAX_MSGS = 42  # messages allowed in one I2C_RDWR call
+
+
+class I2CMessage(ctypes.Structure):
+    """
+    struct i2c_msg from linux/i2c.h
+    """
+    _fields_ = [('addr', ctypes.c_uint16),
+                ('flags', ctypes.c_uint16),
+                ('len', ctypes.c_uint16),
+                ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+
+class I2CTransfer(ctypes.Structure):
+    """
+    struct i2c_rdwr_ioctl_data from linux/i2c-dev.h
+    """
+    _fields_ = [('msgs', ctypes.POINTER(I2CMessage)),
+                ('nmsgs', ctypes.c_uint32)]
+
+
+class I2CDevBus(object):
+    """
+    I2C bus using combined transfers on /dev/i2c-N
+    """
+
+    def __init__(self, bus=1):
+        """
+        bus = I2C bus number
+        """
+        self.bus = bus
+        self.name = 'i2c-' + str(bus)
+        self.fd = os.open('/dev/i2c-' + str(bus), os.O_RDWR)
+
+    def __transfer(self, addr, messages):
+        """
+        internal method for sending a list of (data, read length) messages
+        in one ioctl.  data is written when read length is 0.
+        returns the data of the read messages
+        """
+        count = len(messages)
+        msgs = (I2CMessage * count)()
+        buffers = []
+        for i, (data, length) in enumerate(messages):
+            if length:
+                buf = (ctypes.c_uint8 * length)()
+                msgs[i].flags = I2C_M_RD
+                msgs[i].len = length
+            else:
+                buf = (ctypes.c_uint8 * len(data))(*data)
+                msgs[i].flags = 0
+                msgs[i].len = len(data)
+            msgs[i].addr = addr
+            msgs[i].buf = buf
+            buffers.append(buf)
+        request = I2CTransfer(msgs, count)
+        fcntl.ioctl(self.fd, I2C_RDWR, request)
+        return [list(buffers[i]) for i, (data, length) in enumerate(messages)
+                if length]
+
+    def read_runs(self, addr, runs):
+        """
+        Read runs of registers in as few ioctl calls as possible
+        runs = list of (first register, number of bytes)
+        returns a list of byte lists, one for each run
+        """
+        results = []
+        per_call = I2C_RDWR_MAX_MSGS // 2
+        for first in range(0, len(runs), per_call):
+            messages = []
+            for reg, length in runs[first:first + per_call]:
+                messages.append(([reg], 0))
+                messages.append((None, length))
+            results += self.__transfer(addr, messages)
+        return results
+
+    def write_runs(self, addr, runs):
+        """
+        Write runs of registers in as few ioctl calls as possible
+        runs = list of (first register, list of bytes)
+        """
+        for first in range(0, len(runs), I2C_RDWR_MAX_MSGS):
+            self.__transfer(addr, [([reg] + list(values), 0) for reg, values
+                                   in runs[first:first + I2C_RDWR_MAX_MSGS]])
+
+    # smbus compatible methods
+
+    def read_byte(self, addr):
+        return self.__transfer(addr, [(None, 1)])[0][0]
+
+    def write_byte(self, addr, val):
+        self.__transfer(addr, [([val], 0)])
+
+    def read_byte_data(self, addr, cmd):
+        return self.read_runs(addr, [(cmd, 1)])[0][0]
+
+    def write_byte_data(self, addr, cmd, val):
+        self.write_runs(addr, [(cmd, [val])])
+
+    def read_word_data(self, addr, cmd):
+        data = self.read_runs(addr, [(cmd, 2)])[0]
+        return data[0] | (data[1] << 8)
+
+    def write_word_data(self, addr, cmd, val):
+        self.write_runs(addr, [(cmd, [val & 0xFF, (val >> 8) & 0xFF])])
+
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        return self.read_runs(addr, [(cmd, length)])[0]
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        self.write_runs(addr, [(cmd, vals)])
+
+    def close(self):
+        """
+        Close the bus device
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi 32-Channel Port Expander software PWM
+
+Requires python smbus
+================================================
+
+SoftwarePWM drives output pins of an MCP23017 with pulse width modulation
+from a background thread, as the chip has no PWM hardware.
+
+Every pin shares one base frequency.  Each period starts with all the
+pins that have a duty cycle above 0 switched on and each pin is switched
+off when its duty cycle has passed.  Duty cycles are rounded to the
+resolution so pins with the same duty cycle are switched off together,
+and a write only sends the ports that change, as one A/B pair write when
+both do.  A period costs one write plus one for each different duty
+cycle, so dimming 16 LEDs to the same level needs 2 writes per period.
+"""
+
+import threading
+
+from iopi import monotonic, wait_until
+
+
+class SoftwarePWM(object):
+    """
+    Software PWM on the output pins of an MCP23017.
+    The device should not be used by other threads while the PWM runs,
+    and pins that are not set with set_duty keep the output latch value
+    read when the PWM starts.
+    """
+
+    spin = 0.0005  # seconds before each edge spent polling the clock
+
+    def __init__(self, device, frequency=100.0, resolution=64):
+        """
+        device = MCP23017 with the PWM pins set as outputs
+        frequency = base frequency in Hz shared by all pins
+        resolution = number of duty cycle steps in a period
+        """
+        if frequency <= 0 or resolution < 1:
+            raise ValueError('frequency and resolution must be above 0')
+        self.device = device
+        self.period = 1.0 / frequency
+        self.resolution = resolution
+        self.__duties = {}
+        self.__events = [(0.0, 0, [])]
+        self.__base = None
+        self.__value = None
+        self.__thread = None
+        self.__stop = threading.Event()
+        self.__lock = threading.Lock()
+        self.periods = 0
+        self.overruns = 0
+        self.__first = None
+        self.__last = None
+        self.__error_total = {}
+        self.__error_count = {}
+        self.error = None  # bus error that stopped the PWM thread
+
+    def __plan(self):
+        """
+        internal method for working out the writes in each period, a list
+        of (offset in seconds, 16 bit port value, pins switched off)
+        """
+        steps = {}
+        on = 0
+        for pin, duty in self.__duties.items():
+            step = int(round(duty * self.resolution))
+            if step > 0:
+                on |= 1 << (pin - 1)
+            if 0 < step < self.resolution:
+                steps.setdefault(step, []).append(pin)
+        mask = 0
+        for pin in self.__duties:
+            mask |= 1 << (pin - 1)
+        value = (self.__base & ~mask) | on
+        events = [(0.0, value, [])]
+        for step in sorted(steps):
+            for pin in steps[step]:
+                value &= ~(1 << (pin - 1))
+            events.append((step * self.period / self.resolution, value,
+                           sorted(steps[step])))
+        self.__events = events
+
+    def set_duty(self, pin, duty):
+        """
+        Set the duty cycle of a pin
+        pin = 1 to 16
+        duty = 0.0 to 1.0, the fraction of each period the pin is high
+        """
+        self.set_duties({pin: duty})
+
+    def set_duties(self, duties):
+        """
+        Set the duty cycle of several pins, taking effect together at the
+        start of the next period
+        duties = dictionary of pin number 1 to 16 and duty cycle 0.0 to 1.0
+        """
+        for pin, duty in duties.items():
+            if pin < 1 or pin > 16:
+                raise ValueError('pin out of range: 1 to 16')
+            if duty < 0 or duty > 1:
+                raise ValueError('duty cycle out of range: 0.0 to 1.0')
+        with self.__lock:
+            self.__duties.update(duties)
+            if self.__base is not None:
+                self.__plan()
+
+    def __write(self, value):
+        """
+        internal method for writing the ports that change
+        """
+        changed = 0xFFFF
+        if self.__value is not None:
+            changed = value ^ self.__value
+        if changed & 0xFF and changed & 0xFF00:
+            self.device.write_word(value)
+        elif changed & 0xFF:
+            self.device.write(0, value & 0xFF)
+        elif changed & 0xFF00:
+            self.device.write(1, (value >> 8) & 0xFF)
+        self.__value = value
+
+    def __run(self):
+        """
+        internal method for the PWM thread, periods are scheduled from the
+        start time so timing errors do not accumulate
+        """
+        start = monotonic()
+        index = 0
+        try:
+            while not self.__stop.is_set():
+                with self.__lock:
+                    events = self.__events
+                    duties = dict(self.__duties)
+                period_start = start + index * self.period
+                times = []
+                for offset, value, pins in events:
+                    wait_until(period_start + offset, self.spin)
+                    times.append(monotonic())
+                    self.__write(value)
+
+                # measured duty cycle of each pin switched off in the period
+                for (offset, value, pins), stamp in zip(events, times):
+                    for pin in pins:
+                        error = abs((stamp - times[0]) / self.period -
+                                    duties[pin])
+                        self.__error_total[pin] = \
+                            self.__error_total.get(pin, 0.0) + error
+                        self.__error_count[pin] = \
+                            self.__error_count.get(pin, 0) + 1
+                if self.__first is None:
+                    self.__first = times[0]
+                self.__last = times[0]
+                self.periods += 1
+
+                index += 1
+                behind = monotonic() - (start + index * self.period)
+                if behind > 0:
+                    missed = int(behind / self.period) + 1
+                    self.overruns += missed
+                    index += missed
+        except IOError as err:
+            self.error = err
+
+    def start(self):
+        """
+        Start the PWM thread.  The output latches are read so pins without
+        a duty cycle keep their value.
+        """
+        if self.__thread is not None:
+            return
+        config = self.device.read_config()
+        with self.__lock:
+            self.__base = config[self.device.OLATA] | \
+                (config[self.device.OLATB] << 8)
+            self.__value = self.__base
+            self.__plan()
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop the PWM thread and leave each pin high if its duty cycle is
+        1.0 and low otherwise, unless a bus error stopped the thread
+        """
+        if self.__thread is None:
+            return
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+        if self.error is not None:
+            return
+        with self.__lock:
+            mask = 0
+            high = 0
+            for pin, duty in self.__duties.items():
+                mask |= 1 << (pin - 1)
+                if duty >= 1:
+                    high |= 1 << (pin - 1)
+            self.__write((self.__base & ~mask) | high)
+
+    def statistics(self):
+        """
+        Get the achieved base frequency, the number of periods run and
+        missed, the mean difference between the set and measured duty
+        cycle of each pin and the bus error that stopped the PWM thread,
+        None if there was none
+        returns a dictionary
+        """
+        frequency = 0.0
+        if self.periods > 1 and self.__last > self.__first:
+            frequency = (self.periods - 1) / (self.__last - self.__first)
+        duty_error = {}
+        for pin, total in self.__error_total.items():
+            duty_error[pin] = total / self.__error_count[pin]
+        return {'frequency': frequency,
+                'target': 1.0 / self.period,
+                'periods': self.periods,
+                'overruns': self.overruns,
+                'writes_per_period': len(self.__events),
+                'duty_error': duty_error,
+                'error': str(self.error) if self.error is not None else None}
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi capture file
+
+Fixed size binary records of pin readings in a memory mapped ring file
+for long logging runs.
+================================================
+
+The file starts with a 64 byte header, followed by a sparse time index
+and then the records.  All values are little-endian.
+
+header: magic 'IOPR', version (uint16), record size (uint16), number of
+record slots (uint64), records written since the file was created
+(uint64), records between index entries (uint64), and the start time of
+the file in seconds since the epoch (double).
+
+index: the time of every index_every'th record slot (double).
+
+record: time in seconds from the start of the file (double) and the 16
+bit pin state (uint16), followed by the 16 bit INTF and INTCAP values when
+interrupts are recorded.
+
+When every slot is used the oldest records are overwritten so the file
+and memory use stay the same size however long the recording runs.  Each
+record is packed straight into the mapped file and the record count in
+the header is updated after it, so a crash loses at most the record
+being written.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b'IOPR'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQQd')
+HEADER_SIZE = 64
+COUNT_OFFSET = 16  # offset of the record count in the header
+INDEX = struct.Struct('<d')
+RECORD = struct.Struct('<dH')
+INTERRUPT_RECORD = struct.Struct('<dHHH')
+
+
+class CaptureFile(object):
+    """
+    Memory mapped ring file of pin readings
+    """
+
+    def __init__(self, path, capacity=1000000, interrupts=False,
+                 index_every=256, writable=True):
+        """
+        Open a capture file, creating it if it does not exist.  An existing
+        file keeps its size and record format and new records are added
+        after the ones already in it.
+        path = file name
+        capacity = number of record slots in a new file
+        interrupts = True records INTF and INTCAP with each reading in a
+        new file
+        index_every = records between time index entries in a new file
+        writable = False opens an existing file for reading
+        """
+        self.path = path
+        self.writable = writable
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if not exists and not writable:
+            raise IOError("Capture file not found: " + path)
+        if not writable:
+            self.file = open(path, 'rb')
+        elif exists:
+            self.file = open(path, 'r+b')
+        else:
+            self.file = open(path, 'w+b')
+        if not exists:
+            self.__create(capacity, interrupts, index_every)
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError("Not a capture file: " + path)
+        (magic, version, record_size, self.capacity, count,
+         self.index_every, self.start) = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a capture file: " + path)
+        if record_size == INTERRUPT_RECORD.size:
+            self.record = INTERRUPT_RECORD
+        elif record_size == RECORD.size:
+            self.record = RECORD
+        else:
+            raise ValueError("Unknown record size in " + path)
+        self.interrupts = self.record is INTERRUPT_RECORD
+        self.records_offset = HEADER_SIZE + INDEX.size * (
+            self.capacity // self.index_every)
+        self.map = mmap.mmap(self.file.fileno(), 0,
+                             access=mmap.ACCESS_WRITE if writable
+                             else mmap.ACCESS_READ)
+        # time of the first record added by this object
+        self.offset = time.time() - self.start
+
+    def __create(self, capacity, interrupts, index_every):
+        """
+        internal method for writing the header of a new file and
+        allocating space for every record
+        """
+        if capacity < 1 or index_every < 1:
+            raise ValueError("Capacity and index interval must be above 0")
+        # whole index intervals so each interval has one index entry
+        capacity = -(-capacity // index_every) * index_every
+        record = INTERRUPT_RECORD if interrupts else RECORD
+        size = (HEADER_SIZE + INDEX.size * (capacity // index_every) +
+                record.size * capacity)
+        self.file.write(HEADER.pack(MAGIC, VERSION, record.size, capacity,
+                                    0, index_every, time.time()).ljust(
+                                        HEADER_SIZE, b'\0'))
+        self.file.truncate(size)
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.file.fileno(), 0, size)
+        self.file.flush()
+        self.file.seek(0)
+
+    @property
+    def count(self):
+        """
+        Number of records written since the file was created
+        """
+        return struct.unpack_from('<Q', self.map, COUNT_OFFSET)[0]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, stamp, value, intf=0, intcap=0):
+        """
+        Add a record, overwriting the oldest record when the file is full
+        stamp = seconds since this object was opened
+        value = 16 bit pin state
+        intf, intcap = interrupt flags and capture, kept when the file
+        records interrupts
+        """
+        count = self.count
+        slot = count % self.capacity
+        stamp += self.offset
+        offset = self.records_offset + slot * self.record.size
+        if self.interrupts:
+            self.record.pack_into(self.map, offset, stamp, value, intf,
+                                  intcap)
+        else:
+            self.record.pack_into(self.map, offset, stamp, value)
+        if slot % self.index_every == 0:
+            INDEX.pack_into(self.map, HEADER_SIZE +
+                            INDEX.size * (slot // self.index_every), stamp)
+        struct.pack_into('<Q', self.map, COUNT_OFFSET, count + 1)
+
+    def __read(self, number):
+        """
+        internal method for reading a record by its number since the file
+        was created
+        """
+        slot = number % self.capacity
+        return self.record.unpack_from(
+            self.map, self.records_offset + slot * self.record.size)
+
+    def seek(self, stamp):
+        """
+        Find the first record at or after a time, using the index to find
+        the interval that holds it
+        stamp = seconds from the start of the file
+        returns the record number
+        """
+        count = self.count
+        first = max(0, count - self.capacity)
+        # binary search of the indexed records still in the file
+        low = -(-first // self.index_every)
+        high = (count - 1) // self.index_every
+        number = first
+        while low <= high:
+            middle = (low + high) // 2
+            slot = (middle * self.index_every) % self.capacity
+            indexed = INDEX.unpack_from(
+                self.map, HEADER_SIZE +
+                INDEX.size * (slot // self.index_every))[0]
+            if indexed < stamp:
+                number = middle * self.index_every
+                low = middle + 1
+            else:
+                high = middle - 1
+        while number < count and self.__read(number)[0] < stamp:
+            number += 1
+        return number
+
+    def records(self, start=None, end=None):
+        """
+        Get the records in time order
+        start, end = seconds from the start of the file to read between
+        returns an iterator of (time, value) or (time, value, intf, intcap)
+        """
+        number = max(0, self.count - self.capacity)
+        if start is not None:
+            number = self.seek(start)
+        while number < self.count:
+            record = self.__read(number)
+            if end is not None and record[0] > end:
+                return
+            yield record
+            number += 1
+
+    def flush(self):
+        """
+        Write the mapped records to the disk
+        """
+        self.map.flush()
+
+    def close(self):
+        """
+        Write the records to the disk and close the file
+        """
+        if self.map is not None:
+            if self.writable:
+                self.map.flush()
+            self.map.close()
+            self.map = None
+            self.file.close()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi 32-Channel Port Expander input rules
+
+Requires python smbus
+================================================
+
+RuleEngine runs actions when input pins of an MCP23017 change: a write
+to an IO Pi pin, a command run in a subprocess or a python callback.
+
+A reader thread waits for interrupt on change on the pins used by the
+rules and reads INTF and INTCAP in one transaction for each interrupt, as
+PulseCounter does.  Each rule has its own debounce time: a change is only
+passed on once the pin has kept its new level for that long, checked
+with one read of GPIO when the time is up.  Confirmed changes are put on
+a queue and a second thread runs the actions of the rules for that pin
+and edge, so a slow action does not hold up reading the inputs.
+
+The reaction latency of each event is measured from the read that
+confirmed the change to the end of its actions.  For pins without a
+debounce time that is the interrupt read; commands are counted as done
+when the process has started.
+"""
+
+import collections
+import os
+import shlex
+import subprocess
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from iopi import MCP23017, merge_bits, monotonic
+
+EDGES = ('rising', 'falling', 'both')
+
+
+def write_action(device, pin, value):
+    """
+    Make an action that sets an output pin with one update of the output
+    latch register, so the interrupt captures of the device are kept
+    device = MCP23017 with the pin set as an output
+    pin = 1 to 16
+    value = 0, 1, 'level' to copy the input level or 'inverse' for the
+    opposite of the input level
+    returns a function taking the input pin, level and edge
+    """
+    if pin < 1 or pin > 16:
+        raise ValueError('pin out of range: 1 to 16')
+    if value not in (0, 1, 'level', 'inverse'):
+        raise ValueError('value must be 0, 1, level or inverse')
+    bit = 1 << (pin - 1)
+
+    def action(input_pin, level, edge):
+        if value == 'level':
+            high = level
+        elif value == 'inverse':
+            high = not level
+        else:
+            high = value
+        changes = {}
+        merge_bits(changes, MCP23017.OLATA, bit, bit if high else 0)
+        device.update(changes)
+    return action
+
+
+def run_action(command):
+    """
+    Make an action that starts a shell command without waiting for it to
+    finish.  The input pin, level and edge are passed in the IOPI_PIN,
+    IOPI_VALUE and IOPI_EDGE environment variables.
+    returns a function taking the input pin, level and edge
+    """
+    processes = []
+
+    def action(input_pin, level, edge):
+        # collect the processes that have finished
+        processes[:] = [process for process in processes
+                        if process.poll() is None]
+        env = dict(os.environ)
+        env.update({'IOPI_PIN': str(input_pin), 'IOPI_VALUE': str(level),
+                    'IOPI_EDGE': edge})
+        processes.append(subprocess.Popen(command, shell=True, env=env))
+    return action
+
+
+def load_rules(path, get_device):
+    """
+    Read rules from a file of 'pin edge debounce action' lines, with #
+    comments.  edge is rising, falling or both, debounce is in seconds and
+    the action is 'write [address:]pin value', with value 0, 1, level or
+    inverse, or 'run command'.
+    get_device = function returning the MCP23017 for an address, or for
+    the board with the inputs when the address is None
+    returns a list of (pin, edge, debounce, action, text)
+    """
+    rules = []
+    with open(path) as rules_file:
+        for line in rules_file:
+            text = line.split('#')[0].strip()
+            if not text:
+                continue
+            fields = text.split(None, 4)
+            if len(fields) < 5 or fields[3] not in ('write', 'run'):
+                raise ValueError("expected 'pin edge debounce write|run "
+                                 "...': " + text)
+            pin, edge, debounce, kind, argument = fields
+            pin = int(pin, 0)
+            debounce = float(debounce)
+            if kind == 'run':
+                action = run_action(argument)
+            else:
+                target = shlex.split(argument)
+                if len(target) != 2:
+                    raise ValueError("expected 'write [address:]pin "
+                                     "value': " + text)
+                address, sep, output = target[0].rpartition(':')
+                value = target[1]
+                if value not in ('level', 'inverse'):
+                    value = int(value, 0)
+                action = write_action(
+                    get_device(int(address, 0) if sep else None),
+                    int(output, 0), value)
+            rules.append((pin, edge, debounce, action, text))
+    return rules
+
+
+def percentile(values, fraction):
+    """
+    Get the nearest rank percentile of a sorted list
+    fraction = 0.0 to 1.0
+    """
+    if not values:
+        return 0.0
+    rank = int(round(fraction * (len(values) - 1)))
+    return values[rank]
+
+
+class RuleEngine(object):
+    """
+    Debounced input rules on one MCP23017 with a reader thread and an
+    action thread joined by a queue.
+    Only the reader thread reads the inputs, and actions should write
+    outputs with update or write_action rather than a read of GPIO, which
+    would clear interrupts the reader is waiting for.
+    """
+
+    def __init__(self, device, poll_interval=0.001, history=100000):
+        """
+        device = MCP23017 with the rule pins set as inputs
+        poll_interval = seconds between reads of the interrupt flags when
+        no interrupt line has been set with set_interrupt_line
+        history = number of the latest reaction latencies kept for the
+        percentiles
+        """
+        self.device = device
+        self.poll_interval = poll_interval
+        self.__rules = []
+        # debounce state keyed by (pin, debounce) of the stable level and
+        # the time the level is confirmed, None when not changing
+        self.__debouncers = {}
+        self.__queue = Queue()
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__threads = []
+        self.__restore = {}
+        self.__sequential = False
+        self.__levels = 0
+        self.__latencies = collections.deque(maxlen=history)
+        self.events = 0
+        self.actions = 0
+        self.errors = 0
+        self.last_error = None
+        self.error = None  # bus error that stopped the reader thread
+        self.listeners = []  # functions called with each finished event
+
+    def add_rule(self, pin, edge, action, debounce=0.0, text=None):
+        """
+        Add a rule, before start is called
+        pin = input pin 1 to 16
+        edge = rising, falling or both
+        action = function called with the pin, level and edge
+        debounce = seconds the pin must keep a new level before the
+        change is passed on
+        text = description of the rule
+        """
+        if pin < 1 or pin > 16:
+            raise ValueError('pin out of range: 1 to 16')
+        if edge not in EDGES:
+            raise ValueError('edge must be rising, falling or both')
+        if debounce < 0:
+            raise ValueError('debounce must not be below 0')
+        if self.__threads:
+            raise ValueError('rules can not be added while running')
+        self.__rules.append((pin, edge, debounce, action,
+                             text or 'pin ' + str(pin) + ' ' + edge))
+        self.__debouncers[(pin, debounce)] = [0, None]
+
+    def __mask(self):
+        """
+        internal method for getting the bits of the pins with rules
+        """
+        mask = 0
+        for pin, debounce in self.__debouncers:
+            mask |= 1 << (pin - 1)
+        return mask
+
+    def start(self):
+        """
+        Enable interrupt on change for the rule pins, read their levels
+        and start the reader and action threads
+        """
+        if self.__threads:
+            return
+        mask = self.__mask()
+        config = self.device.read_config()
+        changes = {}
+        merge_bits(changes, MCP23017.INTCONA, mask, 0)
+        merge_bits(changes, MCP23017.GPINTENA, mask, mask)
+        self.__restore = {}
+        for reg in (MCP23017.INTCONA, MCP23017.GPINTENA):
+            merge_bits(self.__restore, reg, mask,
+                       config[reg] | (config[reg + 1] << 8))
+        self.__sequential = not self.device.combined_transfers()
+        if self.__sequential:
+            changes[MCP23017.IOCON] = (MCP23017.SEQOP, 0)
+            self.__restore[MCP23017.IOCON] = (
+                MCP23017.SEQOP, config[MCP23017.IOCON] & MCP23017.SEQOP)
+        # reading GPIO clears any interrupt from before the rules started
+        gpio = self.device.update(changes, [(MCP23017.GPIOA, 2)])[0]
+        self.__levels = gpio[0] | (gpio[1] << 8)
+        for (pin, debounce), state in self.__debouncers.items():
+            state[0] = (self.__levels >> (pin - 1)) & 1
+            state[1] = None
+        self.__stop.clear()
+        self.__threads = [threading.Thread(target=self.__read),
+                          threading.Thread(target=self.__act)]
+        for thread in self.__threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """
+        Stop the threads after the queued actions have run and put back
+        the interrupt settings of the pins and IOCON.SEQOP
+        """
+        if not self.__threads:
+            return
+        self.__stop.set()
+        self.__threads[0].join()
+        self.__queue.put(None)
+        self.__threads[1].join()
+        self.__threads = []
+        if self.error is None:
+            self.device.update(self.__restore)
+
+    def __changed(self, changed, stamp):
+        """
+        internal method for passing on changes without a debounce time
+        and starting the debounce time of the others
+        changed = bits of the pins that changed
+        """
+        for (pin, debounce), state in self.__debouncers.items():
+            if not changed & (1 << (pin - 1)):
+                continue
+            if debounce:
+                state[1] = stamp + debounce
+                continue
+            level = (self.__levels >> (pin - 1)) & 1
+            if level != state[0]:
+                state[0] = level
+                self.__queue.put((stamp, pin, debounce, level))
+
+    def __read(self):
+        """
+        internal method for the reader thread
+        """
+        mask = self.__mask()
+        try:
+            while not self.__stop.is_set():
+                deadlines = [state[1] for state in self.__debouncers.values()
+                             if state[1] is not None]
+                timeout = 0.1
+                if deadlines:
+                    timeout = max(0.0, min(min(deadlines) - monotonic(),
+                                           timeout))
+                flags, capture = self.device.wait_for_interrupt(
+                    timeout, self.poll_interval, self.__sequential)
+                stamp = monotonic()
+                if flags:
+                    ports = 0
+                    if flags & 0xFF:
+                        ports |= 0xFF
+                    if flags & 0xFF00:
+                        ports |= 0xFF00
+                    changed = (capture ^ self.__levels) & ports & mask
+                    # a flagged pin captured at its old level was a pulse
+                    pulsed = flags & ~changed & mask
+                    if pulsed:
+                        self.__levels ^= pulsed
+                        self.__changed(pulsed, stamp)
+                    self.__levels = (self.__levels & ~ports) | \
+                        (capture & ports)
+                    self.__changed(changed | pulsed, stamp)
+
+                due = [key for key, state in self.__debouncers.items()
+                       if state[1] is not None and state[1] <= stamp]
+                if not due:
+                    continue
+                # confirm the levels, catching changes since the interrupt
+                gpio = self.device.read_word()
+                stamp = monotonic()
+                changed = (gpio ^ self.__levels) & mask
+                self.__levels = gpio
+                for pin, debounce in due:
+                    state = self.__debouncers[(pin, debounce)]
+                    if changed & (1 << (pin - 1)):
+                        continue
+                    state[1] = None
+                    level = (gpio >> (pin - 1)) & 1
+                    if level != state[0]:
+                        state[0] = level
+                        self.__queue.put((stamp, pin, debounce, level))
+                self.__changed(changed, stamp)
+        except IOError as err:
+            self.error = err
+
+    def __act(self):
+        """
+        internal method for the action thread
+        """
+        while True:
+            event = self.__queue.get()
+            if event is None:
+                return
+            stamp, pin, debounce, level = event
+            edge = 'rising' if level else 'falling'
+            ran = []
+            for rule in self.__rules:
+                if rule[0] != pin or rule[2] != debounce or \
+                        rule[1] not in (edge, 'both'):
+                    continue
+                try:
+                    rule[3](pin, level, edge)
+                except Exception as err:  # keep running the other rules
+                    self.errors += 1
+                    self.last_error = rule[4] + ': ' + str(err)
+                ran.append(rule[4])
+            latency = monotonic() - stamp
+            with self.__lock:
+                self.events += 1
+                self.actions += len(ran)
+                self.__latencies.append(latency)
+            for listener in self.listeners:
+                listener(stamp, pin, edge, ran, latency)
+
+    def statistics(self):
+        """
+        Get the number of events and actions run, the action errors and
+        the reaction latency percentiles in seconds
+        returns a dictionary
+        """
+        with self.__lock:
+            latencies = sorted(self.__latencies)
+            events = self.events
+            actions = self.actions
+        mean = 0.0
+        if latencies:
+            mean = sum(latencies) / len(latencies)
+        return {'events': events,
+                'actions': actions,
+                'errors': self.errors,
+                'last_error': self.last_error,
+                'mean': mean,
+                'p50': percentile(latencies, 0.5),
+                'p90': percentile(latencies, 0.9),
+                'p99': percentile(latencies, 0.99),
+                'max': latencies[-1] if latencies else 0.0}
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi shared device state
+
+Advisory locks and a shared memory register shadow so several processes
+can use the same IO Pi boards without losing each other's updates.
+================================================
+
+DeviceLock is a per device advisory lock.  Each bus has a lock file with
+one byte locked for each I2C address, so processes using different
+boards on the same bus do not wait for each other.  MCP23017 holds the
+lock only while it reads and then writes a register.
+
+SharedShadow keeps a copy of the configuration and output latch
+registers of each board on a bus in shared memory with a generation
+counter for each board that is increased by every change.  A process
+compares the generation with the one it last saw and only reloads its
+copy when another process has changed the board, so the registers are
+not read from the board again.
+
+The shadow is only right when every process writing to the boards uses
+it, such as with the --shared-cache option.  IOPI_LOCK_DIR sets the
+directory for the lock files, /run/lock or the temporary directory by
+default.  The shadow files are kept in /dev/shm.  New files can be read
+and written by their owner and group, the group of /dev/i2c-N or the
+group named by IOPI_GROUP, so only users allowed to use the bus share
+them.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+FIRST_ADDRESS = 0x20
+ADDRESSES = 8
+REGISTERS = 0x16  # IODIRA to OLATB
+# generation, bit mask of registers held and the register values
+SLOT = struct.Struct('<QI22s')
+SLOT_SIZE = 64
+
+
+def lock_dir():
+    """
+    Get the directory for lock files
+    """
+    if os.environ.get('IOPI_LOCK_DIR'):
+        return os.environ['IOPI_LOCK_DIR']
+    if os.path.isdir('/run/lock'):
+        return '/run/lock'
+    return tempfile.gettempdir()
+
+
+def shared_dir():
+    """
+    Get the directory for shared memory files
+    """
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def shared_group(name):
+    """
+    Get the group for the lock and shadow files of a bus: the group named
+    or numbered by IOPI_GROUP, otherwise the group of /dev/<name>
+    name = bus name, such as i2c-1
+    returns the group id, or None to keep the group of the process
+    """
+    group = os.environ.get('IOPI_GROUP')
+    if group:
+        if group.isdigit():
+            return int(group)
+        import grp
+        return grp.getgrnam(group).gr_gid
+    try:
+        return os.stat(os.path.join('/dev', name)).st_gid
+    except OSError:
+        return None
+
+
+def open_shared_file(path, size=0, group=None):
+    """
+    Open or create a file the owner and group can read and write, extended
+    to at least size bytes.  Symbolic links are not followed and a file
+    that already exists keeps its owner and mode.
+    group = group id given to a new file, None to keep the group of the
+    process
+    returns the file descriptor
+    """
+    flags = os.O_RDWR | getattr(os, 'O_NOFOLLOW', 0)
+    while True:
+        try:
+            fd = os.open(path, flags | os.O_CREAT | os.O_EXCL, 0o660)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        else:
+            # the umask may have removed the group bits
+            try:
+                if group is not None:
+                    os.fchown(fd, -1, group)
+                os.fchmod(fd, 0o660)
+            except OSError:
+                pass  # not a member of the group
+            break
+        try:
+            fd = os.open(path, flags)
+            break
+        except OSError as err:
+            # removed again between the two opens
+            if err.errno != errno.ENOENT:
+                raise
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+    return fd
+
+
+class DeviceLock(object):
+    """
+    Reentrant lock for one device, held against other processes with an
+    fcntl record lock and against other threads with a thread lock.
+    Use get so all devices at one address in a process share the lock,
+    as record locks belong to the process.
+    """
+
+    __locks = {}
+    __files = {}
+    __create_lock = threading.Lock()
+
+    def __init__(self, fd, address):
+        self.fd = fd
+        self.address = address
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+
+    @classmethod
+    def get(cls, name, address):
+        """
+        Get the lock for a device
+        name = bus name, such as i2c-1
+        address = I2C address
+        """
+        with cls.__create_lock:
+            key = (name, address)
+            if key not in cls.__locks:
+                path = os.path.join(lock_dir(), 'iopi-' + name + '.lock')
+                # never closed, closing any descriptor for the file would
+                # release every lock the process holds on it
+                if path not in cls.__files:
+                    cls.__files[path] = open_shared_file(
+                        path, group=shared_group(name))
+                cls.__locks[key] = DeviceLock(cls.__files[path], address)
+            return cls.__locks[key]
+
+    def __enter__(self):
+        """
+        Take the lock
+        returns True for the outermost use of a reentrant lock
+        """
+        self.thread_lock.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.address)
+            except (IOError, OSError):
+                self.depth -= 1
+                self.thread_lock.release()
+                raise
+        return self.depth == 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.address)
+        self.thread_lock.release()
+        return False
+
+
+class SharedShadow(object):
+    """
+    Register values of the boards on one bus in shared memory.
+    Changes should be made with the DeviceLock for the board held.
+    """
+
+    __shadows = {}
+    __create_lock = threading.Lock()
+
+    def __init__(self, path, group=None):
+        fd = open_shared_file(path, SLOT_SIZE * ADDRESSES, group)
+        try:
+            self.map = mmap.mmap(fd, SLOT_SIZE * ADDRESSES)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def get(cls, name):
+        """
+        Get the shadow for a bus, shared by every device in the process
+        name = bus name, such as i2c-1
+        """
+        with cls.__create_lock:
+            if name not in cls.__shadows:
+                cls.__shadows[name] = SharedShadow(os.path.join(
+                    shared_dir(), 'iopi-' + name + '.shadow'),
+                    shared_group(name))
+            return cls.__shadows[name]
+
+    @staticmethod
+    def offset(address):
+        """
+        Get the offset of the slot of a board in the shared memory
+        """
+        if address < FIRST_ADDRESS or address >= FIRST_ADDRESS + ADDRESSES:
+            raise ValueError('address out of range: 0x20 to 0x27')
+        return (address - FIRST_ADDRESS) * SLOT_SIZE
+
+    def generation(self, address):
+        """
+        Get the generation counter of a board
+        """
+        return struct.unpack_from('<Q', self.map, self.offset(address))[0]
+
+    def load(self, address):
+        """
+        Get the register values of a board
+        returns a list of the 22 registers, None for registers not held
+        """
+        generation, valid, data = SLOT.unpack_from(
+            self.map, self.offset(address))
+        values = bytearray(data)
+        return [values[reg] if valid & (1 << reg) else None
+                for reg in range(REGISTERS)]
+
+    def store(self, address, values):
+        """
+        Set the register values of a board and increase its generation
+        values = list of the 22 registers, None for registers not known
+        returns the new generation
+        """
+        offset = self.offset(address)
+        generation = self.generation(address) + 1
+        valid = 0
+        data = bytearray(REGISTERS)
+        for reg, value in enumerate(values):
+            if value is not None:
+                valid |= 1 << reg
+                data[reg] = value
+        SLOT.pack_into(self.map, offset, generation, valid, bytes(data))
+        return generation
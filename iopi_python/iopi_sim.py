@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+
+"""
+ ================================================
+ ABElectronics IO Pi simulated I2C bus
+
+A register accurate model of the MCP23017 behind an smbus compatible bus
+object so the IO Pi code can run and be measured without hardware.
+================================================
+
+SimulatedBus can be passed to MCP23017 as the bus argument, or selected
+for the whole program with --backend=sim or the IOPI_BACKEND=sim
+environment variable.  IOPI_SIM_LATENCY sets the time in seconds added to
+each transaction when the backend is selected that way.
+
+The model covers every register from IODIRA to OLATB, the IOCON BANK,
+MIRROR, SEQOP and INTPOL bits, interrupt flag and capture behaviour and
+sequential or toggling address pointer operation.  Pin levels driven onto
+the inputs from outside the chip are set with set_inputs.
+"""
+
+import contextlib
+import errno
+import os
+import threading
+import time
+
+# register index in IOCON.BANK = 0 order, see the MCP23017 datasheet
+IODIRA = 0x00
+IODIRB = 0x01
+IPOLA = 0x02
+IPOLB = 0x03
+GPINTENA = 0x04
+GPINTENB = 0x05
+DEFVALA = 0x06
+DEFVALB = 0x07
+INTCONA = 0x08
+INTCONB = 0x09
+IOCON = 0x0A
+GPPUA = 0x0C
+GPPUB = 0x0D
+INTFA = 0x0E
+INTFB = 0x0F
+INTCAPA = 0x10
+INTCAPB = 0x11
+GPIOA = 0x12
+GPIOB = 0x13
+OLATA = 0x14
+OLATB = 0x15
+
+# IOCON bits
+BANK = 0x80
+MIRROR = 0x40
+SEQOP = 0x20
+INTPOL = 0x02
+
+# registers that can not be written
+READ_ONLY = (INTFA, INTFB, INTCAPA, INTCAPB)
+
+
+class SimulatedMCP23017(object):
+    """
+    Register model of one MCP23017
+    """
+
+    def __init__(self):
+        self.registers = [0] * (OLATB + 1)
+        self.registers[IODIRA] = 0xFF  # power-on reset, all inputs
+        self.registers[IODIRB] = 0xFF
+        self.inputs = 0  # levels driven onto the pins from outside
+        self.driven = 0  # pins with a level driven from outside
+        self.pointer = 0
+        self.__int_read = None
+        self.__int_write = None
+
+    # address pointer
+
+    def __register(self, pointer):
+        """
+        internal method for mapping an address in the current bank mode to
+        a register index
+        """
+        if self.registers[IOCON] & BANK:
+            port = (pointer >> 4) & 1
+            index = pointer & 0x0F
+            if index > 0x0A:
+                return None
+            return index * 2 + port
+        if pointer > OLATB:
+            return None
+        return pointer
+
+    def __advance(self):
+        """
+        internal method for moving the address pointer after each byte
+        """
+        config = self.registers[IOCON]
+        if config & BANK:
+            if config & SEQOP:
+                return
+            port = self.pointer & 0x10
+            self.pointer = port | (((self.pointer & 0x0F) + 1) % 0x0B)
+        elif config & SEQOP:
+            # byte mode toggles between the A and B registers
+            self.pointer ^= 1
+        else:
+            self.pointer = (self.pointer + 1) % (OLATB + 1)
+
+    # pins
+
+    def __pin_levels(self):
+        """
+        internal method for getting the logic level on all 16 pins
+        """
+        direction = self.__word(IODIRA)
+        outputs = self.__word(OLATA) & ~direction
+        pullup = self.__word(GPPUA) & ~self.driven
+        inputs = (self.inputs & self.driven) | pullup
+        return (outputs | (inputs & direction)) & 0xFFFF
+
+    def __gpio(self):
+        """
+        internal method for getting the GPIO value, input polarity only
+        applies to inputs
+        """
+        inverted = self.__word(IPOLA) & self.__word(IODIRA)
+        return self.__pin_levels() ^ inverted
+
+    def __word(self, low_reg):
+        return self.registers[low_reg] | (self.registers[low_reg + 1] << 8)
+
+    # interrupts
+
+    def __check_interrupts(self, previous):
+        """
+        internal method for setting the interrupt flags and captures after
+        the pin levels change from previous
+        """
+        levels = self.__pin_levels()
+        enabled = self.__word(GPINTENA) & self.__word(IODIRA)
+        compare = self.__word(INTCONA)
+        changed = (levels ^ previous) & ~compare
+        mismatch = (levels ^ self.__word(DEFVALA)) & compare
+        triggered = (changed | mismatch) & enabled
+        gpio = self.__gpio()
+        fired = False
+        for port in (0, 1):
+            bits = (triggered >> (port * 8)) & 0xFF
+            # further changes are ignored until the interrupt is cleared
+            if bits and not self.registers[INTFA + port]:
+                self.registers[INTFA + port] = bits
+                self.registers[INTCAPA + port] = (gpio >> (port * 8)) & 0xFF
+                fired = True
+        if fired and self.__int_write is not None:
+            os.write(self.__int_write, b'\x01')
+
+    def __clear_interrupt(self, port):
+        """
+        internal method for clearing the interrupt on a port after a read
+        of INTCAP or GPIO.  Pins compared against DEFVAL trigger again
+        straight away if they still do not match.
+        """
+        self.registers[INTFA + port] = 0
+        levels = self.__pin_levels()
+        self.__check_interrupts(levels)
+
+    def interrupt_active(self, port):
+        """
+        Get the state of the INTA (port 0) or INTB (port 1) output,
+        True when an interrupt is waiting to be cleared
+        """
+        flags = self.registers[INTFA + port]
+        if self.registers[IOCON] & MIRROR:
+            flags = self.registers[INTFA] | self.registers[INTFB]
+        return flags != 0
+
+    def interrupt_level(self, port):
+        """
+        Get the logic level of the INTA (port 0) or INTB (port 1) output
+        taking IOCON.INTPOL into account
+        """
+        active = self.interrupt_active(port)
+        if self.registers[IOCON] & INTPOL:
+            return int(active)
+        return int(not active)
+
+    def interrupt_fd(self):
+        """
+        Get a file descriptor that becomes readable each time an interrupt
+        is triggered, standing in for the INT line
+        """
+        if self.__int_read is None:
+            self.__int_read, self.__int_write = os.pipe()
+        return self.__int_read
+
+    def set_inputs(self, value, driven=0xFFFF):
+        """
+        Drive the pins from outside the chip
+        value = 16 bit pin levels, port A in the low byte
+        driven = pins that are driven, others follow their pull-up
+        """
+        previous = self.__pin_levels()
+        self.inputs = value & 0xFFFF
+        self.driven = driven & 0xFFFF
+        self.__check_interrupts(previous)
+
+    def pins(self):
+        """
+        Get the logic level on all 16 pins, port A in the low byte
+        """
+        return self.__pin_levels()
+
+    # transfers
+
+    def set_pointer(self, pointer):
+        """
+        Set the address pointer from the register address byte
+        """
+        self.pointer = pointer
+
+    def read_next(self):
+        """
+        Read the register at the address pointer and advance it
+        """
+        reg = self.__register(self.pointer)
+        value = 0
+        if reg == IOCON or reg == IOCON + 1:
+            value = self.registers[IOCON] & 0xFE
+        elif reg in (GPIOA, GPIOB):
+            value = (self.__gpio() >> ((reg - GPIOA) * 8)) & 0xFF
+            self.__clear_interrupt(reg - GPIOA)
+        elif reg in (INTCAPA, INTCAPB):
+            value = self.registers[reg]
+            self.__clear_interrupt(reg - INTCAPA)
+        elif reg is not None:
+            value = self.registers[reg]
+        self.__advance()
+        return value
+
+    def write_next(self, value):
+        """
+        Write the register at the address pointer and advance it
+        """
+        reg = self.__register(self.pointer)
+        value &= 0xFF
+        previous = self.__pin_levels()
+        if reg == IOCON or reg == IOCON + 1:
+            self.registers[IOCON] = value & 0xFE
+        elif reg in (GPIOA, GPIOB):
+            self.registers[reg + 2] = value
+        elif reg is not None and reg not in READ_ONLY:
+            self.registers[reg] = value
+        self.__advance()
+        self.__check_interrupts(previous)
+
+
+class SimulatedBus(object):
+    """
+    smbus compatible bus with simulated MCP23017 devices.
+    Each method call counts as one I2C transaction.
+    """
+
+    def __init__(self, bus=1, addresses=range(0x20, 0x28), latency=0.0,
+                 byte_time=0.0, combined=False):
+        """
+        bus = bus number, kept for reference
+        addresses = I2C addresses with a device
+        latency = seconds added to each transaction
+        byte_time = seconds added for each byte transferred
+        combined = True adds read_runs and write_runs, which move several
+        register runs in one transaction like the i2c-dev bus
+        """
+        self.bus = bus
+        # simulated devices belong to this process, see iopi_shared
+        self.name = 'sim-' + str(os.getpid()) + '-' + str(bus)
+        self.devices = {}
+        for address in addresses:
+            self.devices[address] = SimulatedMCP23017()
+        self.latency = latency
+        self.byte_time = byte_time
+        self.transactions = 0
+        self.bytes = 0
+        self.__lock = threading.RLock()
+        if combined:
+            self.read_runs = self.__read_runs
+            self.write_runs = self.__write_runs
+
+    @contextlib.contextmanager
+    def __transaction(self, address, size):
+        """
+        internal method for running a transaction on a device.  The bus is
+        held until the transaction ends, as the kernel does for an I2C
+        adapter, so threads sharing the bus do not interleave bytes.
+        """
+        with self.__lock:
+            self.transactions += 1
+            self.bytes += size
+            delay = self.latency + self.byte_time * size
+            if delay > 0:
+                time.sleep(delay)
+            if address not in self.devices:
+                raise IOError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+            yield self.devices[address]
+
+    def reset_counters(self):
+        """
+        Set the transaction and byte counters to 0
+        """
+        self.transactions = 0
+        self.bytes = 0
+
+    def read_byte(self, addr):
+        with self.__transaction(addr, 2) as device:
+            return device.read_next()
+
+    def write_byte(self, addr, val):
+        with self.__transaction(addr, 2) as device:
+            device.set_pointer(val)
+
+    def read_byte_data(self, addr, cmd):
+        with self.__transaction(addr, 3) as device:
+            device.set_pointer(cmd)
+            return device.read_next()
+
+    def write_byte_data(self, addr, cmd, val):
+        with self.__transaction(addr, 3) as device:
+            device.set_pointer(cmd)
+            device.write_next(val)
+
+    def read_word_data(self, addr, cmd):
+        with self.__transaction(addr, 4) as device:
+            device.set_pointer(cmd)
+            low = device.read_next()
+            return low | (device.read_next() << 8)
+
+    def write_word_data(self, addr, cmd, val):
+        with self.__transaction(addr, 4) as device:
+            device.set_pointer(cmd)
+            device.write_next(val & 0xFF)
+            device.write_next((val >> 8) & 0xFF)
+
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        with self.__transaction(addr, 2 + length) as device:
+            device.set_pointer(cmd)
+            return [device.read_next() for _ in range(length)]
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        with self.__transaction(addr, 2 + len(vals)) as device:
+            device.set_pointer(cmd)
+            for val in vals:
+                device.write_next(val)
+
+    def __read_runs(self, addr, runs):
+        size = sum([2 + length for reg, length in runs])
+        with self.__transaction(addr, size) as device:
+            results = []
+            for reg, length in runs:
+                device.set_pointer(reg)
+                results.append([device.read_next() for _ in range(length)])
+            return results
+
+    def __write_runs(self, addr, runs):
+        size = sum([2 + len(values) for reg, values in runs])
+        with self.__transaction(addr, size) as device:
+            for reg, values in runs:
+                device.set_pointer(reg)
+                for val in values:
+                    device.write_next(val)
+
+    def close(self):
+        return
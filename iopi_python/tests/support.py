@@ -0,0 +1,75 @@
+"""
+ ================================================
+ ABElectronics IO Pi test helpers
+
+Commands and devices in the tests run against the simulated bus in
+iopi_sim, each test on a bus of its own so it starts from the power on
+register values.
+================================================
+"""
+
+import itertools
+import os
+import sys
+
+IOPI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, IOPI_DIR)
+
+import iopi  # noqa: E402
+
+try:
+    from io import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+bus_numbers = itertools.count(100)
+
+
+def new_bus():
+    """
+    Select a new simulated bus for the devices and commands that follow
+    returns the SimulatedBus
+    """
+    iopi.MCP23017.backend = 'sim'
+    iopi.MCP23017.bus_number = next(bus_numbers)
+    return iopi.MCP23017.get_shared_bus()
+
+
+def capture(function, *args):
+    """
+    Call a function with the printed output captured
+    returns the exit status, 0 unless the function exits, and the printed
+    output
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    status = 0
+    try:
+        function(*args)
+    except SystemExit as err:
+        status = err.code
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+        iopi.MCP23017.instrument = False
+    return status, output
+
+
+def cli(argv):
+    """
+    Run a command line on the selected simulated bus in this process
+    argv = list of arguments or a string split on spaces
+    returns the exit status and the printed output
+    """
+    if not isinstance(argv, list):
+        argv = argv.split()
+    return capture(iopi.main, argv)
+
+
+def run(argv, devices):
+    """
+    Run a command with devices kept between commands, as --batch and
+    --serve do
+    returns the exit status and the printed output
+    """
+    return capture(iopi.run, argv.split(), devices)
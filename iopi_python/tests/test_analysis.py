@@ -0,0 +1,78 @@
+"""
+Capture files recorded on the simulated bus and analysed with NumPy
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import support
+import iopi_record
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'analysis needs NumPy')
+class AnalyseCaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record_then_analyse(self):
+        self.bus.devices[0x20].set_inputs(0x8001)
+        status, output = support.cli(
+            '--record=' + self.path + ' --rate=1000 --samples=50 -a 0x20')
+        self.assertEqual(status, 0)
+        status, output = support.cli('--analyse=' + self.path)
+        self.assertEqual(status, 0)
+        results = json.loads(output)
+        self.assertEqual([pin['pin'] for pin in results
+                          if pin['high_ratio'] == 1.0], [1, 16])
+        self.assertEqual(sum(pin['transitions'] for pin in results), 0)
+
+    def test_analyse_full_ring(self):
+        # 250 records in 100 slots, the oldest first after loading
+        capture = iopi_record.CaptureFile(self.path, 100, True, 10)
+        for number in range(250):
+            capture.append(number * 0.01, number & 1, 0, 0)
+        capture.close()
+        import iopi_analysis
+        times, values = iopi_analysis.load_samples(self.path)
+        self.assertEqual(len(times), 100)
+        self.assertTrue((numpy.diff(times) > 0).all())
+        self.assertEqual(int(values[0]), 150 & 1)
+        status, output = support.cli('--analyse=' + self.path + ' -n 1,2')
+        self.assertEqual(status, 0)
+        pin1, pin2 = json.loads(output)
+        self.assertEqual(pin1['transitions'], 99)
+        self.assertEqual(pin2['transitions'], 0)
+
+    def test_binary_sample(self):
+        # pins 9 to 16 pulled up read high, at bits 8 to 15 of each record
+        path = os.path.join(self.directory, 'test.bin')
+        with open(path, 'wb') as output:
+            subprocess.check_call(
+                [sys.executable, 'iopi.py', '--sample', '--backend=sim',
+                 '--rate=1000', '--samples=5', '--format=binary', '-a',
+                 '0x20', '-p', '1', '-u', '0xFF'],
+                cwd=support.IOPI_DIR, stdout=output)
+        status, output = support.cli('--analyse=' + path)
+        self.assertEqual(status, 0)
+        self.assertEqual([pin['pin'] for pin in json.loads(output)
+                          if pin['high_ratio'] == 1.0], list(range(9, 17)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Board profiles set with --apply on the simulated bus
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+import iopi
+
+MCP23017 = iopi.MCP23017
+
+PROFILE = {'0x20': {'port0.direction': '0xFF', 'pin1.direction': 0,
+                    'pin1.write': 1, 'pin2.pullup': 1,
+                    'mirrorinterrupts': 1},
+           '0x21': {'port2.direction': '0x00FF', 'port1.write': '0xA5'}}
+
+
+class ApplyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, profile, name='profile.json'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as profile_file:
+            if name.endswith('.ini'):
+                profile_file.write(profile)
+            else:
+                json.dump(profile, profile_file)
+        return path
+
+    def registers(self, address):
+        return MCP23017(address, bus=self.bus, init=False).read_registers()
+
+    def test_apply(self):
+        path = self.save(PROFILE)
+        status, output = support.cli('--apply=' + path)
+        self.assertEqual(status, 0)
+        results = json.loads(output)
+        self.assertEqual(results['0x20']['writes'],
+                         ['OLATA=1', 'GPPUA=2', 'IODIRA=254', 'IOCON=64'])
+        first = self.registers(0x20)
+        self.assertEqual(first[MCP23017.IODIRA], 0xFE)
+        self.assertEqual(first[MCP23017.OLATA], 0x01)
+        self.assertEqual(first[MCP23017.GPPUA], 0x02)
+        self.assertEqual(first[MCP23017.IOCON], 0x40)
+        second = self.registers(0x21)
+        self.assertEqual(second[MCP23017.IODIRA], 0xFF)
+        self.assertEqual(second[MCP23017.IODIRB], 0x00)
+        self.assertEqual(second[MCP23017.OLATB], 0xA5)
+        # the boards already match so nothing is written
+        status, output = support.cli('--apply=' + path)
+        for board in json.loads(output).values():
+            self.assertEqual(board['writes'], [])
+        self.assertEqual(self.registers(0x20), first)
+
+    def test_dry_run(self):
+        before = self.registers(0x20)
+        path = self.save(PROFILE)
+        status, output = support.cli('--apply=' + path + ' --dry-run -a 0x20')
+        self.assertEqual(status, 0)
+        results = json.loads(output)
+        self.assertEqual(list(results), ['0x20'])
+        self.assertEqual(len(results['0x20']['writes']), 4)
+        self.assertEqual(self.registers(0x20), before)
+
+    def test_ini_profile(self):
+        path = self.save('[0x22]\nport0.direction = 0\nport0.write = 0x3C\n',
+                         'profile.ini')
+        self.assertEqual(support.cli('--apply=' + path)[0], 0)
+        registers = self.registers(0x22)
+        self.assertEqual(registers[MCP23017.IODIRA], 0)
+        self.assertEqual(registers[MCP23017.OLATA], 0x3C)
+
+    def test_bad_profiles(self):
+        before = self.registers(0x20)
+        for profile in ({'0x50': {'port0.write': 1}},
+                        {'0x20': {'port3.write': 1}}):
+            status, output = support.cli('--apply=' + self.save(profile))
+            self.assertEqual(status, 2)
+        self.assertEqual(self.registers(0x20), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
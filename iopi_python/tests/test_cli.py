@@ -0,0 +1,24 @@
+"""
+Command line parsing
+"""
+
+import unittest
+
+import support
+
+
+class ModeOptionTest(unittest.TestCase):
+
+    def setUp(self):
+        support.new_bus()
+
+    def test_one_mode(self):
+        status, output = support.cli('--client --sample -a 0x20 -p 0')
+        self.assertEqual(status, 2)
+        self.assertIn('--client', output)
+        status, output = support.cli('--dump --record=x.cap -a 0x20')
+        self.assertEqual(status, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Pulse counting on the simulated bus
+"""
+
+import time
+import unittest
+
+import support
+import iopi
+from iopi_counter import PulseCounter
+
+MCP23017 = iopi.MCP23017
+
+
+def wait_for(condition, timeout=2.0):
+    """
+    Wait for a condition to become true
+    returns the last value of the condition
+    """
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.001)
+    return condition()
+
+
+class PulseCounterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.chip = self.bus.devices[0x20]
+        self.device = MCP23017(0x20)
+
+    def test_counts_edges(self):
+        counter = PulseCounter(self.device, [1, 9], poll_interval=0.0005)
+        counter.start()
+        try:
+            level = 0
+            for number in range(10):
+                level ^= 0x0101
+                events = counter.events
+                self.chip.set_inputs(level)
+                self.assertTrue(wait_for(lambda: counter.events > events))
+        finally:
+            counter.stop()
+        self.assertIsNone(counter.error)
+        self.assertEqual(counter.counts(), {1: (5, 5), 9: (5, 5)})
+        stats = counter.statistics()
+        self.assertEqual(stats['edges'], 20)
+        self.assertEqual(stats['missed'], 0)
+        seconds, rates = counter.rates()
+        self.assertGreater(seconds, 0)
+
+    def test_uncounted_pins_and_restore(self):
+        before = self.device.read_config()
+        counter = PulseCounter(self.device, [2], poll_interval=0.0005)
+        counter.start()
+        try:
+            self.chip.set_inputs(0x0001)
+            self.chip.set_inputs(0x0003)
+            self.assertTrue(wait_for(lambda: counter.events > 0))
+            time.sleep(0.01)
+        finally:
+            counter.stop()
+        self.assertEqual(counter.counts(), {2: (1, 0)})
+        # the interrupt settings are put back
+        self.assertEqual(self.device.read_config(), before)
+
+    def test_bus_error_stops_counting(self):
+        counter = PulseCounter(self.device, [1], poll_interval=0.0005)
+        counter.start()
+        del self.bus.devices[0x20]
+        self.assertTrue(wait_for(lambda: counter.error is not None))
+        counter.stop()
+        self.assertRaises(IOError, counter.rates)
+
+    def test_pin_out_of_range(self):
+        self.assertRaises(ValueError, PulseCounter, self.device, [17])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+"""
+MCP23017 methods on the simulated bus
+"""
+
+import unittest
+
+import support
+import iopi
+
+MCP23017 = iopi.MCP23017
+
+
+class PinWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.chip = self.bus.devices[0x20]
+
+    def write_pins(self, cache):
+        device = MCP23017(0x20, cache)
+        device.set_direction(3, 0, True)
+        device.set_direction(9, 0, True)
+        device.set_interrupt(1, 1, True)
+        # pin 1 is an input driven high, which flags an interrupt
+        self.chip.set_inputs(0x0001, 0x0001)
+        device.write(3, 1, True)
+        device.write_pins({9: 1, 10: 0})
+        return device
+
+    def check_outputs(self, cache):
+        device = self.write_pins(cache)
+        registers = device.read_registers()
+        self.assertEqual(registers[MCP23017.OLATA], 0x04)
+        self.assertEqual(registers[MCP23017.OLATB], 0x01)
+        # the interrupt of pin 1 was not cleared by a read of GPIO
+        self.assertEqual(registers[MCP23017.INTFA], 0x01)
+
+    def test_uncached_writes_use_latch(self):
+        self.check_outputs(False)
+
+    def test_cached_writes_use_latch(self):
+        self.check_outputs(True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+Register snapshots with --dump and --restore on the simulated bus
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+import iopi
+
+MCP23017 = iopi.MCP23017
+
+
+class DumpRestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dump.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def registers(self, address=0x20):
+        return MCP23017(address, bus=self.bus, init=False).read_registers()
+
+    def save(self, dump):
+        with open(self.path, 'w') as dump_file:
+            json.dump(dump, dump_file)
+
+    def test_round_trip(self):
+        self.assertEqual(support.cli(
+            '-a 0x20 -p 0 -d 0x0F -u 0xF0 -w 0x05')[0], 0)
+        MCP23017(0x20, bus=self.bus, init=False).update(
+            {MCP23017.IOCON: (0xFF, 0x42)})
+        saved = self.registers()
+        status, output = support.cli('--dump -a 0x20')
+        self.assertEqual(status, 0)
+        self.save(json.loads(output))
+        # the dump reads IOCON without writing it
+        self.assertEqual(self.registers(), saved)
+
+        support.new_bus()
+        self.bus = MCP23017.get_shared_bus()
+        status, output = support.cli('--restore=' + self.path)
+        self.assertEqual(status, 0)
+        self.assertIn('IOCON', json.loads(output)['0x20'])
+        restored = self.registers()
+        for reg in MCP23017.CACHED_REGISTERS:
+            self.assertEqual(restored[reg], saved[reg],
+                             MCP23017.register_name(reg))
+        # restoring again writes nothing
+        status, output = support.cli('--restore=' + self.path)
+        self.assertEqual(json.loads(output), {'0x20': []})
+
+    def test_address_out_of_range(self):
+        self.save({'0x20': {'OLATA': '0x55'}, '0x50': {'OLATA': '0x55'}})
+        status, output = support.cli('--restore=' + self.path)
+        self.assertEqual(status, 2)
+        self.assertIn('out of range', output)
+        # nothing is written when any board is rejected
+        self.assertEqual(self.registers()[MCP23017.OLATA], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
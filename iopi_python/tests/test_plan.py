@@ -0,0 +1,130 @@
+"""
+Planned register updates on the simulated bus
+"""
+
+import random
+import unittest
+
+import support
+import iopi
+from iopi_sim import SimulatedBus
+
+MCP23017 = iopi.MCP23017
+
+CONFIGURE = '-a 0x20 -n 3 -d 1 -u 1 -i 1 -e 1 -t 0 -f 1 -r'
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+
+    def test_block_transfers_for_kept_devices(self):
+        # the device written by the first command still knows IOCON
+        devices = {}
+        support.run('-a 0x20 -p 0 -r', devices)
+        status, output = support.run(CONFIGURE + ' --plan', devices)
+        self.assertTrue(output.endswith('5 transactions\n'), output)
+        self.bus.reset_counters()
+        support.run(CONFIGURE, devices)
+        self.assertEqual(self.bus.transactions, 5)
+        self.assertEqual(support.run(CONFIGURE.replace('-d 1', '-d 0'),
+                                     devices)[0], 0)
+        device = devices[0x20]
+        self.assertEqual(device.read_registers()[MCP23017.IOCON], 0x22)
+
+
+class CacheTest(unittest.TestCase):
+    """
+    The same changes made with and without the register cache, on buses
+    with and without combined transfers, leave the same registers
+    """
+
+    # configuration and output latch registers, IOCON only with the bits
+    # that do not move the registers
+    REGISTERS = [reg for reg in MCP23017.CACHED_REGISTERS
+                 if reg != MCP23017.IOCON]
+
+    def devices(self):
+        devices = []
+        for combined in (False, True):
+            for cache in (False, True):
+                bus = SimulatedBus(combined=combined)
+                devices.append(MCP23017(0x20, cache, bus))
+        return devices
+
+    def check(self, devices, expected):
+        for device in devices:
+            registers = device.read_registers()
+            for reg in MCP23017.CACHED_REGISTERS:
+                self.assertEqual(registers[reg], expected[reg],
+                                 MCP23017.register_name(reg))
+
+    def test_random_updates(self):
+        generator = random.Random(11)
+        devices = self.devices()
+        expected = devices[0].read_registers()
+        for step in range(200):
+            changes = {}
+            for reg in generator.sample(self.REGISTERS,
+                                        generator.randint(1, 6)):
+                changes[reg] = (generator.randint(0, 0xFF),
+                                generator.randint(0, 0xFF))
+            if generator.random() < 0.2:
+                changes[MCP23017.IOCON] = (0x42, generator.choice(
+                    [0, 0x02, 0x40, 0x42]))
+            for reg, (mask, bits) in changes.items():
+                bits &= mask
+                changes[reg] = (mask, bits)
+                expected[reg] = (expected[reg] & ~mask) | bits
+                if reg == MCP23017.IOCON:
+                    expected[reg + 1] = expected[reg]
+            for device in devices:
+                device.update(changes)
+            self.check(devices, expected)
+
+    def test_methods(self):
+        devices = self.devices()
+        calls = [
+            ('set_direction', (0, 0x0F)), ('set_direction', (12, 0, True)),
+            ('set_pullup', (1, 0xF0)), ('set_pullup', (3, 1, True)),
+            ('write', (0, 0x05)), ('write', (2, 1, True)),
+            ('write', (12, 1, True)), ('invert', (4, 1, True)),
+            ('mirror_interrupts', (1,)), ('set_interrupt_polarity', (0,)),
+            ('set_interrupt_type', (5, 1, True)),
+            ('set_interrupt_defaults', (1, 0xAA)),
+            ('set_interrupt', (6, 1, True)),
+            ('write_word', (0x1234,)), ('write_pins', ({1: 1, 9: 0},)),
+            ('set_direction_pins', ({2: 1, 10: 0},)),
+            ('invert_pins', ({3: 1, 11: 1},)),
+            ('set_interrupt_pins', ({7: 1, 15: 1},))]
+        for method, args in calls:
+            for device in devices:
+                getattr(device, method)(*args)
+            registers = [device.read_registers() for device in devices]
+            for other in registers[1:]:
+                self.assertEqual(other, registers[0], method)
+
+    def test_command_lines(self):
+        # the planner gives the same registers with devices kept between
+        # commands as with a new device for each command.  A new device
+        # writes the default IOCON so the IOCON change comes last.
+        commands = [
+            '-a 0x20 -n 3 -d 0 -w 1', '-a 0x20 -p 0 -d 0x0F -u 0xF0',
+            '-a 0x20 -n 3 -d 1 -u 1 -i 1 -e 1 -t 0 -f 1 -r',
+            '-a 0x20 -n 1,3,9 -d 0 -w 1,0,1', '-a 0x20 -p 1 -d 0 -w 0xA5',
+            '-a 0x20 -n 12 -d 0 -w 1 -r', '-a 0x20 -p 0 -m 1 -l 1']
+        bus = support.new_bus()
+        devices = {}
+        for command in commands:
+            self.assertEqual(support.run(command, devices)[0], 0)
+        kept = MCP23017(0x20, bus=bus, init=False).read_registers()
+        bus = support.new_bus()
+        for command in commands:
+            self.assertEqual(support.cli(command)[0], 0)
+        self.assertEqual(
+            MCP23017(0x20, bus=bus, init=False).read_registers(), kept)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""
+Software PWM on the simulated bus
+"""
+
+import time
+import unittest
+
+import support
+import iopi
+from iopi_pwm import SoftwarePWM
+
+
+class SoftwarePWMTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.device = iopi.MCP23017(0x20)
+        self.device.set_direction(0, 0x00)
+
+    def test_duty_cycles(self):
+        pwm = SoftwarePWM(self.device, frequency=200)
+        pwm.set_duties({1: 1.0, 2: 0.5, 3: 0.0})
+        pwm.start()
+        time.sleep(0.05)
+        pwm.stop()
+        stats = pwm.statistics()
+        self.assertGreater(stats['periods'], 0)
+        self.assertEqual(stats['writes_per_period'], 2)
+        self.assertIsNone(stats['error'])
+        # stopped with only the pin at a duty cycle of 1.0 high
+        self.assertEqual(self.device.read_registers()[iopi.MCP23017.OLATA],
+                         0x01)
+
+    def test_bus_error_is_kept(self):
+        pwm = SoftwarePWM(self.device, frequency=200)
+        pwm.set_duty(1, 0.5)
+        pwm.start()
+        # the board stops answering
+        del self.bus.devices[0x20]
+        time.sleep(0.05)
+        pwm.stop()
+        self.assertIsInstance(pwm.error, IOError)
+        self.assertIsNotNone(pwm.statistics()['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
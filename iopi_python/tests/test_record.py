@@ -0,0 +1,102 @@
+"""
+Capture files written with --record and read back with --replay
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+import iopi_record
+
+
+class CaptureFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_ring_keeps_latest_records(self):
+        capture = iopi_record.CaptureFile(self.path, 20, index_every=4)
+        for number in range(50):
+            capture.append(number, number)
+        self.assertEqual(capture.count, 50)
+        self.assertEqual(len(capture), 20)
+        self.assertEqual([value for stamp, value in capture.records()],
+                         list(range(30, 50)))
+        capture.close()
+
+    def test_seek_with_index(self):
+        capture = iopi_record.CaptureFile(self.path, 64, index_every=8)
+        offset = capture.offset
+        for number in range(100):
+            capture.append(number * 0.5, number)
+        records = list(capture.records(offset + 40.0, offset + 42.0))
+        self.assertEqual([value for stamp, value in records],
+                         [80, 81, 82, 83, 84])
+        capture.close()
+
+    def test_reopen_adds_records(self):
+        capture = iopi_record.CaptureFile(self.path, 10, True)
+        capture.append(0.0, 1, 2, 3)
+        capture.close()
+        capture = iopi_record.CaptureFile(self.path)
+        self.assertTrue(capture.interrupts)
+        capture.append(1.0, 4, 5, 6)
+        self.assertEqual([record[1:] for record in capture.records()],
+                         [(1, 2, 3), (4, 5, 6)])
+        capture.close()
+
+
+class RecordReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record_and_replay(self):
+        self.bus.devices[0x20].set_inputs(0x1234)
+        status, output = support.cli(
+            '--record=' + self.path + ' --rate=1000 --samples=10 '
+            '--interrupts -a 0x20')
+        self.assertEqual(status, 0)
+        status, output = support.cli('--replay=' + self.path + ' -x')
+        self.assertEqual(status, 0)
+        lines = output.splitlines()
+        self.assertEqual(lines[0], 'time,read,int_status,int_capture')
+        self.assertEqual(len(lines), 11)
+        self.assertEqual(lines[1].split(',')[1], '0x1234')
+        status, output = support.cli('--replay=' + self.path +
+                                     ' --format=ndjson')
+        records = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual(len(records), 10)
+        self.assertEqual(records[-1]['read'], str(0x1234))
+
+    def test_replay_between_times(self):
+        capture = iopi_record.CaptureFile(self.path, 100, index_every=10)
+        offset = capture.offset
+        for number in range(100):
+            capture.append(number * 0.1 - offset, number)
+        capture.close()
+        status, output = support.cli('--replay=' + self.path +
+                                     ' --from=2.05 --to=2.55')
+        self.assertEqual(status, 0)
+        self.assertEqual([int(line.split(',')[1]) for line
+                          in output.splitlines()[1:]], [21, 22, 23, 24, 25])
+
+    def test_missing_file(self):
+        status, output = support.cli('--replay=' + self.path)
+        self.assertEqual(status, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+"""
+Debounced input rules on the simulated bus
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import support
+import iopi
+import iopi_rules
+from iopi_rules import RuleEngine
+
+MCP23017 = iopi.MCP23017
+
+
+def wait_for(condition, timeout=2.0):
+    """
+    Wait for a condition to become true
+    returns the last value of the condition
+    """
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.001)
+    return condition()
+
+
+class RuleEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.chip = self.bus.devices[0x20]
+        self.device = MCP23017(0x20)
+        self.calls = []
+
+    def action(self, pin, level, edge):
+        self.calls.append((pin, level, edge))
+
+    def test_edges(self):
+        engine = RuleEngine(self.device, poll_interval=0.0005)
+        engine.add_rule(1, 'rising', self.action)
+        engine.add_rule(2, 'both', self.action)
+        engine.start()
+        try:
+            for level in (0x01, 0x03, 0x02, 0x00):
+                events = engine.events
+                self.chip.set_inputs(level)
+                self.assertTrue(wait_for(lambda: engine.events > events))
+        finally:
+            engine.stop()
+        self.assertEqual(self.calls, [(1, 1, 'rising'), (2, 1, 'rising'),
+                                      (2, 0, 'falling')])
+        stats = engine.statistics()
+        self.assertEqual(stats['events'], 4)
+        self.assertEqual(stats['actions'], 3)
+        self.assertEqual(stats['errors'], 0)
+        self.assertLessEqual(stats['p50'], stats['max'])
+
+    def test_debounce(self):
+        engine = RuleEngine(self.device, poll_interval=0.0005)
+        engine.add_rule(3, 'both', self.action, debounce=0.05)
+        engine.start()
+        try:
+            # a short glitch is not passed on
+            self.chip.set_inputs(0x04)
+            time.sleep(0.005)
+            self.chip.set_inputs(0x00)
+            time.sleep(0.1)
+            self.assertEqual(self.calls, [])
+            self.chip.set_inputs(0x04)
+            self.assertTrue(wait_for(lambda: self.calls))
+        finally:
+            engine.stop()
+        self.assertEqual(self.calls, [(3, 1, 'rising')])
+
+    def test_write_action(self):
+        self.device.set_direction(9, 0, True)
+        self.device.write(9, 1, True)
+        engine = RuleEngine(self.device, poll_interval=0.0005)
+        engine.add_rule(1, 'both', iopi_rules.write_action(
+            self.device, 9, 'inverse'))
+        engine.start()
+        try:
+            self.chip.set_inputs(0x0001, 0x0001)
+            self.assertTrue(wait_for(lambda: engine.actions == 1))
+        finally:
+            engine.stop()
+        self.assertEqual(self.chip.pins() & 0x0100, 0)
+        self.assertEqual(
+            self.device.read_registers()[MCP23017.OLATB] & 0x01, 0)
+
+    def test_action_errors_are_counted(self):
+        def fail(pin, level, edge):
+            raise RuntimeError('failed')
+        engine = RuleEngine(self.device, poll_interval=0.0005)
+        engine.add_rule(1, 'rising', fail, text='failing rule')
+        engine.add_rule(1, 'rising', self.action)
+        engine.start()
+        try:
+            self.chip.set_inputs(0x01)
+            self.assertTrue(wait_for(lambda: engine.actions == 2))
+        finally:
+            engine.stop()
+        self.assertEqual(engine.errors, 1)
+        self.assertEqual(engine.last_error, 'failing rule: failed')
+        self.assertEqual(self.calls, [(1, 1, 'rising')])
+
+    def test_bad_rules(self):
+        engine = RuleEngine(self.device)
+        self.assertRaises(ValueError, engine.add_rule, 17, 'both',
+                          self.action)
+        self.assertRaises(ValueError, engine.add_rule, 1, 'up', self.action)
+        self.assertRaises(ValueError, engine.add_rule, 1, 'both',
+                          self.action, -1)
+
+
+class LoadRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'rules.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, text):
+        with open(self.path, 'w') as rules_file:
+            rules_file.write(text)
+        devices = {}
+
+        def get_device(address):
+            address = address or 0x20
+            if address not in devices:
+                devices[address] = MCP23017(address)
+            return devices[address]
+        return iopi_rules.load_rules(self.path, get_device)
+
+    def test_load(self):
+        rules = self.load('# comment\n'
+                          '1 rising 0.01 write 0x21:9 level\n'
+                          '\n'
+                          '2 both 0 run echo $IOPI_PIN  # shell\n')
+        self.assertEqual([rule[:3] for rule in rules],
+                         [(1, 'rising', 0.01), (2, 'both', 0.0)])
+        self.assertEqual(rules[1][4], '2 both 0 run echo $IOPI_PIN')
+        # the write action sets pin 9 of the board at 0x21
+        rules[0][3](1, 1, 'rising')
+        self.assertEqual(MCP23017(0x21, init=False).read_registers()[
+            MCP23017.OLATB], 0x01)
+
+    def test_bad_lines(self):
+        self.assertRaises(ValueError, self.load, '1 rising 0 blink 3\n')
+        self.assertRaises(ValueError, self.load, '1 rising 0 write 3\n')
+        self.assertRaises(ValueError, self.load,
+                          '1 rising 0 write 17 1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Shared register shadow and device locks
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+import iopi
+import iopi_shared
+
+
+class SharedShadowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.shadow = iopi_shared.SharedShadow(
+            os.path.join(self.directory, 'test.shadow'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store_and_load(self):
+        values = [None] * iopi_shared.REGISTERS
+        values[0] = 0x0F
+        self.assertEqual(self.shadow.store(0x27, values), 1)
+        self.assertEqual(self.shadow.load(0x27), values)
+        self.assertEqual(self.shadow.generation(0x20), 0)
+
+    def test_address_out_of_range(self):
+        for address in (0x1F, 0x28):
+            self.assertRaises(ValueError, self.shadow.generation, address)
+            self.assertRaises(ValueError, self.shadow.load, address)
+            self.assertRaises(ValueError, self.shadow.store, address,
+                              [None] * iopi_shared.REGISTERS)
+
+
+class SharedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.directory = tempfile.mkdtemp()
+        os.environ['IOPI_LOCK_DIR'] = self.directory
+        iopi.MCP23017.shared_cache = True
+
+    def tearDown(self):
+        iopi.MCP23017.shared_cache = False
+        del os.environ['IOPI_LOCK_DIR']
+        shutil.rmtree(self.directory)
+        path = os.path.join(iopi_shared.shared_dir(),
+                            'iopi-' + self.bus.name + '.shadow')
+        if os.path.exists(path):
+            os.remove(path)
+
+    def test_address_without_slot(self):
+        self.assertRaises(ValueError, iopi.MCP23017, 0x40, False, self.bus)
+
+
+class LockedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = support.new_bus()
+        self.directory = tempfile.mkdtemp()
+        os.environ['IOPI_LOCK_DIR'] = self.directory
+        iopi.MCP23017.locking = True
+
+    def tearDown(self):
+        iopi.MCP23017.locking = False
+        del os.environ['IOPI_LOCK_DIR']
+        shutil.rmtree(self.directory)
+
+    def test_private_cache_reads_inside_lock(self):
+        # a change made by another device is kept by a cached device
+        cached = iopi.MCP23017(0x20, True, self.bus)
+        other = iopi.MCP23017(0x20, False, self.bus)
+        cached.set_direction(0, 0x00)
+        cached.write(3, 1, True)
+        other.write(5, 1, True)
+        cached.write(7, 1, True)
+        self.assertEqual(
+            other.read_registers()[iopi.MCP23017.OLATA], 0x54)
+
+
+if __name__ == '__main__':
+    unittest.main()